@@ -0,0 +1 @@
+"""Benchmarks for the mesh_persist ingest path."""
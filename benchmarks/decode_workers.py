@@ -0,0 +1,77 @@
+"""Decode throughput with 1/2/4 worker processes.
+
+Feeds a fixed set of synthetic encrypted envelopes through the in-thread
+PacketDecoder and through DecodePool at several worker counts, and prints
+messages/second for each as JSON.
+
+    python -m benchmarks.decode_workers --messages 50000 --workers 1 2 4
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+from mesh_persist import channels, decode_pool, decoder, dedup
+
+from .generator import position_stream
+
+
+def run_inline(messages: list[tuple[str, bytes]]) -> float:
+    """Decodes every message on the calling thread; returns msgs/sec."""
+    logger = logging.getLogger("bench.inline")
+    logger.setLevel(logging.WARNING)
+    packet_decoder = decoder.PacketDecoder(
+        channels.ChannelKeys.default(), dedup.DedupCache(), logger
+    )
+    start = time.perf_counter()
+    for topic, payload in messages:
+        packet_decoder.decode(topic, payload)
+    return len(messages) / (time.perf_counter() - start)
+
+
+def run_pool(messages: list[tuple[str, bytes]], workers: int) -> float:
+    """Decodes every message through a DecodePool; returns msgs/sec."""
+    logger = logging.getLogger("bench.pool")
+    logger.setLevel(logging.WARNING)
+    expected = len(messages) * 2  # a mesh_packets row and a node_positions row each
+    received = 0
+    done = threading.Event()
+
+    def on_rows(rows: decoder.Rows) -> None:
+        nonlocal received
+        received += len(rows)
+        if received >= expected:
+            done.set()
+
+    pool = decode_pool.DecodePool(workers, {}, {}, on_rows, logger, log_level=logging.WARNING)
+    pool.start()
+    # let the spawned interpreters finish importing before the clock starts
+    time.sleep(2.0)
+    start = time.perf_counter()
+    for topic, payload in messages:
+        pool.submit(topic, payload)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    return len(messages) / elapsed
+
+
+def main() -> None:
+    """Runs the benchmark and prints JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    messages = position_stream(args.messages, args.nodes)
+    results = {"messages": args.messages, "inline_msgs_per_sec": run_inline(messages)}
+    for workers in args.workers:
+        results[f"workers_{workers}_msgs_per_sec"] = run_pool(messages, workers)
+    print(json.dumps(results, indent=2))  # noqa: T201
+
+
+if __name__ == "__main__":
+    main()
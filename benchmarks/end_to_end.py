@@ -0,0 +1,132 @@
+"""End-to-end ingest throughput.
+
+Pushes synthetic mixed traffic through the same path on_message uses
+(PacketDecoder, then the BatchWriter thread) and reports messages/second
+once every row has been flushed.  The writer either talks to the PostgreSQL
+database configured in mesh_persist.ini (--db postgres) or to an in-memory
+fake that only counts rows (--db fake, the default), which isolates the
+Python side of the pipeline.
+
+    python -m benchmarks.end_to_end --messages 50000 --db fake
+"""
+
+import argparse
+import json
+import logging
+import time
+from collections import Counter
+
+from mesh_persist import batch_writer, channels, config_load, db_functions, decoder, dedup
+
+from .generator import mixed_stream
+
+
+class FakePool:
+    """Stands in for db_functions.ConnectionPool: always healthy, never connects."""
+
+    healthy = True
+
+    def session(self) -> None:
+        """Nothing to connect to."""
+
+
+class FakeDb:
+    """In-memory stand-in for DbFunctions that counts the rows it is asked to write."""
+
+    def __init__(self) -> None:
+        """Initialization function for FakeDb."""
+        self.pool = FakePool()
+        self.rows: Counter[str] = Counter()
+
+    def write_batches(
+        self, batches: dict[str, list[tuple]], *, bulk_copy: bool = False
+    ) -> dict[str, tuple[int, int]]:
+        """Counts the batch the way write_batches would coalesce it."""
+        merged = {}
+        for table, rows in batches.items():
+            batch = db_functions.coalesce_rows(table, rows)
+            self.rows[table] += len(batch)
+            if bulk_copy and table in db_functions.COPY_STAGING:
+                merged[table] = (len(batch), 0)
+        return merged
+
+
+def run(
+    messages: list[tuple[str, bytes]],
+    db: "db_functions.DbFunctions | FakeDb",
+    writer_config: dict,
+) -> dict:
+    """Ingests `messages` and waits for the writer; returns throughput and counters."""
+    logger = logging.getLogger("bench.e2e")
+    logger.setLevel(logging.WARNING)
+    packet_decoder = decoder.PacketDecoder(
+        channels.ChannelKeys.default(), dedup.DedupCache(), logger
+    )
+    writer = batch_writer.BatchWriter.from_config(db, logger, writer_config)  # type: ignore[arg-type]
+    writer.start()
+    start = time.perf_counter()
+    for topic, payload in messages:
+        for table, row in packet_decoder.decode(topic, payload):
+            writer.submit(table, row)
+    decoded = time.perf_counter() - start
+    writer.wait_flushed(writer.stats.rows_submitted)
+    elapsed = time.perf_counter() - start
+    writer.stop()
+    s = writer.stats
+    return {
+        "msgs_per_sec": len(messages) / elapsed,
+        "decode_msgs_per_sec": len(messages) / decoded,
+        "elapsed_seconds": elapsed,
+        "rows_submitted": s.rows_submitted,
+        "rows_written": s.rows_written,
+        "rows_dropped": s.rows_dropped,
+        "flushes": s.flushes,
+        "avg_flush_ms": s.avg_flush_seconds * 1000,
+        "max_flush_ms": s.max_flush_seconds * 1000,
+        "dedup_hit_rate": packet_decoder.dedup.stats.hit_rate,
+    }
+
+
+def main() -> None:
+    """Runs the end-to-end benchmark and prints JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--dup-ratio", type=float, default=0.3)
+    parser.add_argument("--db", choices=("fake", "postgres"), default="fake")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--bulk-copy", action="store_true")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    messages = mixed_stream(args.messages, nodes=args.nodes, dup_ratio=args.dup_ratio)
+    db: db_functions.DbFunctions | FakeDb
+    if args.db == "postgres":
+        db = db_functions.DbFunctions(logging.getLogger("bench.e2e"), config_load.read_config())
+    else:
+        db = FakeDb()
+    writer_config = {
+        "batch_size": args.batch_size,
+        "queue_size": max(10000, args.batch_size * 4),
+        "bulk_copy": str(args.bulk_copy),
+        "stats_interval": 3600,
+    }
+    results = {
+        "benchmark": "end_to_end",
+        "db": args.db,
+        "messages": args.messages,
+        "nodes": args.nodes,
+        "dup_ratio": args.dup_ratio,
+        "batch_size": args.batch_size,
+        "bulk_copy": args.bulk_copy,
+        **run(messages, db, writer_config),
+    }
+    text = json.dumps(results, indent=2)
+    print(text)  # noqa: T201
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:  # noqa: PTH123
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Synthetic Meshtastic MQTT traffic.
+
+Builds encrypted ServiceEnvelope payloads, the way a gateway publishes them,
+so the ingest path can be exercised without a broker or a radio.
+"""
+
+import random
+
+from Crypto.Cipher import AES
+
+from mesh_persist.channels import DEFAULT_KEY
+from mesh_persist.db_functions import id_to_hex
+from mesh_persist.protos import mesh_pb2, mqtt_pb2, portnums_pb2, telemetry_pb2
+
+BROADCAST = 0xFFFFFFFF
+CHANNEL = "LongFast"
+FIRST_NODE = 0x10000000
+FIRST_GATEWAY = 0x20000000
+
+# Rough share of each portnum on a busy public mesh.
+DEFAULT_MIX = {
+    portnums_pb2.POSITION_APP: 0.35,
+    portnums_pb2.TELEMETRY_APP: 0.30,
+    portnums_pb2.NODEINFO_APP: 0.20,
+    portnums_pb2.NEIGHBORINFO_APP: 0.05,
+    portnums_pb2.TEXT_MESSAGE_APP: 0.10,
+}
+
+
+def make_envelope(  # noqa: PLR0913
+    source: int,
+    packet_id: int,
+    portnum: portnums_pb2.PortNum.ValueType,
+    payload: bytes,
+    gateway: int,
+    *,
+    key: bytes = DEFAULT_KEY,
+    rx_time: int = 1700000000,
+    dest: int = BROADCAST,
+) -> tuple[str, bytes]:
+    """Builds one encrypted (topic, payload) pair as published by `gateway`."""
+    data = mesh_pb2.Data(portnum=portnum, payload=payload)
+    nonce = packet_id.to_bytes(8, "little") + source.to_bytes(7, "little")
+    encrypted = AES.new(key, AES.MODE_CTR, nonce=nonce).encrypt(data.SerializeToString())
+    packet = mesh_pb2.MeshPacket()
+    setattr(packet, "from", source)
+    packet.to = dest
+    packet.id = packet_id
+    packet.channel = 8
+    packet.encrypted = encrypted
+    packet.rx_time = rx_time
+    packet.rx_snr = random.uniform(-20.0, 10.0)  # noqa: S311
+    packet.rx_rssi = random.randint(-130, -40)  # noqa: S311
+    packet.hop_limit = 3
+    packet.hop_start = 3
+    envelope = mqtt_pb2.ServiceEnvelope(
+        packet=packet, channel_id=CHANNEL, gateway_id=id_to_hex(gateway)
+    )
+    return f"msh/US/2/e/{CHANNEL}/{id_to_hex(gateway)}", envelope.SerializeToString()
+
+
+def position_stream(count: int, nodes: int = 1000, seed: int = 1) -> list[tuple[str, bytes]]:
+    """Builds `count` unique POSITION_APP messages spread over `nodes` nodes."""
+    rng = random.Random(seed)  # noqa: S311
+    messages = []
+    for i in range(count):
+        source = 0x10000000 + rng.randrange(nodes)
+        messages.append(
+            make_envelope(source, i + 1, portnums_pb2.POSITION_APP, _position(rng), 0x20000000)
+        )
+    return messages
+
+
+def _position(rng: random.Random) -> bytes:
+    return mesh_pb2.Position(
+        latitude_i=rng.randint(-900000000, 900000000),
+        longitude_i=rng.randint(-1800000000, 1800000000),
+        altitude=rng.randint(0, 3000),
+    ).SerializeToString()
+
+
+def _nodeinfo(rng: random.Random, source: int) -> bytes:
+    return mesh_pb2.User(
+        id=id_to_hex(source),
+        long_name=f"Meshtastic {source & 0xFFFF:04x}",
+        short_name=f"{source & 0xFFFF:04x}",
+        hw_model=rng.choice((mesh_pb2.TBEAM, mesh_pb2.HELTEC_V3, mesh_pb2.RAK4631)),
+    ).SerializeToString()
+
+
+def _telemetry(rng: random.Random) -> bytes:
+    return telemetry_pb2.Telemetry(
+        time=1700000000,
+        device_metrics=telemetry_pb2.DeviceMetrics(
+            battery_level=rng.randint(0, 101),
+            voltage=rng.uniform(3.3, 4.2),
+            channel_utilization=rng.uniform(0.0, 40.0),
+            air_util_tx=rng.uniform(0.0, 10.0),
+            uptime_seconds=rng.randint(0, 10000000),
+        ),
+    ).SerializeToString()
+
+
+def _neighborinfo(rng: random.Random, source: int) -> bytes:
+    return mesh_pb2.NeighborInfo(
+        node_id=source,
+        node_broadcast_interval_secs=900,
+        neighbors=[
+            mesh_pb2.Neighbor(node_id=FIRST_NODE + rng.randrange(1000), snr=rng.uniform(-20, 10))
+            for _ in range(rng.randint(1, 8))
+        ],
+    ).SerializeToString()
+
+
+def _text_message(rng: random.Random) -> bytes:
+    return ("hello mesh " * rng.randint(1, 10)).encode("utf-8")
+
+
+# payload builder per portnum, called with the random generator and the source node
+PAYLOAD_BUILDERS = {
+    portnums_pb2.POSITION_APP: lambda rng, _source: _position(rng),
+    portnums_pb2.NODEINFO_APP: _nodeinfo,
+    portnums_pb2.TELEMETRY_APP: lambda rng, _source: _telemetry(rng),
+    portnums_pb2.NEIGHBORINFO_APP: _neighborinfo,
+    portnums_pb2.TEXT_MESSAGE_APP: lambda rng, _source: _text_message(rng),
+}
+
+
+def mixed_stream(  # noqa: PLR0913
+    count: int,
+    *,
+    nodes: int = 1000,
+    gateways: int = 10,
+    dup_ratio: float = 0.3,
+    mix: dict[portnums_pb2.PortNum.ValueType, float] | None = None,
+    seed: int = 1,
+) -> list[tuple[str, bytes]]:
+    """Builds `count` messages of mixed traffic, as seen by a busy MQTT server.
+
+    Args:
+        count: number of (topic, payload) messages to build.
+        nodes: number of distinct source nodes.
+        gateways: number of distinct gateways publishing receptions.
+        dup_ratio: fraction of messages that are repeat receptions of an earlier
+            packet through a different gateway.
+        mix: relative weight of each portnum (default DEFAULT_MIX).
+        seed: random seed, so runs are comparable.
+    """
+    rng = random.Random(seed)  # noqa: S311
+    mix = mix or DEFAULT_MIX
+    portnums = list(mix)
+    weights = list(mix.values())
+    messages: list[tuple[str, bytes]] = []
+    recent: list[tuple[int, int, portnums_pb2.PortNum.ValueType, bytes, int]] = []
+    packet_id = 0
+    for _ in range(count):
+        gateway = FIRST_GATEWAY + rng.randrange(gateways)
+        if recent and rng.random() < dup_ratio:
+            source, pkt_id, portnum, payload, rx_time = rng.choice(recent)
+        else:
+            packet_id += 1
+            source = FIRST_NODE + rng.randrange(nodes)
+            portnum = rng.choices(portnums, weights)[0]
+            payload = PAYLOAD_BUILDERS[portnum](rng, source)
+            pkt_id = packet_id
+            rx_time = 1700000000 + packet_id
+            recent.append((source, pkt_id, portnum, payload, rx_time))
+            if len(recent) > 256:  # noqa: PLR2004
+                recent.pop(0)
+        messages.append(make_envelope(source, pkt_id, portnum, payload, gateway, rx_time=rx_time))
+    return messages
@@ -0,0 +1,80 @@
+"""Cold import time of the persister's entry points.
+
+Imports each module in a fresh interpreter, `repeat` times, and reports the
+best cumulative import time Python itself measures (-X importtime), plus the
+wall time of the whole process less that of an empty interpreter.  The full
+meshtastic package is measured too, for comparison with the protobuf-only
+mesh_persist.protos.  decode_pool is what every decode worker process
+imports when it is spawned.
+
+    python -m benchmarks.import_time --repeat 10
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+MODULES = (
+    "meshtastic",
+    "mesh_persist.protos",
+    "mesh_persist.decoder",
+    "mesh_persist.decode_pool",
+    "mesh_persist.mesh_persist",
+)
+
+
+def import_once(module: str) -> tuple[float, float]:
+    """Imports module in a new interpreter; returns (import seconds, wall seconds)."""
+    code = f"import {module}" if module else "pass"
+    start = time.perf_counter()
+    proc = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    imported = 0.0
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[2].strip() == module:  # noqa: PLR2004
+            imported = int(fields[1]) / 1e6
+    return imported, wall
+
+
+def measure(module: str, repeat: int, baseline: float) -> dict[str, float]:
+    """Best of `repeat` cold imports of module, in milliseconds."""
+    runs = [import_once(module) for _ in range(repeat)]
+    return {
+        "import_ms": min(imported for imported, _ in runs) * 1000,
+        "wall_ms": (min(wall for _, wall in runs) - baseline) * 1000,
+    }
+
+
+def main() -> None:
+    """Runs the benchmark and prints JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--modules", nargs="+", default=list(MODULES))
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    baseline = min(import_once("")[1] for _ in range(args.repeat))
+    results = {
+        "benchmark": "import_time",
+        "repeat": args.repeat,
+        "interpreter_ms": baseline * 1000,
+        "modules": {module: measure(module, args.repeat, baseline) for module in args.modules},
+    }
+    text = json.dumps(results, indent=2)
+    print(text)  # noqa: T201
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:  # noqa: PTH123
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Memory held per queued packet: row records versus protobuf messages.
+
+Decodes the same synthetic mixed traffic two ways and keeps everything that
+would sit on the write queue during a backlog:
+
+- records: the (table, row) pairs PacketDecoder.decode produces, which is
+  what the batch writer queues (the dedup cache entries made along the way
+  are included, so this slightly overstates the queue's share);
+- protobuf: the decoded ServiceEnvelope plus the parsed payload message for
+  each packet, which is what queueing packets rather than rows would keep.
+
+Reports bytes per packet as JSON, from tracemalloc and, on Linux, from the
+change in resident set size (protobuf's upb backend allocates outside the
+Python allocator, where tracemalloc can't see it).
+
+    python -m benchmarks.memory --messages 50000
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import tracemalloc
+from collections.abc import Callable
+
+from Crypto.Cipher import AES
+
+from mesh_persist import channels, decoder, dedup, protos
+from mesh_persist.protos import mqtt_pb2
+
+from .generator import mixed_stream
+
+
+def _rss() -> int | None:
+    """Resident set size in bytes, or None where /proc isn't available."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:  # noqa: PTH123
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def measure(count: int, build: Callable[[], list]) -> dict[str, float | None]:
+    """Bytes per packet retained by the list build() returns."""
+    gc.collect()
+    rss_before = _rss()
+    tracemalloc.start()
+    kept = build()
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    rss_after = _rss()
+    result = {"traced_bytes_per_packet": traced / count, "rss_bytes_per_packet": None}
+    if rss_before is not None and rss_after is not None:
+        result["rss_bytes_per_packet"] = (rss_after - rss_before) / count
+    del kept
+    return result
+
+
+def records(messages: list[tuple[str, bytes]]) -> list:
+    """The rows the decoder queues for each message."""
+    logger = logging.getLogger("bench.memory")
+    logger.setLevel(logging.WARNING)
+    packet_decoder = decoder.PacketDecoder(
+        channels.ChannelKeys.default(), dedup.DedupCache(), logger
+    )
+    return [packet_decoder.decode(topic, payload) for topic, payload in messages]
+
+
+def protobufs(messages: list[tuple[str, bytes]], key: bytes) -> list:
+    """The decoded envelope and payload message for each message."""
+    kept = []
+    for _, payload in messages:
+        envelope = mqtt_pb2.ServiceEnvelope()
+        envelope.ParseFromString(payload)
+        pkt = envelope.packet
+        nonce = pkt.id.to_bytes(8, "little") + getattr(pkt, "from").to_bytes(7, "little")
+        plain = AES.new(key, AES.MODE_CTR, nonce=nonce).decrypt(pkt.encrypted)
+        pkt.decoded.ParseFromString(plain)
+        payload_type = protos.PAYLOAD_TYPES.get(pkt.decoded.portnum)
+        pb = None
+        if payload_type is not None:
+            pb = payload_type()
+            pb.ParseFromString(pkt.decoded.payload)
+        kept.append((envelope, pb))
+    return kept
+
+
+def main() -> None:
+    """Runs the memory comparison and prints JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--dup-ratio", type=float, default=0.3)
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    key = channels.DEFAULT_KEY
+    messages = mixed_stream(args.messages, nodes=args.nodes, dup_ratio=args.dup_ratio)
+    results = {
+        "benchmark": "memory",
+        "messages": args.messages,
+        "nodes": args.nodes,
+        "dup_ratio": args.dup_ratio,
+        "records": measure(args.messages, lambda: records(messages)),
+        "protobuf": measure(args.messages, lambda: protobufs(messages, key)),
+    }
+    text = json.dumps(results, indent=2)
+    print(text)  # noqa: T201
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:  # noqa: PTH123
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
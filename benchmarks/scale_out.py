@@ -0,0 +1,143 @@
+"""Ingest throughput of 1/2/4 instances sharing one MQTT subscription.
+
+Runs N consumer processes against a real broker (a local mosquitto will do),
+each subscribed to the same MQTT v5 shared subscription and decoding what the
+broker hands it with its own PacketDecoder and dedup cache, the way N
+mesh-persist instances started with the same [mqtt] share_group would.  The
+same synthetic mixed traffic is then published once per instance count, and
+the messages/second at which the group drains it is printed as JSON.  The
+publish rate is reported too: once it is close to the drain rate, the
+publisher, not the instances, is the limit.
+
+    mosquitto -p 1883 &
+    python -m benchmarks.scale_out --broker localhost --instances 1 2 4
+"""
+
+import argparse
+import dataclasses
+import json
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing.synchronize import Event
+
+from mesh_persist import channels, decoder, dedup, mqtt_session
+
+from .generator import mixed_stream
+
+
+def consume(settings: mqtt_session.MqttSettings, total, ready: Event, stop: Event) -> None:
+    """One instance: decodes its share of the messages and adds its count to total."""
+    logger = logging.getLogger("bench.scale_out")
+    logger.setLevel(logging.WARNING)
+    packet_decoder = decoder.PacketDecoder(
+        channels.ChannelKeys.default(), dedup.DedupCache(), logger
+    )
+    received = 0
+
+    def on_message(client, userdata, message) -> None:  # noqa: ARG001
+        nonlocal received
+        packet_decoder.decode(message.topic, message.payload)
+        received += 1
+
+    client = mqtt_session.paho_client(settings)
+    client.on_message = on_message
+    client.on_connect = lambda c, *_: c.subscribe(settings.subscriptions)
+    client.on_subscribe = lambda *_: ready.set()
+    mqtt_session.connect_paho(client, settings)
+    client.loop_start()
+    reported = 0
+    # the count is published in bulk, so the processes don't contend on the lock
+    while not stop.wait(0.05):
+        current = received
+        with total.get_lock():
+            total.value += current - reported
+        reported = current
+    client.loop_stop()
+    client.disconnect()
+
+
+def run(
+    settings: mqtt_session.MqttSettings,
+    messages: list[tuple[str, bytes]],
+    instances: int,
+    timeout: float,
+) -> dict[str, float]:
+    """Drains messages with `instances` consumers; returns the rates."""
+    ctx = multiprocessing.get_context("spawn")
+    prefix = f"bench/{os.getpid()}/{instances}"
+    group = dataclasses.replace(
+        settings, topics=(f"{prefix}/#",), share_group=f"bench{os.getpid()}x{instances}"
+    )
+    total = ctx.Value("q", 0)
+    stop = ctx.Event()
+    readies = [ctx.Event() for _ in range(instances)]
+    procs = [ctx.Process(target=consume, args=(group, total, r, stop)) for r in readies]
+    for proc in procs:
+        proc.start()
+    for ready in readies:
+        ready.wait(timeout)
+
+    publisher = mqtt_session.paho_client(settings)
+    publisher.max_inflight_messages_set(1000)
+    mqtt_session.connect_paho(publisher, settings)
+    publisher.loop_start()
+    start = time.perf_counter()
+    info = None
+    for topic, payload in messages:
+        info = publisher.publish(f"{prefix}/{topic}", payload, qos=settings.qos)
+    if info is not None:
+        info.wait_for_publish(timeout)
+    published = time.perf_counter() - start
+    deadline = time.monotonic() + timeout
+    while total.value < len(messages) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for proc in procs:
+        proc.join()
+    publisher.loop_stop()
+    publisher.disconnect()
+    return {
+        "msgs_per_sec": total.value / elapsed,
+        "publish_msgs_per_sec": len(messages) / published,
+        "received": total.value,
+    }
+
+
+def main() -> None:
+    """Runs the benchmark and prints JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--user")
+    parser.add_argument("--password")
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=1)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--dup-ratio", type=float, default=0.3)
+    parser.add_argument("--instances", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    settings = mqtt_session.MqttSettings(
+        args.broker, args.port, args.user, args.password, (), qos=args.qos, v5=True
+    )
+    messages = mixed_stream(args.messages, nodes=args.nodes, dup_ratio=args.dup_ratio)
+    results = {
+        "benchmark": "scale_out",
+        "messages": args.messages,
+        "qos": args.qos,
+        "instances": {n: run(settings, messages, n, args.timeout) for n in args.instances},
+    }
+    text = json.dumps(results, indent=2)
+    print(text)  # noqa: T201
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:  # noqa: PTH123
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Per-stage microbenchmarks for the decode hot path.
+
+Times each stage of PacketDecoder.decode in isolation over the same synthetic
+mixed traffic: ServiceEnvelope parse, AES-CTR decrypt (a new cipher per
+packet, and the channel registry's precomputed one), Data and payload
+protobuf parse, and building the table rows.  Prints nanoseconds per message
+and messages/second per stage as JSON.
+
+    python -m benchmarks.stages --messages 20000 --dup-ratio 0.3
+"""
+
+import argparse
+import json
+import logging
+import time
+from collections.abc import Callable
+
+from Crypto.Cipher import AES
+
+from mesh_persist import channels, db_functions, decoder, dedup, protos
+from mesh_persist.protos import mesh_pb2, mqtt_pb2
+
+from .generator import mixed_stream
+
+
+def best_of(repeat: int, count: int, func: Callable[[], object]) -> dict[str, float]:
+    """Runs func `repeat` times and reports the fastest run, per message."""
+    best = min(_timed(func) for _ in range(repeat))
+    return {"ns_per_msg": best / count * 1e9, "msgs_per_sec": count / best}
+
+
+def _timed(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run_stages(messages: list[tuple[str, bytes]], repeat: int = 5) -> dict[str, dict]:  # noqa: C901
+    """Times each decode stage over `messages`; returns per-stage results."""
+    key = channels.DEFAULT_KEY
+    keys = channels.ChannelKeys.default()
+    channel = channels.ChannelKey("LongFast", key)
+    logger = logging.getLogger("bench.stages")
+    logger.setLevel(logging.WARNING)
+    count = len(messages)
+
+    envelopes = []
+    for _, payload in messages:
+        envelope = mqtt_pb2.ServiceEnvelope()
+        envelope.ParseFromString(payload)
+        envelopes.append(envelope)
+
+    def envelope_parse() -> None:
+        for _, payload in messages:
+            mqtt_pb2.ServiceEnvelope().ParseFromString(payload)
+
+    def nonce(pkt: mesh_pb2.MeshPacket) -> bytes:
+        return pkt.id.to_bytes(8, "little") + getattr(pkt, "from").to_bytes(7, "little")
+
+    def decrypt() -> None:
+        for envelope in envelopes:
+            pkt = envelope.packet
+            AES.new(key, AES.MODE_CTR, nonce=nonce(pkt)).decrypt(pkt.encrypted)
+
+    def decrypt_cached() -> None:
+        for envelope in envelopes:
+            pkt = envelope.packet
+            channel.decrypt(pkt.id, getattr(pkt, "from"), pkt.encrypted)
+
+    plain = [
+        AES.new(key, AES.MODE_CTR, nonce=nonce(e.packet)).decrypt(e.packet.encrypted)
+        for e in envelopes
+    ]
+
+    def payload_parse() -> None:
+        for text in plain:
+            data = mesh_pb2.Data()
+            data.ParseFromString(text)
+            payload_type = protos.PAYLOAD_TYPES.get(data.portnum)
+            if payload_type is not None:
+                payload_type().ParseFromString(data.payload)
+
+    parsed = []
+    for envelope, text in zip(envelopes, plain, strict=True):
+        envelope.packet.decoded.ParseFromString(text)
+        payload_type = protos.PAYLOAD_TYPES.get(envelope.packet.decoded.portnum)
+        pb = None
+        if payload_type is not None:
+            pb = payload_type()
+            pb.ParseFromString(envelope.packet.decoded.payload)
+        parsed.append((envelope, pb))
+    packet_decoder = decoder.PacketDecoder(keys, dedup.DedupCache(), logger)
+
+    def row_building() -> None:
+        for envelope, pb in parsed:
+            db_functions.mesh_packet_row(envelope)
+            packet_decoder.payload_rows(envelope.packet, pb)
+
+    def full_decode() -> None:
+        # a fresh cache each run, so duplicates are recognised the same way every time
+        full = decoder.PacketDecoder(keys, dedup.DedupCache(), logger)
+        for topic, payload in messages:
+            full.decode(topic, payload)
+
+    return {
+        "envelope_parse": best_of(repeat, count, envelope_parse),
+        "decrypt": best_of(repeat, count, decrypt),
+        "decrypt_cached": best_of(repeat, count, decrypt_cached),
+        "payload_parse": best_of(repeat, count, payload_parse),
+        "row_building": best_of(repeat, count, row_building),
+        "full_decode": best_of(repeat, count, full_decode),
+    }
+
+
+def main() -> None:
+    """Runs the stage benchmarks and prints JSON results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--dup-ratio", type=float, default=0.3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    messages = mixed_stream(args.messages, nodes=args.nodes, dup_ratio=args.dup_ratio)
+    results = {
+        "benchmark": "stages",
+        "messages": args.messages,
+        "nodes": args.nodes,
+        "dup_ratio": args.dup_ratio,
+        "stages": run_stages(messages, args.repeat),
+    }
+    text = json.dumps(results, indent=2)
+    print(text)  # noqa: T201
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:  # noqa: PTH123
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+--
+-- Converts the append-only packet and metric tables to range partitions on toi.
+--
+-- Run once, with mesh-persist stopped:
+--
+--     psql -d meshtastic -f db/migrations/0001_partition_by_toi.sql
+--
+-- Each table is renamed to <table>_unpartitioned, recreated as a partitioned
+-- table with one partition per month from its oldest row to three months
+-- ahead plus a default partition (for packets with nonsense timestamps), and
+-- its rows copied across.  After that, mesh-persist creates future
+-- partitions and applies retention itself (see [partitions] in
+-- mesh_persist.ini).  The old tables are left in place; drop them once the
+-- new ones have been checked:
+--
+--     DROP TABLE mesh_packets_unpartitioned, device_metrics_unpartitioned, ...;
+--
+-- Unique indexes on a partitioned table have to include the partition key, so
+-- the mesh_packets unique key gains toi (a repeat publish of a reception
+-- carries the same rx_time, so it is still caught).  The redundant
+-- mesh_packets_source_idx and idx_device_metrics_node_id_toi_desc indexes are
+-- not recreated: (source, toi DESC) and the (node_id, toi) unique key cover
+-- them.
+--
+
+SET client_min_messages = warning;
+
+BEGIN;
+
+-- partition bounds are whole UTC months
+SET LOCAL timezone = 'UTC';
+
+CREATE FUNCTION pg_temp.partition_by_toi(tbl text) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    old_tbl text := tbl || '_unpartitioned';
+    idx record;
+    oldest timestamptz;
+    m timestamptz;
+BEGIN
+    EXECUTE format('ALTER TABLE public.%I RENAME TO %I', tbl, old_tbl);
+    -- free the index names for the new table; the old table is only read from now on
+    FOR idx IN
+        SELECT indexrelid::regclass AS name FROM pg_index WHERE indrelid = ('public.' || old_tbl)::regclass
+    LOOP
+        EXECUTE format('DROP INDEX %s', idx.name);
+    END LOOP;
+    EXECUTE format(
+        'CREATE TABLE public.%I (LIKE public.%I INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+        'PARTITION BY RANGE (toi)', tbl, old_tbl);
+    EXECUTE format('ALTER TABLE public.%I OWNER TO mesh_rw', tbl);
+    EXECUTE format('GRANT SELECT ON TABLE public.%I TO mesh_ro', tbl);
+
+    EXECUTE format('SELECT min(toi) FROM public.%I', old_tbl) INTO oldest;
+    m := date_trunc('month', coalesce(oldest, now()));
+    WHILE m < date_trunc('month', now()) + interval '4 months' LOOP
+        EXECUTE format(
+            'CREATE TABLE public.%I PARTITION OF public.%I FOR VALUES FROM (%L) TO (%L)',
+            tbl || '_p' || to_char(m, 'YYYYMMDD'), tbl, m, m + interval '1 month');
+        m := m + interval '1 month';
+    END LOOP;
+    EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I DEFAULT', tbl || '_default', tbl);
+
+    EXECUTE format('INSERT INTO public.%I SELECT * FROM public.%I', tbl, old_tbl);
+END;
+$$;
+
+-- views are bound to the tables they were created on, so rebuild them afterwards
+DROP VIEW public.current_nodes;
+DROP MATERIALIZED VIEW public.last_device_metrics;
+
+-- toi becomes the partition key, so it can no longer be NULL
+UPDATE public.mesh_packets SET toi = now() WHERE toi IS NULL;
+ALTER TABLE public.mesh_packets ALTER COLUMN toi SET NOT NULL;
+
+SELECT pg_temp.partition_by_toi('mesh_packets');
+SELECT pg_temp.partition_by_toi('device_metrics');
+SELECT pg_temp.partition_by_toi('text_messages');
+SELECT pg_temp.partition_by_toi('environment_metrics');
+SELECT pg_temp.partition_by_toi('power_metrics');
+SELECT pg_temp.partition_by_toi('air_quality_metrics');
+SELECT pg_temp.partition_by_toi('local_stats');
+
+ALTER SEQUENCE public.text_messages_msg_id_seq OWNED BY public.text_messages.msg_id;
+
+CREATE UNIQUE INDEX idx_mesh_packets_uk ON public.mesh_packets USING btree (source, packet_id, channel, gateway_id, toi);
+CREATE INDEX idx_mesh_packets_source_toi ON public.mesh_packets USING btree (source, toi DESC);
+CREATE INDEX idx_mesh_packets_toi ON public.mesh_packets USING btree (toi);
+CREATE UNIQUE INDEX idx_device_metrics_uk ON public.device_metrics USING btree (node_id, toi);
+CREATE INDEX idx_text_messages_toi ON public.text_messages USING btree (toi);
+CREATE UNIQUE INDEX idx_environment_metrics_uk ON public.environment_metrics USING btree (node_id, toi);
+CREATE UNIQUE INDEX idx_power_metrics_uk ON public.power_metrics USING btree (node_id, toi);
+CREATE UNIQUE INDEX idx_air_quality_metrics_uk ON public.air_quality_metrics USING btree (node_id, toi);
+CREATE UNIQUE INDEX idx_local_stats_uk ON public.local_stats USING btree (node_id, toi);
+
+CREATE MATERIALIZED VIEW public.last_device_metrics AS
+ SELECT DISTINCT ON (node_id) node_id,
+    round((battery_level)::numeric, 2) AS battery_level,
+    round((voltage)::numeric, 2) AS voltage,
+    round((channel_util)::numeric, 2) AS channel_util,
+    round((air_util_tx)::numeric, 2) AS air_util_tx
+   FROM public.device_metrics
+  ORDER BY node_id, toi DESC
+  WITH NO DATA;
+
+ALTER MATERIALIZED VIEW public.last_device_metrics OWNER TO mesh_rw;
+
+CREATE VIEW public.current_nodes AS
+ SELECT DISTINCT ON (n.source) n.source AS node_id,
+    ni.short_name,
+    ni.long_name,
+    ni.hw_model,
+    ni.role,
+    np.altitude,
+    np.latitude,
+    np.longitude,
+    dm.battery_level,
+    dm.voltage,
+    dm.channel_util,
+    dm.air_util_tx,
+    (now() - mp.toi) AS since
+   FROM ((((public.mesh_packets n
+     LEFT JOIN public.node_infos ni ON ((n.source = ni.node_id)))
+     LEFT JOIN public.node_positions np ON ((n.source = np.node_id)))
+     LEFT JOIN public.last_device_metrics dm ON ((n.source = dm.node_id)))
+     LEFT JOIN LATERAL ( SELECT mesh_packets.toi
+           FROM public.mesh_packets
+          WHERE ((mesh_packets.source = n.source) AND (mesh_packets.toi >= (now() - '7 days'::interval)))
+          ORDER BY mesh_packets.toi DESC
+         LIMIT 1) mp ON (true))
+  WHERE (n.toi >= (now() - '3 days'::interval))
+  ORDER BY n.source, (now() - mp.toi) DESC;
+
+ALTER VIEW public.current_nodes OWNER TO mesh_rw;
+
+COMMIT;
+
+REFRESH MATERIALIZED VIEW public.last_device_metrics;
+ANALYZE public.mesh_packets, public.device_metrics, public.text_messages;
@@ -0,0 +1,100 @@
+--
+-- One row per node, maintained by mesh-persist ([node_status] in mesh_persist.ini),
+-- replacing the query-time work of the current_nodes view.
+--
+--     psql -d meshtastic -f db/migrations/0002_node_status.sql
+--
+-- latitude/longitude are in degrees.  The table is seeded from the existing
+-- tables; packet_count starts from the last 30 days of mesh_packets.
+--
+
+SET client_min_messages = warning;
+
+BEGIN;
+
+CREATE TABLE public.node_status (
+    node_id bigint PRIMARY KEY,
+    last_seen timestamp with time zone,
+    last_gateway bigint,
+    packet_count bigint DEFAULT 0 NOT NULL,
+    long_name character varying(100),
+    short_name character varying(10),
+    hw_model character varying(30),
+    role character varying,
+    info_updated_at timestamp with time zone,
+    latitude double precision,
+    longitude double precision,
+    altitude double precision,
+    position_updated_at timestamp with time zone,
+    battery_level integer,
+    voltage double precision,
+    channel_util double precision,
+    air_util_tx double precision,
+    uptime_seconds integer,
+    metrics_updated_at timestamp with time zone
+);
+
+ALTER TABLE public.node_status OWNER TO mesh_rw;
+GRANT SELECT ON TABLE public.node_status TO mesh_ro;
+
+CREATE INDEX idx_node_status_last_seen ON public.node_status USING btree (last_seen);
+
+INSERT INTO public.node_status (node_id, last_seen, packet_count)
+    SELECT source, max(toi), count(*)
+    FROM public.mesh_packets
+    WHERE toi >= now() - interval '30 days'
+    GROUP BY source;
+
+INSERT INTO public.node_status AS s (node_id, long_name, short_name, hw_model, role, info_updated_at)
+    SELECT DISTINCT ON (node_id) node_id, long_name, short_name, hw_model, role, updated_at
+    FROM public.node_infos
+    ORDER BY node_id, updated_at DESC
+    ON CONFLICT (node_id) DO UPDATE SET
+        long_name = EXCLUDED.long_name, short_name = EXCLUDED.short_name,
+        hw_model = EXCLUDED.hw_model, role = EXCLUDED.role,
+        info_updated_at = EXCLUDED.info_updated_at;
+
+INSERT INTO public.node_status AS s (node_id, latitude, longitude, altitude, position_updated_at)
+    SELECT DISTINCT ON (node_id) node_id,
+        -- rows written before 0003_position_geom.sql are in 1e-7 degrees
+        CASE WHEN abs(latitude) > 90 OR abs(longitude) > 180 THEN latitude / 1e7 ELSE latitude END,
+        CASE WHEN abs(latitude) > 90 OR abs(longitude) > 180 THEN longitude / 1e7 ELSE longitude END,
+        altitude, updated_at
+    FROM public.node_positions
+    ORDER BY node_id, updated_at DESC
+    ON CONFLICT (node_id) DO UPDATE SET
+        latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude,
+        altitude = EXCLUDED.altitude, position_updated_at = EXCLUDED.position_updated_at;
+
+INSERT INTO public.node_status AS s (node_id, battery_level, voltage, channel_util, air_util_tx,
+        uptime_seconds, metrics_updated_at)
+    SELECT DISTINCT ON (node_id) node_id, battery_level, voltage, channel_util, air_util_tx,
+        uptime_seconds, toi
+    FROM public.device_metrics
+    ORDER BY node_id, toi DESC
+    ON CONFLICT (node_id) DO UPDATE SET
+        battery_level = EXCLUDED.battery_level, voltage = EXCLUDED.voltage,
+        channel_util = EXCLUDED.channel_util, air_util_tx = EXCLUDED.air_util_tx,
+        uptime_seconds = EXCLUDED.uptime_seconds,
+        metrics_updated_at = EXCLUDED.metrics_updated_at;
+
+-- same columns as before, now a primary-key-ordered scan of node_status
+CREATE OR REPLACE VIEW public.current_nodes AS
+ SELECT node_id,
+    short_name,
+    long_name,
+    hw_model,
+    role,
+    altitude,
+    latitude,
+    longitude,
+    round((battery_level)::numeric, 2) AS battery_level,
+    round((voltage)::numeric, 2) AS voltage,
+    round((channel_util)::numeric, 2) AS channel_util,
+    round((air_util_tx)::numeric, 2) AS air_util_tx,
+    (now() - last_seen) AS since
+   FROM public.node_status
+  WHERE (last_seen >= (now() - '3 days'::interval))
+  ORDER BY node_id;
+
+COMMIT;
@@ -0,0 +1,50 @@
+--
+-- node_positions: geom and degree latitude/longitude are now written by the
+-- INSERT itself, so the geom_inserted trigger (and its second UPDATE per
+-- row) goes away.
+--
+-- Run with mesh-persist stopped, and outside a transaction (the backfill
+-- commits after each chunk, so it doesn't hold locks or bloat one huge
+-- transaction):
+--
+--     psql -d meshtastic -f db/migrations/0003_position_geom.sql
+--
+-- Existing rows store latitude/longitude in 1e-7 degrees and their geom was
+-- computed with integer division; both are rewritten.  A row is recognised as
+-- old-scale by a coordinate outside the valid degree range.  The migration can
+-- be re-run safely if interrupted.
+--
+
+SET client_min_messages = notice;
+
+DROP TRIGGER IF EXISTS geom_inserted ON public.node_positions;
+DROP FUNCTION IF EXISTS public.fn_add_geom_update();
+
+DO $$
+DECLARE
+    updated integer;
+    total bigint := 0;
+BEGIN
+    LOOP
+        UPDATE public.node_positions
+            SET latitude = latitude / 1e7,
+                longitude = longitude / 1e7,
+                geom = public.ST_SetSRID(public.ST_MakePoint(longitude / 1e7, latitude / 1e7, 0), 4326)
+            WHERE ctid IN (
+                SELECT ctid FROM public.node_positions
+                WHERE abs(latitude) > 90 OR abs(longitude) > 180
+                LIMIT 10000);
+        GET DIAGNOSTICS updated = ROW_COUNT;
+        EXIT WHEN updated = 0;
+        total := total + updated;
+        RAISE NOTICE 'node_positions: % rows rescaled', total;
+        COMMIT;
+    END LOOP;
+    -- degree-scale rows that never got a geom
+    UPDATE public.node_positions
+        SET geom = public.ST_SetSRID(public.ST_MakePoint(longitude, latitude, 0), 4326)
+        WHERE geom IS NULL;
+END;
+$$;
+
+ANALYZE public.node_positions;
@@ -0,0 +1,36 @@
+--
+-- Support for running several mesh-persist instances against one database.
+--
+--     psql -d meshtastic -f db/migrations/0004_instances.sql
+--
+-- Every connection mesh-persist opens sets mesh_persist.instance_id to its
+-- [persist] instance_id, and mesh_packets rows are tagged with it by default.
+-- Rows written before this migration have a NULL instance_id.
+--
+-- packet_claims backs the cross-instance dedup ([dedup] shared=true): the first
+-- instance to claim a (source, packet_id) writes the packet's text message or
+-- telemetry row.  Claims only need to outlive the dedup TTL and are pruned by
+-- the instances, so the table is UNLOGGED.
+--
+
+SET client_min_messages = warning;
+
+BEGIN;
+
+ALTER TABLE public.mesh_packets
+    ADD COLUMN IF NOT EXISTS instance_id character varying
+    DEFAULT current_setting('mesh_persist.instance_id', true);
+
+CREATE UNLOGGED TABLE IF NOT EXISTS public.packet_claims (
+    source bigint NOT NULL,
+    packet_id bigint NOT NULL,
+    instance_id character varying DEFAULT current_setting('mesh_persist.instance_id', true),
+    claimed_at timestamp with time zone DEFAULT now() NOT NULL,
+    PRIMARY KEY (source, packet_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_packet_claims_claimed_at ON public.packet_claims (claimed_at);
+
+ALTER TABLE public.packet_claims OWNER TO mesh_rw;
+
+COMMIT;
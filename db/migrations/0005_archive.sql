@@ -0,0 +1,30 @@
+--
+-- Indexes for the Parquet archive (mesh-persist --archive).
+--
+--     psql -d meshtastic -f db/migrations/0005_archive.sql
+--
+-- The archive reads, and optionally deletes, one UTC day of each table at a
+-- time by toi.  mesh_packets already has a toi index; the metric tables are
+-- only indexed by (node_id, toi), so each day would be a full scan.  Their
+-- rows arrive in toi order, which is what BRIN indexes are for: they cost a
+-- few pages per table, and next to nothing on insert.
+--
+
+SET client_min_messages = warning;
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS idx_device_metrics_toi_brin
+    ON public.device_metrics USING brin (toi);
+CREATE INDEX IF NOT EXISTS idx_environment_metrics_toi_brin
+    ON public.environment_metrics USING brin (toi);
+CREATE INDEX IF NOT EXISTS idx_power_metrics_toi_brin
+    ON public.power_metrics USING brin (toi);
+CREATE INDEX IF NOT EXISTS idx_air_quality_metrics_toi_brin
+    ON public.air_quality_metrics USING brin (toi);
+CREATE INDEX IF NOT EXISTS idx_local_stats_toi_brin
+    ON public.local_stats USING brin (toi);
+CREATE INDEX IF NOT EXISTS idx_text_messages_toi_brin
+    ON public.text_messages USING brin (toi);
+
+COMMIT;
@@ -0,0 +1,59 @@
+--
+-- One-minute traffic totals per gateway and channel, maintained by mesh-persist
+-- ([rollups] in mesh_persist.ini).
+--
+--     psql -d meshtastic -f db/migrations/0006_gateway_rollups.sql
+--
+-- mesh-persist adds its in-memory totals into the row for each (bucket,
+-- gateway_id, channel_id) every flush, so sums and counts are kept and the
+-- averages are generated from them.  duplicates counts receptions of a packet
+-- that had already been received (by any gateway).  The table is seeded from
+-- the last 7 days of mesh_packets, where every reception after the first of a
+-- packet is a duplicate.
+--
+
+SET client_min_messages = warning;
+
+BEGIN;
+
+CREATE TABLE public.gateway_rollups (
+    bucket timestamp with time zone NOT NULL,
+    gateway_id bigint NOT NULL,
+    channel_id character varying NOT NULL,
+    packets integer DEFAULT 0 NOT NULL,
+    duplicates integer DEFAULT 0 NOT NULL,
+    snr_min double precision,
+    snr_max double precision,
+    snr_sum double precision DEFAULT 0 NOT NULL,
+    rssi_min integer,
+    rssi_max integer,
+    rssi_sum bigint DEFAULT 0 NOT NULL,
+    hops_sum bigint DEFAULT 0 NOT NULL,
+    hops_count integer DEFAULT 0 NOT NULL,
+    snr_avg double precision GENERATED ALWAYS AS (snr_sum / NULLIF(packets, 0)) STORED,
+    rssi_avg double precision GENERATED ALWAYS AS (rssi_sum::double precision / NULLIF(packets, 0)) STORED,
+    hops_avg double precision GENERATED ALWAYS AS (hops_sum::double precision / NULLIF(hops_count, 0)) STORED,
+    PRIMARY KEY (bucket, gateway_id, channel_id)
+);
+
+ALTER TABLE public.gateway_rollups OWNER TO mesh_rw;
+GRANT SELECT ON TABLE public.gateway_rollups TO mesh_ro;
+
+CREATE INDEX idx_gateway_rollups_gateway_bucket ON public.gateway_rollups USING btree (gateway_id, bucket);
+
+INSERT INTO public.gateway_rollups (bucket, gateway_id, channel_id, packets, duplicates,
+        snr_min, snr_max, snr_sum, rssi_min, rssi_max, rssi_sum, hops_sum, hops_count)
+    SELECT date_trunc('minute', toi), gateway_id, COALESCE(channel_id, ''), count(*),
+        count(*) FILTER (WHERE NOT first),
+        min(rx_snr), max(rx_snr), COALESCE(sum(rx_snr), 0),
+        min(rx_rssi), max(rx_rssi), COALESCE(sum(rx_rssi), 0),
+        COALESCE(sum(hop_start - hop_limit) FILTER (WHERE hop_start >= hop_limit), 0),
+        count(*) FILTER (WHERE hop_start >= hop_limit)
+    FROM (
+        SELECT *, row_number() OVER (PARTITION BY source, packet_id ORDER BY toi) = 1 AS first
+        FROM public.mesh_packets
+        WHERE toi >= now() - interval '7 days' AND gateway_id IS NOT NULL
+    ) AS p
+    GROUP BY 1, 2, 3;
+
+COMMIT;
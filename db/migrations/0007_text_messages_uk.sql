@@ -0,0 +1,30 @@
+--
+-- A unique key for text_messages, so a message written twice (a spool replay
+-- after a crash, or a batch retried after its commit was lost) is caught by
+-- ON CONFLICT DO NOTHING like the other packet tables.
+--
+--     psql -d meshtastic -f db/migrations/0007_text_messages_uk.sql
+--
+-- The key is (source_id, packet_id, toi); toi is the rx_time of the reception
+-- the message was decoded from, and is needed anyway for a unique index on the
+-- partitioned table (see 0001_partition_by_toi.sql).  Duplicates already in
+-- the table are deleted first, keeping the earliest msg_id.  Works on the
+-- table before or after partitioning.
+--
+
+SET client_min_messages = warning;
+
+BEGIN;
+
+DELETE FROM public.text_messages a
+    USING public.text_messages b
+    WHERE a.source_id = b.source_id
+        AND a.packet_id = b.packet_id
+        AND a.toi = b.toi
+        AND a.msg_id > b.msg_id;
+
+CREATE UNIQUE INDEX idx_text_messages_uk ON public.text_messages USING btree (source_id, packet_id, toi);
+
+COMMIT;
+
+ANALYZE public.text_messages;
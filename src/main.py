@@ -2,4 +2,6 @@
 
 from mesh_persist import mesh_persist
 
-mesh_persist.main()
+# decode workers are spawned processes, which import this module again
+if __name__ == "__main__":
+    mesh_persist.main()
@@ -0,0 +1,268 @@
+"""Parquet archive of cold packet and telemetry rows.
+
+`mesh-persist --archive` streams the rows of each [archive] table that are
+older than older_than_days out of the database, one UTC day at a time,
+through a server-side cursor (so memory use is bounded by batch_rows), and
+writes each day to a compressed Parquet file:
+
+    <directory>/<table>/date=YYYY-MM-DD/<table>-YYYYMMDD.parquet
+
+A file is written under a temporary name and renamed once complete.  With
+delete=true the archived day is then deleted from the table.  After each day
+the checkpoint file in the archive directory records how far each table has
+got, so an interrupted run resumes where it stopped.
+
+Requires the optional "archive" extras (pyarrow).
+"""
+
+# pylint: disable=E0401
+# pylint: disable=R0902
+# pylint: disable=R0913
+
+import datetime as dt
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import db_functions, partitions
+from .config_load import TRUTHY
+
+ARCHIVED_TABLES = ("mesh_packets", "device_metrics")
+
+CHECKPOINT_FILE = "_checkpoint.json"
+
+# Postgres type -> (select expression, Arrow type); anything else is archived as text.
+_ARROW_TYPES = {
+    "bigint": ("{}", pa.int64()),
+    "integer": ("{}", pa.int32()),
+    "smallint": ("{}", pa.int16()),
+    "double precision": ("{}", pa.float64()),
+    "real": ("{}", pa.float32()),
+    "numeric": ("{}::double precision", pa.float64()),
+    "boolean": ("{}", pa.bool_()),
+    "character varying": ("{}", pa.string()),
+    "text": ("{}", pa.string()),
+    "bytea": ("{}", pa.binary()),
+    "timestamp with time zone": ("{}", pa.timestamp("us", tz="UTC")),
+    "timestamp without time zone": ("{}", pa.timestamp("us")),
+    "USER-DEFINED": ("ST_AsBinary({})", pa.binary()),  # PostGIS geometry, as WKB
+}
+
+_COLUMNS_SQL = """SELECT column_name, data_type FROM information_schema.columns
+    WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position"""
+
+
+class Checkpoint:
+    """Per-table end of the last archived day, kept in a JSON file."""
+
+    def __init__(self, path: Path) -> None:
+        """Initialization function for Checkpoint."""
+        self.path = path
+        self._done: dict[str, str] = {}
+        if path.exists():
+            self._done = json.loads(path.read_text(encoding="utf-8"))
+
+    def get(self, table: str) -> dt.datetime | None:
+        """Where archiving of table resumes, or None if it never ran."""
+        done = self._done.get(table)
+        return dt.datetime.fromisoformat(done) if done else None
+
+    def set(self, table: str, until: dt.datetime) -> None:
+        """Records that table is archived up to until, replacing the file atomically."""
+        self._done[table] = until.isoformat()
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(self._done, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self.path)
+
+
+class Archiver:
+    """Streams rows older than a cutoff into day-partitioned Parquet files."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        db: db_functions.DbFunctions,
+        logger: logging.Logger,
+        *,
+        directory: str = "archive",
+        tables: tuple[str, ...] = ARCHIVED_TABLES,
+        older_than_days: int = 90,
+        batch_rows: int = 50000,
+        compression: str = "zstd",
+        delete: bool = False,
+    ) -> None:
+        """Initialization function for Archiver.
+
+        Args:
+            db: database functions whose connection pool is used.
+            logger: logger for progress and throughput.
+            directory: root of the Parquet archive.
+            tables: tables to archive; each needs a toi column.
+            older_than_days: archive whole days that ended at least this long ago.
+            batch_rows: rows fetched from the server-side cursor, and written as
+                one Parquet row group, at a time.
+            compression: Parquet compression codec (zstd, snappy, gzip, none).
+            delete: delete each day from the table once its file is written.
+        """
+        self.db = db
+        self.logger = logger
+        self.directory = Path(directory)
+        self.tables = tables
+        self.older_than_days = older_than_days
+        self.batch_rows = batch_rows
+        self.compression = compression
+        self.delete = delete
+        self.checkpoint = Checkpoint(self.directory / CHECKPOINT_FILE)
+        self.rows_archived = 0
+
+    @classmethod
+    def from_config(
+        cls, db: db_functions.DbFunctions, logger: logging.Logger, config: dict
+    ) -> "Archiver":
+        """Builds an Archiver from the [archive] section of mesh_persist.ini."""
+        tables = tuple(t.strip() for t in config.get("tables", "").split(",") if t.strip())
+        return cls(
+            db,
+            logger,
+            directory=config.get("directory", "archive"),
+            tables=tables or ARCHIVED_TABLES,
+            older_than_days=int(config.get("older_than_days", 90)),
+            batch_rows=int(config.get("batch_rows", 50000)),
+            compression=config.get("compression", "zstd"),
+            delete=config.get("delete", "false").lower() in TRUTHY,
+        )
+
+    def run(self, now: dt.datetime | None = None) -> None:
+        """Archives every table up to the cutoff, resuming from the checkpoint."""
+        now = now or dt.datetime.now(dt.UTC)
+        cutoff = partitions.period_start(now - dt.timedelta(days=self.older_than_days), "day")
+        start = time.perf_counter()
+        sess = self.db.pool.session()
+        for table in self.tables:
+            try:
+                self.archive_table(sess.conn, table, cutoff)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.db.pool.discard()
+                raise
+            except psycopg2.Error as e:
+                sess.conn.rollback()
+                err = f"Archiving {table} failed: {db_functions.format_db_error(e)}"
+                self.logger.error(err)  # noqa: TRY400
+        elapsed = time.perf_counter() - start
+        self.logger.info(
+            "Archived %d rows in %.1fs (%.0f rows/s)",
+            self.rows_archived,
+            elapsed,
+            self.rows_archived / elapsed if elapsed else 0.0,
+        )
+
+    def archive_table(self, conn, table: str, cutoff: dt.datetime) -> None:
+        """Archives table one day at a time, from the checkpoint up to cutoff."""
+        with conn.cursor() as cur:
+            cur.execute("SET TIME ZONE 'UTC'")
+            select, schema = self.columns(cur, table)
+            day = self.checkpoint.get(table)
+            if day is None:
+                cur.execute(f"SELECT min(toi) FROM {table} WHERE toi < %s", (cutoff,))  # noqa: S608
+                oldest = cur.fetchone()[0]
+                if oldest is None:
+                    conn.commit()
+                    self.logger.info("%s: nothing older than %s", table, cutoff.date())
+                    return
+                day = partitions.period_start(oldest, "day")
+        conn.commit()
+        while day < cutoff:
+            end = partitions.next_period(day, "day")
+            self.archive_day(conn, table, select, schema, day=day, end=end)
+            self.checkpoint.set(table, end)
+            day = end
+
+    def columns(self, cur, table: str) -> tuple[str, pa.Schema]:
+        """The SELECT list and Arrow schema for archiving table."""
+        cur.execute(_COLUMNS_SQL, (table,))
+        exprs = []
+        fields = []
+        for name, data_type in cur.fetchall():
+            expr, arrow_type = _ARROW_TYPES.get(data_type, ("{}::text", pa.string()))
+            exprs.append(f"{expr.format(name)} AS {name}")
+            fields.append(pa.field(name, arrow_type))
+        if not fields:
+            msg = f"Table {table} not found"
+            raise ValueError(msg)
+        return ", ".join(exprs), pa.schema(fields)
+
+    def day_path(self, table: str, day: dt.datetime) -> Path:
+        """Where the Parquet file for one day of table goes."""
+        return self.directory / table / f"date={day:%Y-%m-%d}" / f"{table}-{day:%Y%m%d}.parquet"
+
+    def archive_day(  # noqa: PLR0913
+        self,
+        conn,
+        table: str,
+        select: str,
+        schema: pa.Schema,
+        *,
+        day: dt.datetime,
+        end: dt.datetime,
+    ) -> None:
+        """Writes one day of table to Parquet and, if asked to, deletes it from the table."""
+        path = self.day_path(table, day)
+        tmp = path.with_suffix(".parquet.tmp")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        count = 0
+        writer = None
+        binary = [i for i, f in enumerate(schema) if pa.types.is_binary(f.type)]
+        # a named cursor is a server-side cursor: rows arrive batch_rows at a time
+        with conn.cursor(name=f"archive_{table}") as cur:
+            cur.itersize = self.batch_rows
+            cur.execute(
+                f"SELECT {select} FROM {table} WHERE toi >= %s AND toi < %s",  # noqa: S608
+                (day, end),
+            )
+            while rows := cur.fetchmany(self.batch_rows):
+                columns = [list(c) for c in zip(*rows, strict=True)]
+                for i in binary:  # bytea arrives as memoryview
+                    columns[i] = [None if v is None else bytes(v) for v in columns[i]]
+                batch = pa.RecordBatch.from_arrays(
+                    [pa.array(c, type=f.type) for c, f in zip(columns, schema, strict=True)],
+                    schema=schema,
+                )
+                if writer is None:
+                    writer = pq.ParquetWriter(str(tmp), schema, compression=self.compression)
+                writer.write_batch(batch)
+                count += len(rows)
+        if writer is None:
+            # nothing (left) that day: e.g. deleted by a run that stopped before
+            # its checkpoint; keep any file that run wrote
+            conn.commit()
+            return
+        writer.close()
+        with tmp.open("rb") as f:
+            os.fsync(f.fileno())
+        tmp.replace(path)
+        deleted = 0
+        if self.delete:
+            with conn.cursor() as cur:
+                cur.execute(f"DELETE FROM {table} WHERE toi >= %s AND toi < %s", (day, end))  # noqa: S608
+                deleted = cur.rowcount
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        self.rows_archived += count
+        self.logger.info(
+            "%s %s: %d rows in %.1fs (%.0f rows/s)%s",
+            table,
+            day.date(),
+            count,
+            elapsed,
+            count / elapsed if elapsed else 0.0,
+            f", deleted {deleted}" if self.delete else "",
+        )
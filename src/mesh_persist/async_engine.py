@@ -0,0 +1,352 @@
+"""Asyncio ingest engine.
+
+An alternative runtime to MeshPersist.main's paho loop_forever: MQTT is
+consumed with aiomqtt and rows are written through a psycopg 3 async
+connection pool, so a slow query never stalls MQTT reads or keepalives.
+
+The engine is three tasks joined by bounded asyncio.Queues:
+
+    reader  -> raw (topic, payload)   -> decoder -> decoded rows -> writer
+
+The decoder task runs PacketDecoder, which also performs de-duplication
+(it has to, since dedup happens before decryption).  Envelope parsing and
+decryption are CPU bound, so the decoder task hands the messages waiting on
+the raw queue, up to DECODE_BATCH at a time, to a single decode thread,
+keeping the event loop free for MQTT and database I/O.  The writer reuses the
+BATCH_SQL statements from db_functions, flushing by size or interval with one
+transaction per batch.
+
+The node state cache, shared dedup claims, node status, rollups and the
+spool are features of the threaded engine's writer; MeshPersist warns at
+startup when they are configured together with this engine (see UNSUPPORTED).
+
+Requires the optional "async" extras (aiomqtt, psycopg[pool]).
+"""
+
+# pylint: disable=E0401
+# pylint: disable=R0902
+# pylint: disable=R0913
+
+import asyncio
+import contextlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiomqtt
+import psycopg
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+from . import backpressure, batch_writer, capture, db_functions, decoder, mqtt_session
+
+# Messages decoded per hand-off to the decode thread.
+DECODE_BATCH = 64
+
+# Parameters psycopg 3 can send with one statement (the protocol's count is 16 bits).
+MAX_PARAMS = 65535
+
+# Settings honoured only by the threaded engine: (section, key, default).  MeshPersist
+# warns about those set in a section that is present in mesh_persist.ini.
+UNSUPPORTED = (
+    ("node_cache", "enabled", True),
+    ("dedup", "shared", False),
+    ("node_status", "enabled", False),
+    ("rollups", "enabled", False),
+    ("spool", "enabled", False),
+)
+
+
+def pg_conninfo(config: dict) -> str:
+    """Builds a libpq conninfo string from the [postgresql] section."""
+    params = dict(config)
+    if "database" in params:
+        params["dbname"] = params.pop("database")
+    return make_conninfo(**params)
+
+
+async def check_migrations(conn: psycopg.AsyncConnection) -> None:
+    """Pool configure hook: rejects connections until the required migrations have run.
+
+    See db_functions.REQUIRED_MIGRATIONS; the pool keeps retrying, so batches
+    wait rather than being written against the old schema.
+    """
+    missing = []
+    for migration, sql in db_functions.REQUIRED_MIGRATIONS.items():
+        cur = await conn.execute(sql)
+        if await cur.fetchone() is not None:
+            missing.append(migration)
+    await conn.rollback()
+    if missing:
+        raise psycopg.OperationalError(db_functions.missing_migrations_message(missing))
+
+
+class AsyncEngine:
+    """MQTT -> decode -> PostgreSQL pipeline running on a single event loop."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        mqtt_settings: mqtt_session.MqttSettings,
+        pg_config: dict,
+        writer_config: dict,
+        packet_decoder: decoder.PacketDecoder,
+        logger: logging.Logger,
+        *,
+        debug: bool = False,
+        capture_writer: capture.CaptureWriter | None = None,
+        backpressure_config: dict | None = None,
+    ) -> None:
+        """Initialization function for AsyncEngine.
+
+        Args:
+            mqtt_settings: the parsed [mqtt] section.
+            pg_config: the [postgresql] section.
+            writer_config: the [writer] section (batch_size, flush_interval, queue_size).
+            packet_decoder: decoder used by the decode task.
+            logger: logger for status and error messages.
+            debug: decode but do not write to the database.
+            capture_writer: if given, every received message is also recorded here.
+            backpressure_config: the [backpressure] section, for shedding rows as the
+                row queue fills.
+        """
+        self.mqtt = mqtt_settings
+        self.pg_config = pg_config
+        self.decoder = packet_decoder
+        self.logger = logger
+        self.debug = debug
+        self.capture = capture_writer
+        self.batch_size = int(writer_config.get("batch_size", 500))
+        self.flush_interval = float(writer_config.get("flush_interval", 1.0))
+        self.stats_interval = float(writer_config.get("stats_interval", 60.0))
+        queue_size = int(writer_config.get("queue_size", 10000))
+        self.pool_size = int(writer_config.get("pool_size", 2))
+        self.raw_queue: asyncio.Queue[tuple[str, bytes]] = asyncio.Queue(maxsize=queue_size)
+        self.row_queue: asyncio.Queue[tuple[str, tuple]] = asyncio.Queue(maxsize=queue_size)
+        self.stats = batch_writer.WriterStats()
+        self.metrics = packet_decoder.metrics
+        self.shedder = backpressure.LoadShedder.from_config(
+            lambda: self.row_queue.qsize() / self.row_queue.maxsize,
+            logger,
+            backpressure_config or {},
+            self.metrics,
+        )
+        if self.metrics is not None:
+            self.metrics.add_gauge(
+                "mesh_persist_raw_queue_depth",
+                "Messages waiting to be decoded.",
+                self.raw_queue.qsize,
+            )
+            self.metrics.add_gauge(
+                "mesh_persist_writer_queue_depth",
+                "Rows waiting to be flushed.",
+                self.row_queue.qsize,
+            )
+
+    async def run(self) -> None:
+        """Runs the reader, decoder and writer tasks until cancelled."""
+        async with (
+            AsyncConnectionPool(
+                pg_conninfo(self.pg_config),
+                min_size=1,
+                max_size=self.pool_size,
+                open=False,
+                configure=check_migrations,
+            ) as pool,
+            asyncio.TaskGroup() as tg,
+        ):
+            tg.create_task(self.read_mqtt(), name="mqtt-reader")
+            tg.create_task(self.decode(), name="decoder")
+            tg.create_task(self.write(pool), name="writer")
+
+    async def read_mqtt(self) -> None:
+        """Consumes MQTT messages onto the raw queue, reconnecting on failure."""
+        settings = self.mqtt
+        if settings.v5:
+            protocol = aiomqtt.ProtocolVersion.V5
+            session = {
+                "clean_start": not settings.persistent,
+                "properties": settings.connect_properties(),
+            }
+        else:
+            protocol = aiomqtt.ProtocolVersion.V311
+            session = {"clean_session": not settings.persistent}
+        while True:
+            try:
+                async with aiomqtt.Client(
+                    hostname=settings.broker,
+                    port=settings.port,
+                    username=settings.user,
+                    password=settings.password,
+                    identifier=settings.client_id or None,
+                    protocol=protocol,
+                    keepalive=60,
+                    **session,
+                ) as client:
+                    for topic, qos in settings.subscriptions:
+                        self.logger.info("Subscribing to %s (QoS %d)", topic, qos)
+                        await client.subscribe(topic, qos=qos)
+                    async for message in client.messages:
+                        topic, payload = str(message.topic), bytes(message.payload)
+                        if self.capture is not None:
+                            self.capture.write(topic, payload)
+                        await self.raw_queue.put((topic, payload))
+            except aiomqtt.MqttError as e:
+                self.logger.warning("MQTT connection lost (%s); reconnecting in 5s", e)
+                await asyncio.sleep(5)
+
+    def decode_batch(self, messages: list[tuple[str, bytes]]) -> list[decoder.Rows]:
+        """Decodes a batch of raw messages (on the decode thread)."""
+        return [self.decoder.decode(topic, payload) for topic, payload in messages]
+
+    async def decode(self) -> None:
+        """Decodes raw messages into rows for the writer, off the event loop."""
+        loop = asyncio.get_running_loop()
+        next_stats = time.monotonic() + self.stats_interval
+        # one thread: PacketDecoder is not thread safe, and packets stay in order
+        with ThreadPoolExecutor(1, thread_name_prefix="mesh-persist-decode") as executor:
+            while True:
+                messages = [await self.raw_queue.get()]
+                while len(messages) < DECODE_BATCH and not self.raw_queue.empty():
+                    messages.append(self.raw_queue.get_nowait())
+                for rows in await loop.run_in_executor(executor, self.decode_batch, messages):
+                    await self.submit(rows)
+                if time.monotonic() >= next_stats:
+                    self.decoder.log_stats()
+                    self.log_stats()
+                    next_stats = time.monotonic() + self.stats_interval
+
+    async def submit(self, rows: decoder.Rows) -> None:
+        """Queues one packet's rows for the writer, after load shedding."""
+        if self.shedder is not None:
+            rows = self.shedder.admit(rows)
+        if not self.debug:
+            for row in rows:
+                await self.row_queue.put(row)
+
+    async def write(self, pool: AsyncConnectionPool) -> None:
+        """Flushes rows in batches by size or interval, one transaction per batch.
+
+        When cancelled (on shutdown), the batch being gathered and the rows still
+        queued are flushed once more before exiting.
+        """
+        pending: dict[str, list[tuple]] = {}
+        count = 0
+        try:
+            while True:
+                pending = {}
+                count = 0
+                deadline = time.monotonic() + self.flush_interval
+                while count < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        table, row = await asyncio.wait_for(self.row_queue.get(), timeout)
+                    except TimeoutError:
+                        break
+                    pending.setdefault(table, []).append(row)
+                    count += 1
+                if count:
+                    await self.flush(pool, pending, count)
+        except asyncio.CancelledError:
+            while not self.row_queue.empty():
+                table, row = self.row_queue.get_nowait()
+                pending.setdefault(table, []).append(row)
+                count += 1
+            if count:
+                self.logger.info("Flushing %d rows before exiting", count)
+                await self.flush(pool, pending, count, retry=False)
+            raise
+
+    async def flush(
+        self,
+        pool: AsyncConnectionPool,
+        pending: dict[str, list[tuple]],
+        count: int,
+        *,
+        retry: bool = True,
+    ) -> None:
+        """Writes one batch, retrying connection failures until it is accepted (with retry)."""
+        while True:
+            start = time.perf_counter()
+            try:
+                async with pool.connection() as conn:
+                    async with conn.transaction():
+                        for table, rows in pending.items():
+                            t0 = time.perf_counter()
+                            await self.insert(conn, table, db_functions.coalesce_rows(table, rows))
+                            if self.metrics is not None:
+                                self.metrics.insert_seconds.observe(time.perf_counter() - t0, table)
+                        t0 = time.perf_counter()
+                    if self.metrics is not None:
+                        self.metrics.commit_seconds.observe(time.perf_counter() - t0)
+            except (OSError, psycopg.OperationalError, PoolTimeout) as e:
+                self.stats.flush_errors += 1
+                if not retry:
+                    self.stats.rows_dropped += count
+                    self.logger.warning("Batch flush failed, dropping %d rows: %s", count, e)
+                    return
+                self.logger.warning("Batch flush failed, will retry: %s", e)
+                await asyncio.sleep(self.flush_interval)
+                continue
+            except Exception:
+                self.stats.flush_errors += 1
+                self.stats.rows_dropped += count
+                self.logger.exception("Dropping batch of %d rows", count)
+                return
+            self.stats.record_flush(count, time.perf_counter() - start)
+            return
+
+    @staticmethod
+    async def insert(conn: psycopg.AsyncConnection, table: str, rows: list[tuple]) -> None:
+        """Inserts rows into table, in as many statements as the parameter limit needs."""
+        per_statement = MAX_PARAMS // len(rows[0])
+        for i in range(0, len(rows), per_statement):
+            chunk = rows[i : i + per_statement]
+            await conn.execute(
+                db_functions.batch_sql(table, len(chunk)), [value for row in chunk for value in row]
+            )
+
+    def log_stats(self) -> None:
+        """Logs the queue depths and writer counters."""
+        s = self.stats
+        self.logger.info(
+            "async: raw_queue=%d row_queue=%d written=%d dropped=%d flushes=%d errors=%d "
+            "flush_ms avg=%.1f max=%.1f",
+            self.raw_queue.qsize(),
+            self.row_queue.qsize(),
+            s.rows_written,
+            s.rows_dropped,
+            s.flushes,
+            s.flush_errors,
+            s.avg_flush_seconds * 1000,
+            s.max_flush_seconds * 1000,
+        )
+        if self.shedder is not None:
+            self.shedder.log_stats()
+
+
+def run(  # noqa: PLR0913
+    mqtt_settings: mqtt_session.MqttSettings,
+    pg_config: dict,
+    writer_config: dict,
+    packet_decoder: decoder.PacketDecoder,
+    logger: logging.Logger,
+    *,
+    debug: bool = False,
+    capture_writer: capture.CaptureWriter | None = None,
+    backpressure_config: dict | None = None,
+) -> None:
+    """Runs the asyncio engine until interrupted."""
+    engine = AsyncEngine(
+        mqtt_settings,
+        pg_config,
+        writer_config,
+        packet_decoder,
+        logger,
+        debug=debug,
+        capture_writer=capture_writer,
+        backpressure_config=backpressure_config,
+    )
+    with contextlib.suppress(asyncio.CancelledError):
+        asyncio.run(engine.run())
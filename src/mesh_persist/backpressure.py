@@ -0,0 +1,219 @@
+"""Priority-aware load shedding in front of the write queue.
+
+The write queue is bounded, and once it is full every row waits on it and is
+then dropped, whatever it holds.  With [backpressure] enabled, each decoded
+row is given the priority of its traffic class before it is queued: the
+portnum of its packet, or "receptions" for the mesh_packets rows of repeat
+receptions (records.RepeatReception), which only add another gateway's view of
+a packet already written.
+As the queue fills past the watermarks, low priority rows are first sampled
+and then dropped, then normal priority rows are dropped, so that the space
+left goes to the high priority traffic.  Each level is left again once the
+queue has drained below its watermark by the hysteresis margin.
+"""
+
+# pylint: disable=R0902
+
+import logging
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass, field
+
+from . import metrics, records
+from .config_load import TRUTHY
+
+HIGH = 2
+NORMAL = 1
+LOW = 0
+
+PRIORITY_NAMES = {"high": HIGH, "normal": NORMAL, "low": LOW}
+
+# The traffic class of the mesh_packets rows of repeat receptions.
+RECEPTIONS = "receptions"
+
+# Portnum whose payload each table stores.
+TABLE_PORTNUMS = {
+    "node_infos": "NODEINFO_APP",
+    "node_positions": "POSITION_APP",
+    "neighbor_info": "NEIGHBORINFO_APP",
+    "text_messages": "TEXT_MESSAGE_APP",
+    "device_metrics": "TELEMETRY_APP",
+    "environment_metrics": "TELEMETRY_APP",
+    "power_metrics": "TELEMETRY_APP",
+    "air_quality_metrics": "TELEMETRY_APP",
+    "local_stats": "TELEMETRY_APP",
+}
+
+DEFAULT_PRIORITIES = {
+    "TEXT_MESSAGE_APP": HIGH,
+    "NODEINFO_APP": HIGH,
+    "POSITION_APP": LOW,
+    RECEPTIONS: LOW,
+}
+
+# Shedding levels, from none to the most aggressive.
+ADMIT_ALL = 0
+SAMPLE_LOW = 1
+DROP_LOW = 2
+DROP_NORMAL = 3
+
+_LEVEL_NAMES = ("admit all", "sample low", "drop low", "drop normal")
+
+
+@dataclass
+class ShedStats:
+    """Counters kept by the load shedder."""
+
+    admitted: int = 0
+    shed: Counter = field(default_factory=Counter)  # rows shed, by traffic class
+    level_changes: int = 0
+
+
+class LoadShedder:
+    """Decides, row by row, what to queue for writing given how full the queue is."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        fill: Callable[[], float],
+        logger: logging.Logger,
+        *,
+        priorities: dict[str, int] | None = None,
+        sample_watermark: float = 0.5,
+        low_watermark: float = 0.7,
+        normal_watermark: float = 0.85,
+        hysteresis: float = 0.1,
+        sample_every: int = 10,
+        pipeline_metrics: metrics.PipelineMetrics | None = None,
+    ) -> None:
+        """Initialization function for LoadShedder.
+
+        Args:
+            fill: returns how full the write queue is, from 0.0 to 1.0.
+            logger: logger for level changes.
+            priorities: traffic class (portnum name or "receptions") -> HIGH,
+                NORMAL or LOW; unlisted classes are NORMAL.
+            sample_watermark: fill at which only one in sample_every low priority
+                rows is kept.
+            low_watermark: fill at which low priority rows are all dropped.
+            normal_watermark: fill at which normal priority rows are dropped too.
+            hysteresis: how far below a watermark the fill must fall to leave its level.
+            sample_every: keep one in this many low priority rows while sampling.
+            pipeline_metrics: if given, shed rows are counted there too.
+        """
+        self.fill = fill
+        self.logger = logger
+        self.priorities = DEFAULT_PRIORITIES if priorities is None else priorities
+        self.watermarks = (sample_watermark, low_watermark, normal_watermark)
+        self.hysteresis = hysteresis
+        self.sample_every = max(sample_every, 1)
+        self.level = ADMIT_ALL
+        self.stats = ShedStats()
+        self.metrics = pipeline_metrics
+        self._sampled = 0
+        if pipeline_metrics is not None:
+            pipeline_metrics.add_gauge(
+                "mesh_persist_shed_level",
+                "Load shedding level: 0 admit all, 1 sample low, 2 drop low, 3 drop normal.",
+                lambda: self.level,
+            )
+
+    @classmethod
+    def from_config(
+        cls,
+        fill: Callable[[], float],
+        logger: logging.Logger,
+        config: dict,
+        pipeline_metrics: metrics.PipelineMetrics | None = None,
+    ) -> "LoadShedder | None":
+        """Builds a LoadShedder from the [backpressure] section, or None if disabled.
+
+        The high, normal and low keys each list traffic classes, comma separated;
+        they replace the default priorities for the classes they name.
+        """
+        if config.get("enabled", "false").lower() not in TRUTHY:
+            return None
+        priorities = dict(DEFAULT_PRIORITIES)
+        for name, priority in PRIORITY_NAMES.items():
+            for traffic in config.get(name, "").split(","):
+                if traffic.strip():
+                    priorities[traffic.strip()] = priority
+        return cls(
+            fill,
+            logger,
+            priorities=priorities,
+            sample_watermark=float(config.get("sample_watermark", 0.5)),
+            low_watermark=float(config.get("low_watermark", 0.7)),
+            normal_watermark=float(config.get("normal_watermark", 0.85)),
+            hysteresis=float(config.get("hysteresis", 0.1)),
+            sample_every=int(config.get("sample_every", 10)),
+            pipeline_metrics=pipeline_metrics,
+        )
+
+    def _update_level(self) -> None:
+        fill = self.fill()
+        level = self.level
+        while level < DROP_NORMAL and fill >= self.watermarks[level]:
+            level += 1
+        while level > ADMIT_ALL and fill < self.watermarks[level - 1] - self.hysteresis:
+            level -= 1
+        if level != self.level:
+            log = self.logger.warning if level > self.level else self.logger.info
+            log(
+                "Write queue %.0f%% full: load shedding now '%s' (was '%s')",
+                fill * 100,
+                _LEVEL_NAMES[level],
+                _LEVEL_NAMES[self.level],
+            )
+            self.level = level
+            self.stats.level_changes += 1
+            if level == ADMIT_ALL:
+                self.log_stats()
+
+    @staticmethod
+    def traffic_class(table: str, row: tuple) -> str:
+        """The traffic class whose priority applies to a row.
+
+        A packet's first mesh_packets row has the priority of its portnum.
+        """
+        if isinstance(row, records.MeshPacketRow):
+            return RECEPTIONS if isinstance(row, records.RepeatReception) else row.portnum
+        return TABLE_PORTNUMS.get(table, table)
+
+    def admit(self, rows: list[tuple[str, tuple]]) -> list[tuple[str, tuple]]:
+        """Returns the rows of one decoded packet that should be queued."""
+        self._update_level()
+        if self.level == ADMIT_ALL:
+            self.stats.admitted += len(rows)
+            return rows
+        kept = []
+        for table, row in rows:
+            traffic = self.traffic_class(table, row)
+            priority = self.priorities.get(traffic, NORMAL)
+            if self._keep(priority):
+                kept.append((table, row))
+            else:
+                self.stats.shed[traffic] += 1
+                if self.metrics is not None:
+                    self.metrics.shed.inc(traffic)
+        self.stats.admitted += len(kept)
+        return kept
+
+    def _keep(self, priority: int) -> bool:
+        if priority == HIGH:
+            return True
+        if priority == NORMAL:
+            return self.level < DROP_NORMAL
+        if self.level == SAMPLE_LOW:
+            self._sampled += 1
+            return self._sampled % self.sample_every == 0
+        return False
+
+    def log_stats(self) -> None:
+        """Logs the shedding level and the rows shed per traffic class."""
+        shed = ", ".join(f"{k}={v}" for k, v in self.stats.shed.most_common()) or "none"
+        self.logger.info(
+            "backpressure: level='%s' admitted=%d shed: %s",
+            _LEVEL_NAMES[self.level],
+            self.stats.admitted,
+            shed,
+        )
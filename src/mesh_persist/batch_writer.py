@@ -0,0 +1,307 @@
+"""Write-behind batch writer.
+
+This module decouples the MQTT network thread from the database.  Decoded rows
+are placed on a bounded queue by on_message, and a dedicated writer thread
+drains that queue and flushes the rows to PostgreSQL in batches, one commit
+per batch.
+"""
+
+# pylint: disable=R0902
+# pylint: disable=R0913
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+
+import psycopg2
+
+from . import db_functions
+from .config_load import TRUTHY
+
+
+@dataclass
+class WriterStats:
+    """Counters kept by the batch writer."""
+
+    rows_submitted: int = 0
+    rows_dropped: int = 0
+    rows_written: int = 0
+    rows_merged: int = 0
+    rows_duplicate: int = 0
+    flushes: int = 0
+    flush_errors: int = 0
+    last_flush_seconds: float = 0.0
+    max_flush_seconds: float = 0.0
+    total_flush_seconds: float = 0.0
+
+    def record_flush(self, rows: int, elapsed: float) -> None:
+        """Accounts for one successful flush of `rows` rows taking `elapsed` seconds."""
+        self.rows_written += rows
+        self.flushes += 1
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        self.total_flush_seconds += elapsed
+
+    def record_merge(self, merged: dict[str, tuple[int, int]]) -> None:
+        """Accounts for the inserted/duplicate counts reported by a COPY merge."""
+        for inserted, duplicates in merged.values():
+            self.rows_merged += inserted
+            self.rows_duplicate += duplicates
+
+    @property
+    def avg_flush_seconds(self) -> float:
+        """Mean flush latency over the life of the writer."""
+        return self.total_flush_seconds / self.flushes if self.flushes else 0.0
+
+
+class BatchWriter(threading.Thread):
+    """Background thread that flushes queued rows to the database in batches."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        db: db_functions.DbFunctions,
+        logger: logging.Logger,
+        *,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        queue_size: int = 10000,
+        submit_timeout: float = 1.0,
+        stats_interval: float = 60.0,
+        bulk_copy: bool = False,
+    ) -> None:
+        """Initialization function for BatchWriter.
+
+        Args:
+            db: database functions used to write the batches.
+            logger: logger for status and error messages.
+            batch_size: flush as soon as this many rows are pending.
+            flush_interval: flush at least this often (seconds) when rows are pending.
+            queue_size: maximum number of rows waiting on the queue.
+            submit_timeout: how long submit() blocks on a full queue before dropping.
+            stats_interval: how often (seconds) to log the writer counters.
+            bulk_copy: load mesh_packets, device_metrics and text_messages with COPY
+                and a staging-table merge instead of multi-row INSERTs.
+        """
+        super().__init__(name="mesh-persist-writer", daemon=True)
+        self.db = db
+        self.logger = logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.submit_timeout = submit_timeout
+        self.stats_interval = stats_interval
+        self.bulk_copy = bulk_copy
+        self.queue: queue.Queue[tuple[str, tuple]] = queue.Queue(maxsize=queue_size)
+        self.stats = WriterStats()
+        self.healthy = True
+        self.rows_flushed = 0
+        self._flushed = threading.Condition()
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def from_config(
+        cls, db: db_functions.DbFunctions, logger: logging.Logger, config: dict
+    ) -> "BatchWriter":
+        """Builds a BatchWriter from the [writer] section of mesh_persist.ini."""
+        return cls(
+            db,
+            logger,
+            batch_size=int(config.get("batch_size", 500)),
+            flush_interval=float(config.get("flush_interval", 1.0)),
+            queue_size=int(config.get("queue_size", 10000)),
+            submit_timeout=float(config.get("submit_timeout", 1.0)),
+            stats_interval=float(config.get("stats_interval", 60.0)),
+            bulk_copy=config.get("bulk_copy", "false").lower() in TRUTHY,
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of rows waiting to be flushed."""
+        return self.queue.qsize()
+
+    @property
+    def fill(self) -> float:
+        """How full the queue is, from 0.0 to 1.0."""
+        return self.queue.qsize() / self.queue.maxsize
+
+    def has_room(self, fraction: float = 1.0) -> bool:
+        """True if the queue is filled to less than `fraction` of its capacity."""
+        return self.queue.qsize() < self.queue.maxsize * fraction
+
+    def wait_flushed(self, target: int, timeout: float | None = None) -> bool:
+        """Waits until the first `target` submitted rows have left the writer.
+
+        Compare against stats.rows_submitted taken after submitting.  Rows that
+        were dropped as bad count as having left.
+        """
+        with self._flushed:
+            return self._flushed.wait_for(lambda: self.rows_flushed >= target, timeout)
+
+    def submit(self, table: str, row: tuple, *, block: bool = False) -> bool:
+        """Queues a row for `table`.  Returns False if the row had to be dropped.
+
+        With block, waits for room however long it takes instead of dropping the
+        row after submit_timeout (for spool replay, whose rows must not be lost).
+        """
+        try:
+            if block:
+                self.queue.put((table, row))
+            else:
+                self.queue.put((table, row), timeout=self.submit_timeout)
+        except queue.Full:
+            self.stats.rows_dropped += 1
+            self.logger.warning("Write queue full, dropping %s row", table)
+            return False
+        self.stats.rows_submitted += 1
+        return True
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Signals the writer to flush what it has and exit, then waits for it."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self) -> None:
+        """Writer loop: gather rows until the batch is full or the interval expires."""
+        pending: dict[str, list[tuple]] = {}
+        count = 0
+        taken = 0
+        deadline = time.monotonic() + self.flush_interval
+        next_stats = time.monotonic() + self.stats_interval
+        while not (self._stop_event.is_set() and self.queue.empty()):
+            try:
+                table, row = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                pending.setdefault(table, []).append(row)
+                count += 1
+                taken += 1
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            if count >= self.batch_size or now >= deadline:
+                if not count and not self.healthy:
+                    self._probe()
+                if count and not self._flush_with_retry(pending):
+                    return
+                if count:
+                    with self._flushed:
+                        self.rows_flushed = taken
+                        self._flushed.notify_all()
+                pending = {}
+                count = 0
+                deadline = now + self.flush_interval
+            if now >= next_stats:
+                self.log_stats()
+                next_stats = now + self.stats_interval
+        if count:
+            self._flush(pending)
+        self.log_stats()
+
+    def _flush_with_retry(self, pending: dict[str, list[tuple]]) -> bool:
+        """Flushes a batch, holding it (and the queue) until the DB accepts it.
+
+        Returns False if the writer was stopped while the batch was still unwritten.
+        """
+        while not self._flush(pending):
+            if self._stop_event.wait(self.flush_interval):
+                unflushed = sum(map(len, pending.values()))
+                self.logger.warning("Writer stopped with %d unflushed rows", unflushed)
+                return False
+        return True
+
+    def _probe(self) -> None:
+        """Tries to reconnect while idle, so health is regained without traffic."""
+        try:
+            self.db.pool.session()
+        except psycopg2.OperationalError:
+            return
+        self.healthy = True
+
+    def _flush(self, pending: dict[str, list[tuple]]) -> bool:
+        """Writes one batch.  Returns False if it should be retried later.
+
+        A batch the database rejects is written again table by table, and a
+        table that still fails is split in halves until only the offending rows
+        are left to drop.  Rows that got written are taken out of `pending`, so
+        a retry after a lost connection does not write them twice.
+        """
+        count = sum(map(len, pending.values()))
+        start = time.perf_counter()
+        try:
+            merged = self.db.write_batches(pending, bulk_copy=self.bulk_copy)
+        except psycopg2.OperationalError as e:
+            self.healthy = False
+            self.stats.flush_errors += 1
+            err = f"Batch flush failed, will retry: {db_functions.format_db_error(e)}"
+            self.logger.warning(err)
+            return False
+        except Exception as e:  # noqa: BLE001  anything else must not kill the writer
+            self.stats.flush_errors += 1
+            self.logger.warning(
+                "Batch of %d rows failed, retrying in parts: %s",
+                count,
+                db_functions.format_db_error(e),
+            )
+            return self._isolate(pending)
+        self.healthy = True
+        self.stats.record_flush(count, time.perf_counter() - start)
+        self.stats.record_merge(merged)
+        return True
+
+    def _isolate(self, pending: dict[str, list[tuple]]) -> bool:
+        """Writes a rejected batch in ever smaller parts, dropping only the rows that fail.
+
+        Returns False if the connection was lost part way; what is left unwritten
+        stays in `pending` for the retry.
+        """
+        for table in list(pending):
+            parts = deque([pending[table]])
+            while parts:
+                rows = parts[0]
+                start = time.perf_counter()
+                try:
+                    merged = self.db.write_batches({table: rows}, bulk_copy=self.bulk_copy)
+                except psycopg2.OperationalError as e:
+                    self.healthy = False
+                    pending[table] = [row for part in parts for row in part]
+                    err = f"Batch flush failed, will retry: {db_functions.format_db_error(e)}"
+                    self.logger.warning(err)
+                    return False
+                except Exception as e:  # noqa: BLE001
+                    parts.popleft()
+                    if len(rows) > 1:
+                        half = len(rows) // 2
+                        parts.extendleft((rows[half:], rows[:half]))
+                        continue
+                    self.stats.rows_dropped += 1
+                    err = f"Dropping {table} row {rows[0]!r}: {db_functions.format_db_error(e)}"
+                    self.logger.error(err)  # noqa: TRY400
+                    continue
+                parts.popleft()
+                self.stats.record_flush(len(rows), time.perf_counter() - start)
+                self.stats.record_merge(merged)
+            del pending[table]
+        self.healthy = True
+        return True
+
+    def log_stats(self) -> None:
+        """Logs the current writer counters."""
+        s = self.stats
+        self.logger.info(
+            "writer: queue=%d submitted=%d written=%d dropped=%d flushes=%d errors=%d "
+            "flush_ms last=%.1f avg=%.1f max=%.1f",
+            self.queue_depth,
+            s.rows_submitted,
+            s.rows_written,
+            s.rows_dropped,
+            s.flushes,
+            s.flush_errors,
+            s.last_flush_seconds * 1000,
+            s.avg_flush_seconds * 1000,
+            s.max_flush_seconds * 1000,
+        )
+        if self.bulk_copy:
+            self.logger.info(
+                "writer: bulk copy merged=%d duplicates=%d", s.rows_merged, s.rows_duplicate
+            )
@@ -0,0 +1,73 @@
+"""Capture and replay of MQTT traffic.
+
+A capture file is a short magic header followed by the same length-prefixed
+(timestamp, topic, payload) records the spool uses.  Captures are written
+from on_message during a live run (--capture) and fed back through the same
+decode and persist path with no broker at all (--replay), either as fast as
+possible or at a scaled real-time rate.
+"""
+
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+from .spool import encode_record, iter_records
+
+MAGIC = b"MPCAP\x00\x01\n"
+
+
+class CaptureWriter:
+    """Appends received MQTT messages to a capture file."""
+
+    def __init__(self, path: str) -> None:
+        """Initialization function for CaptureWriter; creates or truncates path."""
+        self.path = Path(path)
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = self.path.open("wb")
+        self._file.write(MAGIC)
+
+    def write(self, topic: str, payload: bytes, timestamp: float | None = None) -> None:
+        """Records one message, stamped with the current time unless given."""
+        record = encode_record(time.time() if timestamp is None else timestamp, topic, payload)
+        with self._lock:
+            self._file.write(record)
+            self.count += 1
+
+    def close(self) -> None:
+        """Flushes and closes the capture file."""
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path: str) -> Iterator[tuple[float, str, bytes]]:
+    """Yields (timestamp, topic, payload) from a capture file."""
+    with Path(path).open("rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            msg = f"{path} is not a mesh_persist capture file"
+            raise ValueError(msg)
+        for timestamp, topic, payload, _ in iter_records(f):
+            yield timestamp, topic, payload
+
+
+def paced(
+    records: Iterator[tuple[float, str, bytes]], rate: float
+) -> Iterator[tuple[float, str, bytes]]:
+    """Re-times records to their original spacing divided by rate.
+
+    A rate of 0 (or less) yields records as fast as they can be consumed; 1.0
+    reproduces the captured timing, 10.0 plays it back ten times faster.
+    """
+    if rate <= 0:
+        yield from records
+        return
+    start_wall = time.monotonic()
+    start_ts: float | None = None
+    for record in records:
+        if start_ts is None:
+            start_ts = record[0]
+        delay = (record[0] - start_ts) / rate - (time.monotonic() - start_wall)
+        if delay > 0:
+            time.sleep(delay)
+        yield record
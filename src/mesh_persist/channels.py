@@ -0,0 +1,246 @@
+"""Channel key registry.
+
+Every encrypted packet carries the hash of the channel it was sent on: the
+XOR of the bytes of the channel name and of its expanded PSK.  The registry
+holds one ChannelKey per configured channel, indexed by that hash, so the
+key for a packet is found with one dict lookup, and a packet on a channel we
+have no key for is dropped before anything is decrypted or parsed.
+
+Each ChannelKey keeps an AES-ECB cipher with its key schedule already set
+up, and decrypts by encrypting the CTR counter blocks of a packet in one
+call, instead of building a new CTR cipher per packet.
+
+Channels that keep failing to decrypt (same name and hash, but a different
+PSK) and channels with no key are put in a negative cache for negative_ttl
+seconds, and logged once, rather than once per packet.
+"""
+
+import base64
+import logging
+import time
+from collections import Counter
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+from Crypto.Cipher import AES
+
+from .config_load import TRUTHY
+
+# The well-known default PSK ("AQ==" in the apps), used by the preset channels.
+DEFAULT_KEY = bytes(
+    [
+        0xD4,
+        0xF1,
+        0xBB,
+        0x3A,
+        0x20,
+        0x29,
+        0x07,
+        0x59,
+        0xF0,
+        0xBC,
+        0xFF,
+        0xAB,
+        0xCF,
+        0x4E,
+        0x69,
+        0x01,
+    ]
+)
+
+# Channel names of the modem presets, which all use the default PSK.
+PRESET_CHANNELS = (
+    "ShortTurbo",
+    "ShortFast",
+    "ShortSlow",
+    "MediumFast",
+    "MediumSlow",
+    "LongFast",
+    "LongModerate",
+    "LongSlow",
+    "LongTurbo",
+    "VeryLongSlow",
+)
+
+_BLOCK = 16
+
+
+def expand_psk(psk: bytes) -> bytes | None:
+    """Expands a channel PSK the way the firmware does.
+
+    An empty PSK, or the single byte 0, means no encryption (None).  A single
+    byte n selects the default key with n - 1 added to its last byte.  16 and
+    32 byte PSKs are AES-128 and AES-256 keys and are used as they are.
+
+    Raises:
+        ValueError: the PSK has some other length.
+    """
+    if len(psk) == 0 or psk == b"\x00":
+        return None
+    if len(psk) == 1:
+        return DEFAULT_KEY[:-1] + bytes([(DEFAULT_KEY[-1] + psk[0] - 1) & 0xFF])
+    if len(psk) not in (16, 32):
+        msg = f"PSK must be 1, 16 or 32 bytes, not {len(psk)}"
+        raise ValueError(msg)
+    return psk
+
+
+def channel_hash(name: str, key: bytes) -> int:
+    """The channel hash carried by packets sent on channel name with key."""
+    h = 0
+    for b in name.encode("utf-8"):
+        h ^= b
+    for b in key:
+        h ^= b
+    return h
+
+
+class ChannelKey:
+    """One channel's name, expanded key and ready-to-use cipher."""
+
+    __slots__ = ("_ecb", "hash", "key", "name")
+
+    def __init__(self, name: str, key: bytes) -> None:
+        """Initialization function for ChannelKey."""
+        self.name = name
+        self.key = key
+        self.hash = channel_hash(name, key)
+        self._ecb = AES.new(key, AES.MODE_ECB)
+
+    def decrypt(self, packet_id: int, source: int, encrypted: bytes) -> bytes:
+        """Decrypts a packet payload (AES-CTR, nonce = packet id and source node)."""
+        prefix = packet_id.to_bytes(8, "little") + source.to_bytes(4, "little")
+        blocks = (len(encrypted) + _BLOCK - 1) // _BLOCK
+        counters = b"".join(prefix + i.to_bytes(4, "big") for i in range(blocks))
+        stream = self._ecb.encrypt(counters)
+        size = len(encrypted)
+        return (
+            int.from_bytes(encrypted, "little") ^ int.from_bytes(stream[:size], "little")
+        ).to_bytes(size, "little")
+
+
+@dataclass
+class ChannelStats:
+    """Counters kept by the channel key registry."""
+
+    unknown: int = 0  # packets on a channel with no key
+    suppressed: int = 0  # packets dropped by the negative cache
+    failures: int = 0  # packets that didn't decrypt to a valid Data message
+
+
+class ChannelKeys:
+    """Channel keys indexed by channel hash, with a negative cache."""
+
+    def __init__(
+        self,
+        keys: Iterable[ChannelKey],
+        logger: logging.Logger | None = None,
+        *,
+        negative_ttl: float = 300.0,
+        failure_threshold: int = 5,
+    ) -> None:
+        """Initialization function for ChannelKeys.
+
+        Args:
+            keys: the channels to decrypt.
+            logger: logger for channels entering the negative cache.
+            negative_ttl: seconds a channel without a working key is skipped.
+            failure_threshold: decrypt failures in a row (with no success in
+                between) after which a channel is skipped.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.negative_ttl = negative_ttl
+        self.failure_threshold = failure_threshold
+        self.stats = ChannelStats()
+        self._by_hash: dict[int, list[ChannelKey]] = {}
+        for channel in keys:
+            self._by_hash.setdefault(channel.hash, []).append(channel)
+        self._negative: dict[tuple[int, str], float] = {}
+        self._failures: Counter[tuple[int, str]] = Counter()
+
+    @classmethod
+    def default(cls, logger: logging.Logger | None = None) -> "ChannelKeys":
+        """A registry of the preset channels, with the default key."""
+        return cls((ChannelKey(name, DEFAULT_KEY) for name in PRESET_CHANNELS), logger)
+
+    @classmethod
+    def from_config(cls, config: dict, logger: logging.Logger | None = None) -> "ChannelKeys":
+        """Builds the registry from the [channels] section of mesh_persist.ini.
+
+        keys lists name:base64-PSK pairs, comma separated; the preset channels
+        are included unless presets is off.
+
+        Raises:
+            ValueError: a keys entry is malformed or its PSK has the wrong length.
+        """
+        keys: list[ChannelKey] = []
+        if config.get("presets", "true").lower() in TRUTHY:
+            keys.extend(ChannelKey(name, DEFAULT_KEY) for name in PRESET_CHANNELS)
+        for entry in config.get("keys", "").split(","):
+            if not entry.strip():
+                continue
+            name, sep, psk = entry.strip().partition(":")
+            if not sep or not name:
+                msg = f"Invalid [channels] keys entry {entry.strip()!r}: expected name:psk"
+                raise ValueError(msg)
+            key = expand_psk(base64.b64decode(psk))
+            if key is not None:
+                keys.append(ChannelKey(name, key))
+        return cls(
+            keys,
+            logger,
+            negative_ttl=float(config.get("negative_ttl", 300.0)),
+            failure_threshold=int(config.get("failure_threshold", 5)),
+        )
+
+    def __len__(self) -> int:
+        """Number of channels with a key."""
+        return sum(len(channels) for channels in self._by_hash.values())
+
+    def lookup(self, chash: int, channel_id: str) -> ChannelKey | None:
+        """The key for a packet's channel hash (and, on a hash collision, name).
+
+        Returns:
+            None if there is no key for the channel, or it is in the negative cache.
+        """
+        if self._negative:
+            until = self._negative.get((chash, channel_id))
+            if until is not None:
+                if time.monotonic() < until:
+                    self.stats.suppressed += 1
+                    return None
+                del self._negative[chash, channel_id]
+        channels = self._by_hash.get(chash)
+        if channels is None:
+            self.stats.unknown += 1
+            self._suppress(chash, channel_id, "no key for it")
+            return None
+        if len(channels) > 1:
+            for channel in channels:
+                if channel.name == channel_id:
+                    return channel
+        return channels[0]
+
+    def failed(self, chash: int, channel_id: str) -> None:
+        """Records that a packet on the channel didn't decrypt to a valid message."""
+        self.stats.failures += 1
+        key = (chash, channel_id)
+        self._failures[key] += 1
+        if self._failures[key] >= self.failure_threshold:
+            del self._failures[key]
+            self._suppress(chash, channel_id, f"{self.failure_threshold} decrypt failures")
+
+    def decoded(self, chash: int, channel_id: str) -> None:
+        """Records that a packet on the channel decrypted, resetting its failures."""
+        if self._failures:
+            self._failures.pop((chash, channel_id), None)
+
+    def _suppress(self, chash: int, channel_id: str, reason: str) -> None:
+        self._negative[chash, channel_id] = time.monotonic() + self.negative_ttl
+        self.logger.warning(
+            "Skipping channel %s (hash %d) for %.0fs: %s",
+            channel_id or "?",
+            chash,
+            self.negative_ttl,
+            reason,
+        )
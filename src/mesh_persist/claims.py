@@ -0,0 +1,131 @@
+"""Cross-instance packet claims.
+
+When several instances share one subscription, the broker spreads the
+receptions of a packet over all of them, so each instance's dedup cache sees
+only part of them, and more than one instance may decode the same packet.
+Upserted tables (nodeinfo, positions, neighbor info) don't mind, but text
+messages and telemetry would be written more than once.  With [dedup]
+shared=true, DbFunctions.write_batches first claims the (source, packet_id) of
+every such row in packet_claims, in the same transaction and with one
+statement per batch, and only writes the rows whose claim it won.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+
+from psycopg2 import extras
+
+from .config_load import TRUTHY
+
+# Per claimed table: row positions of the source node and the packet id.
+# local_stats has no packet_id column and is written unclaimed.
+CLAIMED_TABLES = {
+    "text_messages": (0, 2),
+    "device_metrics": (0, 1),
+    "environment_metrics": (0, 1),
+    "power_metrics": (0, 1),
+    "air_quality_metrics": (0, 1),
+}
+
+CLAIM_SQL = (
+    """INSERT INTO packet_claims (source, packet_id)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING source, packet_id""",
+    "(%s, %s)",
+)
+
+PRUNE_SQL = "DELETE FROM packet_claims WHERE claimed_at < now() - make_interval(secs => %s)"
+
+
+@dataclass
+class ClaimStats:
+    """Counters kept by the packet claims."""
+
+    won: int = 0
+    lost: int = 0
+    pruned: int = 0
+
+
+class PacketClaims:
+    """Claims packets in packet_claims so only one instance writes their rows."""
+
+    def __init__(
+        self, logger: logging.Logger, *, ttl: float = 600.0, prune_interval: float = 60.0
+    ) -> None:
+        """Initialization function for PacketClaims.
+
+        Args:
+            logger: logger for the prune summary.
+            ttl: seconds a claim is kept; match the [dedup] ttl.
+            prune_interval: seconds between deletions of expired claims.
+        """
+        self.logger = logger
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self.stats = ClaimStats()
+        self._next_prune = time.monotonic() + prune_interval
+
+    @classmethod
+    def from_config(cls, logger: logging.Logger, config: dict) -> "PacketClaims | None":
+        """Builds PacketClaims from the [dedup] section, or None unless shared is on."""
+        if config.get("shared", "false").lower() not in TRUTHY:
+            return None
+        return cls(
+            logger,
+            ttl=float(config.get("ttl", 600.0)),
+            prune_interval=float(config.get("prune_interval", 60.0)),
+        )
+
+    def resolve(self, cur, batches: dict[str, list[tuple]]) -> dict[str, list[tuple]]:
+        """Claims the batches' packets and drops the rows of packets claimed elsewhere.
+
+        Runs inside the caller's transaction, so a rolled back batch releases
+        its claims.  Keys are claimed in sorted order, so concurrent instances
+        lock them in the same order and can't deadlock each other.
+        """
+        if time.monotonic() >= self._next_prune:
+            self._next_prune = time.monotonic() + self.prune_interval
+            cur.execute(PRUNE_SQL, (self.ttl,))
+            self.stats.pruned += max(cur.rowcount, 0)
+            self.logger.info(
+                "packet claims: won=%d lost=%d pruned=%d",
+                self.stats.won,
+                self.stats.lost,
+                self.stats.pruned,
+            )
+        keys = {
+            (row[src], row[pkt])
+            for table, (src, pkt) in CLAIMED_TABLES.items()
+            for row in batches.get(table, ())
+        }
+        if not keys:
+            return batches
+        sql, template = CLAIM_SQL
+        won = set(
+            map(
+                tuple,
+                extras.execute_values(
+                    cur, sql, sorted(keys), template=template, page_size=1000, fetch=True
+                ),
+            )
+        )
+        self.stats.won += len(won)
+        self.stats.lost += len(keys) - len(won)
+        resolved = {}
+        for table, rows in batches.items():
+            positions = CLAIMED_TABLES.get(table)
+            if positions is None:
+                resolved[table] = rows
+                continue
+            src, pkt = positions
+            written = set()
+            kept = []
+            for row in rows:
+                key = (row[src], row[pkt])
+                if key in won and key not in written:
+                    written.add(key)
+                    kept.append(row)
+            resolved[table] = kept
+        return resolved
@@ -1,24 +1,86 @@
 """Config Functions.
 
-This module contains the config file loading functions
+This module contains the config file loading functions.  Each config file is
+read and parsed once per process, however many components ask for a section.
 """
 
+import functools
+import re
+import socket
 import sys
 from configparser import ConfigParser
 
+_INSTANCE_ID_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
 
-def load_config(filename: str, section: str) -> dict:
-    """Reads configfile configuration for mesh_persist components."""
+TRUTHY = ("1", "true", "yes", "on")
+
+
+class Config:
+    """A parsed config file, with typed access to its settings."""
+
+    def __init__(self, parser: ConfigParser) -> None:
+        """Initialization function for Config."""
+        self._parser = parser
+
+    def section(self, name: str, *, required: bool = False) -> dict[str, str]:
+        """The settings of section name, as a dict.
+
+        A missing optional section is an empty dict, so callers can fall back to
+        their defaults; a missing required one exits.
+        """
+        if self._parser.has_section(name):
+            return dict(self._parser.items(name))
+        if required:
+            sys.exit(1)
+        return {}
+
+    def get_str(self, section: str, key: str, default: str = "") -> str:
+        """A string setting, or default if it (or its section) is absent."""
+        return self._parser.get(section, key, fallback=default)
+
+    def get_int(self, section: str, key: str, default: int = 0) -> int:
+        """An integer setting, or default if it (or its section) is absent."""
+        return self._parser.getint(section, key, fallback=default)
+
+    def get_float(self, section: str, key: str, default: float = 0.0) -> float:
+        """A float setting, or default if it (or its section) is absent."""
+        return self._parser.getfloat(section, key, fallback=default)
+
+    def get_bool(self, section: str, key: str, *, default: bool = False) -> bool:
+        """A boolean setting (1/true/yes/on), or default if it (or its section) is absent."""
+        value = self._parser.get(section, key, fallback=None)
+        return default if value is None else value.lower() in TRUTHY
+
+    def enabled(self, section: str) -> bool:
+        """Whether an optional feature's section sets enabled."""
+        return self.get_bool(section, "enabled")
+
+
+@functools.cache
+def read_config(filename: str = "mesh_persist.ini") -> Config:
+    """Reads and parses filename, the first time it is asked for."""
     parser = ConfigParser()
     parser.read(filename)
+    return Config(parser)
+
+
+def load_config(filename: str, section: str, *, required: bool = True) -> dict:
+    """Reads configfile configuration for mesh_persist components.
+
+    Optional sections (required=False) return an empty dict when they are absent,
+    so callers can fall back to their defaults.
+    """
+    return read_config(filename).section(section, required=required)
+
 
-    # get section
-    config = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            config[param[0]] = param[1]
-    else:
-        sys.exit(1)
+def instance_id(persist_config: dict) -> str:
+    """This instance's id: [persist] instance_id, else the short host name.
 
-    return config
+    Raises:
+        ValueError: the id contains characters other than letters, digits, _ . and -.
+    """
+    value = persist_config.get("instance_id") or socket.gethostname().split(".")[0]
+    if not _INSTANCE_ID_RE.match(value):
+        msg = f"Invalid instance_id {value!r}: use letters, digits, '_', '.' and '-'"
+        raise ValueError(msg)
+    return value
@@ -8,15 +8,276 @@ Meshtastic packets to the PostgreSQL database.
 # pylint: disable=R0913
 # pylint: disable=R0917
 
+import contextlib
+import io
 import logging
+import random
+import re
 import sys
+import threading
 import time
+from dataclasses import dataclass, field
+from typing import Any
 
 import psycopg2
-from meshtastic import config_pb2, mesh_pb2, mqtt_pb2, portnums_pb2
-from psycopg2 import errors
+from psycopg2 import extras
 
-from .config_load import load_config
+from . import claims, metrics, node_cache, records
+from .config_load import Config, instance_id
+from .protos import config_pb2, mesh_pb2, mqtt_pb2, portnums_pb2
+
+
+@dataclass(frozen=True)
+class TelemetryTable:
+    """Where the rows of one Telemetry oneof variant are stored.
+
+    The record's fields are the table's columns: (node_id, packet_id, toi,
+    *columns), or (node_id, toi, *columns) for tables without a packet_id.
+    fields names the protobuf field read for each of the trailing columns.
+    """
+
+    table: str
+    record: type[Any]  # a records.py named tuple
+    fields: tuple[str, ...]
+
+    @property
+    def key_columns(self) -> int:
+        """Number of leading (node, packet, time) columns not read from the payload."""
+        return len(self.record._fields) - len(self.fields)
+
+
+def _renamed(record: type[Any], key_columns: int, **renames: str) -> tuple[str, ...]:
+    """Protobuf field names for a record's payload columns; most share the column name."""
+    return tuple(renames.get(column, column) for column in record._fields[key_columns:])
+
+
+# Telemetry oneof variant -> table.  The BATCH_SQL entries for these tables are
+# generated from this mapping, and telemetry_row() builds their rows.
+TELEMETRY_TABLES = {
+    "device_metrics": TelemetryTable(
+        "device_metrics",
+        records.DeviceMetricsRow,
+        _renamed(records.DeviceMetricsRow, 3, channel_util="channel_utilization"),
+    ),
+    "environment_metrics": TelemetryTable(
+        "environment_metrics",
+        records.EnvironmentMetricsRow,
+        _renamed(records.EnvironmentMetricsRow, 3, wind_gus="wind_gust"),
+    ),
+    "power_metrics": TelemetryTable(
+        "power_metrics", records.PowerMetricsRow, _renamed(records.PowerMetricsRow, 3)
+    ),
+    "air_quality_metrics": TelemetryTable(
+        "air_quality_metrics",
+        records.AirQualityMetricsRow,
+        _renamed(
+            records.AirQualityMetricsRow,
+            3,
+            pm10_std="pm10_standard",
+            pm25_std="pm25_standard",
+            pm100_std="pm100_standard",
+            pm10_env="pm10_environmental",
+            pm25_env="pm25_environmental",
+            pm100_env="pm100_environmental",
+        ),
+    ),
+    "local_stats": TelemetryTable(
+        "local_stats", records.LocalStatsRow, _renamed(records.LocalStatsRow, 2)
+    ),
+}
+
+
+def telemetry_batch_sql(spec: TelemetryTable) -> tuple[str, str]:
+    """Builds the BATCH_SQL (statement, row template) entry for a telemetry table."""
+    columns = ", ".join(spec.record._fields)
+    template = ["%s"] * len(spec.record._fields)
+    template[spec.key_columns - 1] = "to_timestamp(%s)"
+    sql = f"INSERT INTO {spec.table} ( {columns} ) VALUES %s ON CONFLICT DO NOTHING"  # noqa: S608
+    return sql, "(" + ", ".join(template) + ")"
+
+
+# Multi-row statements used by the batch writer.  Each entry is the INSERT with a
+# single VALUES %s placeholder (expanded by execute_values) and the per-row template.
+BATCH_SQL = {
+    "mesh_packets": (
+        """INSERT INTO mesh_packets (source, dest, packet_id, channel, rx_snr, rx_rssi,
+                hop_limit, hop_start, portnum, toi, channel_id, gateway_id )
+                VALUES %s
+                ON CONFLICT DO NOTHING""",
+        "(%s, %s, %s, %s, %s, %s, %s, %s, %s, to_timestamp(%s), %s, %s)",
+    ),
+    "node_infos": (
+        """INSERT INTO node_infos (node_id, long_name, short_name,
+                mac_addr, hw_model, role, public_key, created_at, updated_at)
+                VALUES %s
+                ON CONFLICT (node_id, long_name, short_name)
+                DO UPDATE
+                SET updated_at=EXCLUDED.updated_at, public_key=EXCLUDED.public_key
+                WHERE node_infos.role = EXCLUDED.role""",
+        "(%s, %s, %s, %s, %s, %s, %s, to_timestamp(%s), to_timestamp(%s))",
+    ),
+    # geom is built here from the degree lat/lon rather than by a trigger UPDATE
+    "node_positions": (
+        """INSERT INTO node_positions
+                (node_id, created_at, updated_at, latitude, longitude, altitude, geom)
+                SELECT node_id, created_at, updated_at, latitude, longitude, altitude,
+                ST_SetSRID(ST_MakePoint(longitude, latitude, 0), 4326)
+                FROM (VALUES %s)
+                AS v (node_id, created_at, updated_at, latitude, longitude, altitude)
+                ON CONFLICT (node_id, latitude, longitude)
+                DO UPDATE SET updated_at = EXCLUDED.updated_at""",
+        (
+            "(%s::bigint, to_timestamp(%s), to_timestamp(%s), %s::double precision, "
+            "%s::double precision, %s::double precision)"
+        ),
+    ),
+    "neighbor_info": (
+        """INSERT INTO neighbor_info (id, neighbor_id, snr, update_time)
+                VALUES %s
+                ON CONFLICT (id, neighbor_id)
+                DO UPDATE SET snr=EXCLUDED.snr, update_time=EXCLUDED.update_time""",
+        "(%s, %s, %s, to_timestamp(%s))",
+    ),
+    # needs the unique key from db/migrations/0007_text_messages_uk.sql to catch duplicates
+    "text_messages": (
+        """INSERT INTO text_messages (source_id, destination_id, packet_id, toi, body )
+                VALUES %s
+                ON CONFLICT DO NOTHING""",
+        "(%s, %s, %s, to_timestamp(%s), %s)",
+    ),
+    # written by node_status.NodeStatusTracker: NULL columns leave the stored value alone
+    "node_status": (
+        """INSERT INTO node_status (node_id, last_seen, last_gateway, packet_count,
+                long_name, short_name, hw_model, role, info_updated_at,
+                latitude, longitude, altitude, position_updated_at,
+                battery_level, voltage, channel_util, air_util_tx, uptime_seconds,
+                metrics_updated_at)
+                VALUES %s
+                ON CONFLICT (node_id) DO UPDATE SET
+                last_seen = GREATEST(node_status.last_seen, EXCLUDED.last_seen),
+                last_gateway = COALESCE(EXCLUDED.last_gateway, node_status.last_gateway),
+                packet_count = node_status.packet_count + EXCLUDED.packet_count,
+                long_name = COALESCE(EXCLUDED.long_name, node_status.long_name),
+                short_name = COALESCE(EXCLUDED.short_name, node_status.short_name),
+                hw_model = COALESCE(EXCLUDED.hw_model, node_status.hw_model),
+                role = COALESCE(EXCLUDED.role, node_status.role),
+                info_updated_at = COALESCE(EXCLUDED.info_updated_at, node_status.info_updated_at),
+                latitude = COALESCE(EXCLUDED.latitude, node_status.latitude),
+                longitude = COALESCE(EXCLUDED.longitude, node_status.longitude),
+                altitude = COALESCE(EXCLUDED.altitude, node_status.altitude),
+                position_updated_at =
+                    COALESCE(EXCLUDED.position_updated_at, node_status.position_updated_at),
+                battery_level = COALESCE(EXCLUDED.battery_level, node_status.battery_level),
+                voltage = COALESCE(EXCLUDED.voltage, node_status.voltage),
+                channel_util = COALESCE(EXCLUDED.channel_util, node_status.channel_util),
+                air_util_tx = COALESCE(EXCLUDED.air_util_tx, node_status.air_util_tx),
+                uptime_seconds = COALESCE(EXCLUDED.uptime_seconds, node_status.uptime_seconds),
+                metrics_updated_at =
+                    COALESCE(EXCLUDED.metrics_updated_at, node_status.metrics_updated_at)""",
+        (
+            "(%s, to_timestamp(%s), %s, %s, %s, %s, %s, %s, to_timestamp(%s), %s, %s, %s, "
+            "to_timestamp(%s), %s, %s, %s, %s, %s, to_timestamp(%s))"
+        ),
+    ),
+    # written by rollups.GatewayRollups: a minute flushed more than once adds up
+    "gateway_rollups": (
+        """INSERT INTO gateway_rollups AS r (bucket, gateway_id, channel_id, packets,
+                duplicates, snr_min, snr_max, snr_sum, rssi_min, rssi_max, rssi_sum,
+                hops_sum, hops_count)
+                VALUES %s
+                ON CONFLICT (bucket, gateway_id, channel_id) DO UPDATE SET
+                packets = r.packets + EXCLUDED.packets,
+                duplicates = r.duplicates + EXCLUDED.duplicates,
+                snr_min = LEAST(r.snr_min, EXCLUDED.snr_min),
+                snr_max = GREATEST(r.snr_max, EXCLUDED.snr_max),
+                snr_sum = r.snr_sum + EXCLUDED.snr_sum,
+                rssi_min = LEAST(r.rssi_min, EXCLUDED.rssi_min),
+                rssi_max = GREATEST(r.rssi_max, EXCLUDED.rssi_max),
+                rssi_sum = r.rssi_sum + EXCLUDED.rssi_sum,
+                hops_sum = r.hops_sum + EXCLUDED.hops_sum,
+                hops_count = r.hops_count + EXCLUDED.hops_count""",
+        "(to_timestamp(%s), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+    ),
+}
+BATCH_SQL.update({spec.table: telemetry_batch_sql(spec) for spec in TELEMETRY_TABLES.values()})
+
+# Tables written per packet, whose single-row INSERT is prepared on every connection.
+PREPARED_TABLES = (
+    "mesh_packets",
+    "node_infos",
+    "node_positions",
+    "neighbor_info",
+    "text_messages",
+    *(spec.table for spec in TELEMETRY_TABLES.values()),
+)
+
+# Row positions of the ON CONFLICT ... DO UPDATE target for the upserting tables.
+# Postgres refuses to update the same row twice in one statement, so a batch must
+# be coalesced on these keys (last row wins) before it is sent.
+CONFLICT_KEYS = {
+    "node_infos": (0, 1, 2),
+    "node_positions": (0, 3, 4),
+    "neighbor_info": (0, 1),
+    "node_status": (0,),
+    "gateway_rollups": (0, 1, 2),
+}
+
+# Tables that can be bulk loaded with COPY.  Rows are streamed into a per-session
+# staging table (same column order as the BATCH_SQL row template, with toi kept as
+# epoch seconds) and merged into the real table with one INSERT ... SELECT.
+COPY_STAGING = {
+    "mesh_packets": (
+        """source bigint, dest bigint, packet_id bigint, channel integer,
+           rx_snr double precision, rx_rssi integer, hop_limit integer, hop_start integer,
+           portnum varchar, toi double precision, channel_id varchar, gateway_id bigint""",
+        """INSERT INTO mesh_packets (source, dest, packet_id, channel, rx_snr, rx_rssi,
+                hop_limit, hop_start, portnum, toi, channel_id, gateway_id )
+                SELECT source, dest, packet_id, channel, rx_snr, rx_rssi,
+                hop_limit, hop_start, portnum, to_timestamp(toi), channel_id, gateway_id
+                FROM mesh_packets_staging
+                ON CONFLICT DO NOTHING""",
+    ),
+    "device_metrics": (
+        """node_id bigint, packet_id bigint, toi double precision, battery_level integer,
+           voltage double precision, channel_util double precision,
+           air_util_tx double precision, uptime_seconds integer""",
+        """INSERT INTO device_metrics ( node_id, packet_id, toi, battery_level, voltage,
+                channel_util, air_util_tx, uptime_seconds )
+                SELECT node_id, packet_id, to_timestamp(toi), battery_level, voltage,
+                channel_util, air_util_tx, uptime_seconds
+                FROM device_metrics_staging
+                ON CONFLICT DO NOTHING""",
+    ),
+    "text_messages": (
+        """source_id bigint, destination_id bigint, packet_id bigint, toi double precision,
+           body varchar""",
+        """INSERT INTO text_messages (source_id, destination_id, packet_id, toi, body )
+                SELECT source_id, destination_id, packet_id, to_timestamp(toi), body
+                FROM text_messages_staging
+                ON CONFLICT DO NOTHING""",
+    ),
+}
+
+# Migrations the insert statements above depend on, each with a query that returns
+# a row for as long as it has not been run.  Writing before then would store wrong
+# data (node_positions' old trigger rescales the degrees the INSERT now stores), so
+# no connection is handed out until they have been.
+REQUIRED_MIGRATIONS = {
+    "db/migrations/0003_position_geom.sql": """SELECT 1 FROM pg_trigger
+        WHERE tgrelid = 'public.node_positions'::regclass AND tgname = 'geom_inserted'""",
+}
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_text(rows: list[tuple]) -> io.StringIO:
+    """Renders rows in PostgreSQL COPY text format, with None as the NULL marker."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join("\\N" if v is None else str(v).translate(_COPY_ESCAPES) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
 
 
 def hex_to_id(node_id: str) -> int:
@@ -32,267 +293,568 @@ def id_to_hex(node_id: int) -> str:
     return "!" + f"{node_id:x}"
 
 
-def connect(config: dict):  # noqa: ANN201
-    """Connect to the PostgreSQL database server."""
+def missing_migrations(cur) -> list[str]:
+    """The REQUIRED_MIGRATIONS not yet run on the database cur is connected to."""
+    missing = []
+    for migration, sql in REQUIRED_MIGRATIONS.items():
+        cur.execute(sql)
+        if cur.fetchone() is not None:
+            missing.append(migration)
+    return missing
+
+
+def missing_migrations_message(missing: list[str]) -> str:
+    """Explains why nothing is written until the missing migrations are run."""
+    return f"refusing to write until the database is migrated: run {', '.join(missing)}"
+
+
+def format_db_error(e: Exception) -> str:
+    """Renders a psycopg2 (or other) error as module:Class: message for logging."""
+    return f"{type(e).__module__.removesuffix('.errors')}:{type(e).__name__}: {str(e).rstrip()}"
+
+
+# rx_time is taken at face value from this (2020-01-01, before any Meshtastic
+# firmware) to this far ahead of our clock; anything else comes from a gateway
+# whose clock was never set or has drifted.
+MIN_RX_TIME = 1_577_836_800
+MAX_CLOCK_SKEW = 3600
+
+
+def packet_toi(rx_time: int, received: int | None = None) -> int:
+    """The toi to store for a reception: its rx_time, if the gateway's clock is plausible.
+
+    Otherwise received (when the packet was first seen) or now, so that the row
+    lands in a current partition rather than the default one.
+    """
+    now = int(time.time())
+    if MIN_RX_TIME <= rx_time <= now + MAX_CLOCK_SKEW:
+        return rx_time
+    return received or now
+
+
+def mesh_packet_row(
+    service_envelope: mqtt_pb2.ServiceEnvelope,
+    portnum: int | None = None,
+    received: int | None = None,
+    *,
+    repeat: bool = False,
+) -> records.MeshPacketRow:
+    """Builds the mesh_packets row for a received ServiceEnvelope.
+
+    portnum overrides the packet's decoded portnum, for repeat receptions that are
+    recorded without being decrypted; with repeat the row is a RepeatReception.
+    received is the toi used when the gateway sent no rx_time, or an implausible
+    one (see packet_toi); toi is part of the unique key, so it should be the same
+    for every publish of a reception (the decoder passes the packet's first-seen
+    time).
+    """
+    mp = service_envelope.packet
+    if portnum is None:
+        portnum = mp.decoded.portnum
+    gw = service_envelope.gateway_id or "!FFFF"
+    row_type = records.RepeatReception if repeat else records.MeshPacketRow
+    return row_type(
+        getattr(mp, "from"),
+        mp.to,
+        mp.id,
+        0,
+        mp.rx_snr,
+        mp.rx_rssi,
+        mp.hop_limit or 0,
+        mp.hop_start or 3,
+        portnums_pb2.PortNum.Name(portnum),
+        packet_toi(mp.rx_time, received),
+        sys.intern(service_envelope.channel_id),  # a handful of channels, shared by every row
+        hex_to_id(gw),
+    )
+
+
+def nodeinfo_row(from_node: int, nodeinfo: mesh_pb2.User, toi: int) -> records.NodeInfoRow:
+    """Builds the node_infos row for a NodeInfo (User) payload."""
     try:
-        # connecting to the PostgreSQL server
-        with psycopg2.connect(**config) as conn:
-            return conn
-    except psycopg2.DatabaseError as e:
-        err = f"Unable to connect to database: {e}"
-        logging.fatal(err)
-        sys.exit(1)
+        role = config_pb2.Config.DeviceConfig.Role.Name(nodeinfo.role)
+    except ValueError:
+        role = "UNKNOWN"
+    try:
+        hw = mesh_pb2.HardwareModel.Name(nodeinfo.hw_model)
+    except ValueError:
+        hw = "UNKNONW"
+    return records.NodeInfoRow(
+        from_node,
+        nodeinfo.long_name,
+        nodeinfo.short_name,
+        nodeinfo.macaddr,
+        hw,
+        role,
+        nodeinfo.public_key,
+        toi,
+        toi,
+    )
+
+
+def position_row(from_node: int, pos: mesh_pb2.Position, toi: int) -> records.PositionRow | None:
+    """Builds the node_positions row for a Position payload, or None for 0,0 fixes.
+
+    Latitude and longitude are stored in degrees (the payload carries 1e-7 degrees).
+    """
+    if pos.latitude_i == 0 and pos.longitude_i == 0:
+        return None
+    return records.PositionRow(
+        from_node, toi, toi, pos.latitude_i / 1e7, pos.longitude_i / 1e7, pos.altitude
+    )
+
+
+def neighbor_info_rows(
+    from_node: int, neighbor_info: mesh_pb2.NeighborInfo, rx_time: int
+) -> list[records.NeighborRow]:
+    """Builds one neighbor_info row per neighbor in a NeighborInfo payload."""
+    return [
+        records.NeighborRow(from_node, neighbor.node_id, neighbor.snr, rx_time)
+        for neighbor in neighbor_info.neighbors
+    ]
+
+
+def text_message_row(
+    from_node: int, to_node: int, packet_id: int, rx_time: int, body: str
+) -> records.TextMessageRow:
+    """Builds the text_messages row for a text message."""
+    return records.TextMessageRow(from_node, to_node, packet_id, rx_time, body)
+
+
+def _field_values(msg, fields) -> list:
+    """Reads fields from a protobuf message; unset optional fields read as None."""
+    by_name = msg.DESCRIPTOR.fields_by_name
+    values: list = []
+    for name in fields:
+        desc = by_name.get(name)  # fields missing from older protobufs read as None too
+        if desc is None or (desc.has_presence and not msg.HasField(name)):
+            values.append(None)
+        else:
+            values.append(getattr(msg, name))
+    return values
+
+
+def telemetry_row(from_node, packet_id, rx_time, telem) -> tuple[str, Any] | None:
+    """Builds the (table, record) for a Telemetry payload, per its variant's TELEMETRY_TABLES entry.
+
+    Returns None for variants that aren't stored.
+    """
+    variant = telem.WhichOneof("variant")
+    spec = TELEMETRY_TABLES.get(variant)
+    if spec is None:
+        return None
+    values = _field_values(getattr(telem, variant), spec.fields)
+    if "packet_id" in spec.record._fields:
+        return spec.table, spec.record(from_node, packet_id, rx_time, *values)
+    return spec.table, spec.record(from_node, rx_time, *values)
+
+
+def device_metrics_row(from_node, packet_id, rx_time, telem) -> records.DeviceMetricsRow | None:
+    """Builds the device_metrics row for a Telemetry payload, if it carries device metrics."""
+    if telem.WhichOneof("variant") != "device_metrics":
+        return None
+    table_row = telemetry_row(from_node, packet_id, rx_time, telem)
+    return None if table_row is None else table_row[1]
+
+
+def tag_connection(config: dict, instance: str) -> dict:
+    """Adds this instance's id to the [postgresql] connection parameters.
+
+    The id becomes the application_name (for pg_stat_activity) and the
+    mesh_persist.instance_id setting, which column defaults tag rows with.
+    """
+    tagged = dict(config)
+    tagged.setdefault("application_name", f"mesh-persist/{instance}")
+    options = f"-c mesh_persist.instance_id={instance}"
+    tagged["options"] = f"{tagged['options']} {options}" if tagged.get("options") else options
+    return tagged
+
+
+def batch_sql(table: str, count: int) -> str:
+    """Expands a BATCH_SQL statement to `count` rows of positional placeholders.
+
+    For drivers without execute_values (psycopg 3): the parameters are the rows
+    flattened in order.
+    """
+    sql, template = BATCH_SQL[table]
+    return sql.replace("VALUES %s", "VALUES " + ", ".join([template] * count), 1)
+
+
+def coalesce_rows(table: str, rows: list[tuple]) -> list[tuple]:
+    """Collapses rows sharing an upsert conflict key, keeping the most recent."""
+    key = CONFLICT_KEYS.get(table)
+    if key is None or len(rows) < 2:  # noqa: PLR2004
+        return rows
+    latest: dict[tuple, tuple] = {}
+    for row in rows:
+        latest[tuple(row[i] for i in key)] = row
+    return list(latest.values())
+
+
+def prepared_name(table: str) -> str:
+    """Name of the server-side prepared single-row INSERT for a table."""
+    return f"mp_insert_{table}"
+
+
+def prepare_sql(table: str) -> str:
+    """PREPARE statement for a table's single-row INSERT, using $n parameters."""
+    sql, template = BATCH_SQL[table]
+    counter = iter(range(1, template.count("%s") + 1))
+    numbered = re.sub("%s", lambda _: f"${next(counter)}", template)
+    return f"PREPARE {prepared_name(table)} AS " + sql.replace("VALUES %s", "VALUES " + numbered, 1)
+
+
+def execute_prepared_sql(table: str) -> str:
+    """EXECUTE statement (with %s placeholders) for a table's prepared INSERT."""
+    _, template = BATCH_SQL[table]
+    params = ", ".join(["%s"] * template.count("%s"))
+    return f"EXECUTE {prepared_name(table)} ({params})"
+
+
+@dataclass
+class Session:
+    """A pooled connection and the per-connection state that goes with it."""
+
+    conn: psycopg2.extensions.connection
+    staging_ready: set[str] = field(default_factory=set)
+
+
+class ConnectionPool:
+    """Per-thread PostgreSQL connections with passive health checking.
+
+    Each thread that touches the database gets its own connection, opened on
+    first use with the fixed insert statements prepared.  Nothing probes the
+    connection; instead, callers report a failed query with discard(), and the
+    next use reconnects, backing off exponentially (with jitter) while the
+    server stays unreachable.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        logger: logging.Logger,
+        *,
+        min_backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ) -> None:
+        """Initialization function for ConnectionPool.
+
+        Args:
+            config: psycopg2.connect() keyword arguments (the [postgresql] section).
+            logger: logger for connect/disconnect messages.
+            min_backoff: delay (seconds) before the first reconnect attempt.
+            max_backoff: upper bound on the reconnect delay.
+        """
+        self.config = config
+        self.logger = logger
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._local = threading.local()
+        self._sessions: list[Session] = []
+        self._lock = threading.Lock()
+
+    def session(self) -> Session:
+        """Returns this thread's session, connecting if needed.
+
+        Raises:
+            psycopg2.OperationalError: the server is unreachable, setting up the
+                new connection failed (e.g. a PREPARE after a schema change or a
+                permissions problem), a REQUIRED_MIGRATIONS migration has not been
+                run, or we are still backing off after the last failed attempt.
+                Setup failures are raised as OperationalError so that callers
+                retry their batch rather than drop it.
+        """
+        sess: Session | None = getattr(self._local, "session", None)
+        if sess is not None and not sess.conn.closed:
+            return sess
+        now = time.monotonic()
+        retry_at = getattr(self._local, "retry_at", 0.0)
+        if now < retry_at:
+            msg = f"database unavailable, next reconnect in {retry_at - now:.1f}s"
+            raise psycopg2.OperationalError(msg)
+        conn = None
+        try:
+            conn = psycopg2.connect(**self.config)
+            with conn.cursor() as cur:
+                missing = missing_migrations(cur)
+                if missing:
+                    raise psycopg2.OperationalError(missing_migrations_message(missing))
+                cur.execute(";".join(prepare_sql(table) for table in PREPARED_TABLES))
+            conn.commit()
+        except psycopg2.Error as e:
+            if conn is not None:
+                with contextlib.suppress(psycopg2.Error):
+                    conn.close()
+            failures = getattr(self._local, "failures", 0) + 1
+            self._local.failures = failures
+            delay = min(self.max_backoff, self.min_backoff * 2 ** (failures - 1))
+            self._local.retry_at = now + delay * random.uniform(0.5, 1.0)  # noqa: S311
+            if isinstance(e, psycopg2.OperationalError):
+                raise
+            msg = f"database connection setup failed: {format_db_error(e)}"
+            raise psycopg2.OperationalError(msg) from e
+        if getattr(self._local, "failures", 0):
+            self.logger.info("Reconnected to database")
+        self._local.failures = 0
+        sess = Session(conn)
+        self._local.session = sess
+        with self._lock:
+            self._sessions.append(sess)
+        return sess
+
+    def connection(self) -> psycopg2.extensions.connection:
+        """Returns this thread's connection, connecting if needed."""
+        return self.session().conn
+
+    @property
+    def healthy(self) -> bool:
+        """True if this thread holds an open connection (no round trip is made)."""
+        sess: Session | None = getattr(self._local, "session", None)
+        return sess is not None and not sess.conn.closed
+
+    def discard(self) -> None:
+        """Drops this thread's connection after a failure; the next use reconnects."""
+        sess: Session | None = getattr(self._local, "session", None)
+        if sess is None:
+            return
+        self._local.session = None
+        with self._lock:
+            if sess in self._sessions:
+                self._sessions.remove(sess)
+        with contextlib.suppress(psycopg2.Error):
+            sess.conn.close()
+        self.logger.warning("Discarded database connection; will reconnect")
+
+    def closeall(self) -> None:
+        """Closes every connection the pool has handed out."""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for sess in sessions:
+            with contextlib.suppress(psycopg2.Error):
+                sess.conn.close()
 
 
 class DbFunctions:
     """Set of Postgres Database functions for the Mesh Persist Meshtastic persister."""
 
-    def __init__(self, logger: logging.Logger) -> None:
-        """Initialization function for db_functions."""
+    def __init__(self, logger: logging.Logger, config: Config) -> None:
+        """Initialization function for db_functions.
+
+        Args:
+            logger: logger for database errors and the node cache summary.
+            config: the parsed mesh_persist.ini.
+        """
         self.logger = logger
-        self.config = load_config(filename="mesh_persist.ini", section="postgresql")
-        self.conn = connect(self.config)
+        self.instance_id = instance_id(config.section("persist"))
+        self.config = tag_connection(config.section("postgresql", required=True), self.instance_id)
+        self.pool = ConnectionPool(self.config, logger)
+        # set when metrics are enabled, to time inserts and commits
+        self.metrics: metrics.PipelineMetrics | None = None
+        self.node_cache = node_cache.NodeStateCache.from_config(
+            logger, config.section("node_cache")
+        )
+        self.claims = claims.PacketClaims.from_config(logger, config.section("dedup"))
+        # inserts and commits slower than this are logged (None: off); see profiling
+        self.slow_query_seconds: float | None = None
+        if config.enabled("profiling"):
+            slow_query_ms = config.get_float("profiling", "slow_query_ms", 0.0)
+            if slow_query_ms > 0:
+                self.slow_query_seconds = slow_query_ms / 1000
 
     def test_connection(self) -> bool:
-        """Called to determine if a DB connection is up and active."""
+        """Called to determine if a DB connection is up and active.
+
+        This is passive: failures are detected from real queries, so no probe
+        query is sent.
+        """
+        return self.pool.healthy
+
+    def write_batches(  # noqa: C901, PLR0912, PLR0915
+        self, batches: dict[str, list[tuple]], *, bulk_copy: bool = False
+    ) -> dict[str, tuple[int, int]]:
+        """Writes a set of per-table row batches in a single transaction.
+
+        Each table's rows go out as one multi-row INSERT (a single row uses the
+        prepared statement); the whole set is committed once.  With bulk_copy,
+        tables listed in COPY_STAGING are instead streamed in with COPY and
+        merged (see copy_merge).  On any error the transaction is rolled back, a
+        broken connection is discarded, and the exception re-raised so the
+        caller can decide whether to retry.
+
+        With the node state cache enabled, nodeinfo and position rows that match
+        what is already stored are dropped here, and the last-seen times they
+        carried are written in bulk every so often instead.  With shared dedup,
+        text message and telemetry rows are only written for the packets this
+        instance claims (see claims.PacketClaims).
+
+        Returns:
+            (inserted, duplicates) per bulk-copied table.
+        """
+        merged: dict[str, tuple[int, int]] = {}
+        m = self.metrics
+        slow = self.slow_query_seconds
+        cache = self.node_cache
+        staged: dict[str, dict[int, tuple]] = {}
+        touches: dict[str, list[tuple]] = {}
+        if cache is not None:
+            batches = {table: cache.filter(table, rows, staged) for table, rows in batches.items()}
+            touches = cache.take_touches()
+        sess = self.pool.session()
         try:
-            cur = self.conn.cursor()
-            cur.execute("SELECT 1")
-        except psycopg2.OperationalError:
-            return False
-        return True
+            with sess.conn.cursor() as cur:
+                if self.claims is not None:
+                    batches = self.claims.resolve(cur, batches)
+                for table, rows in batches.items():
+                    if not rows:
+                        continue
+                    start = time.perf_counter()
+                    self._insert(sess, cur, table, rows, merged, bulk_copy=bulk_copy)
+                    elapsed = time.perf_counter() - start
+                    if m is not None:
+                        m.insert_seconds.observe(elapsed, table)
+                    if slow is not None and elapsed >= slow:
+                        self.logger.warning(
+                            "Slow insert: %d %s rows took %.1f ms", len(rows), table, elapsed * 1000
+                        )
+                for table, rows in touches.items():
+                    sql, template = node_cache.TOUCH_SQL[table]
+                    extras.execute_values(cur, sql, rows, template=template, page_size=1000)
+            start = time.perf_counter()
+            sess.conn.commit()
+            elapsed = time.perf_counter() - start
+            if m is not None:
+                m.commit_seconds.observe(elapsed)
+            if slow is not None and elapsed >= slow:
+                self.logger.warning("Slow commit: took %.1f ms", elapsed * 1000)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if cache is not None:
+                cache.restore_touches(touches)
+            self.pool.discard()
+            raise
+        except Exception:
+            # data errors, and rows psycopg2 could not even adapt (a NUL in a text
+            # body raises ValueError before anything is sent)
+            if cache is not None:
+                cache.restore_touches(touches)
+            try:
+                sess.conn.rollback()
+            except psycopg2.Error:
+                self.pool.discard()
+            # a rolled back CREATE TEMP TABLE has to be redone on the next flush
+            sess.staging_ready.clear()
+            raise
+        if cache is not None:
+            cache.commit(staged)
+            cache.touched(touches)
+        return merged
 
-    def insert_mesh_packet(self, service_envelope: mqtt_pb2.ServiceEnvelope) -> None:
-        """Called for every received packet:  insert the base packet infomation."""
-        mp = service_envelope.packet
-        pn = mp.decoded.portnum
-        portnum = portnums_pb2.PortNum.Name(pn)
-        gw = service_envelope.gateway_id
+    def warm_node_cache(self) -> None:
+        """Loads each node's latest nodeinfo and position into the node state cache."""
+        cache = self.node_cache
+        if cache is None:
+            return
+        sess = self.pool.session()
+        try:
+            with sess.conn.cursor() as cur:
+                for table, sql in node_cache.WARM_SQL.items():
+                    cur.execute(sql, (cache.max_entries,))
+                    # drop the trailing updated_at, used only for ordering
+                    cache.warm(table, [row[:-1] for row in cur.fetchall()])
+            sess.conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.pool.discard()
+            raise
+        except psycopg2.Error:
+            sess.conn.rollback()
+            raise
+        self.logger.info("Warmed node cache with %d node states", len(cache))
 
-        sql = """INSERT INTO mesh_packets (source, dest, packet_id, channel, rx_snr, rx_rssi,
-                hop_limit, hop_start, portnum, toi, channel_id, gateway_id )
-                VALUES(%s, %s, %s, %s, %s,
-                        %s, %s, %s, %s, to_timestamp(%s),
-                        %s, %s);"""
+    def _insert(  # noqa: PLR0913
+        self,
+        sess: Session,
+        cur,
+        table: str,
+        rows: list[tuple],
+        merged: dict[str, tuple[int, int]],
+        *,
+        bulk_copy: bool,
+    ) -> None:
+        """Writes one table's rows inside the caller's transaction."""
+        if bulk_copy and table in COPY_STAGING:
+            merged[table] = self.copy_merge(sess, cur, table, rows)
+            return
+        rows = coalesce_rows(table, rows)
+        if len(rows) == 1 and table in PREPARED_TABLES:
+            cur.execute(execute_prepared_sql(table), rows[0])
+            return
+        sql, template = BATCH_SQL[table]
+        extras.execute_values(cur, sql, rows, template=template, page_size=1000)
+
+    def copy_merge(self, sess: Session, cur, table: str, rows: list[tuple]) -> tuple[int, int]:
+        """COPYs rows into the table's staging table and merges them into the table.
+
+        Runs inside the caller's transaction.  The staging table is a temporary
+        table (never WAL-logged) that is emptied on commit, so each session gets
+        its own and concurrent persisters don't collide.
+
+        Returns:
+            The number of rows inserted and the number dropped as duplicates.
+        """
+        columns, merge_sql = COPY_STAGING[table]
+        staging = f"{table}_staging"
+        if table not in sess.staging_ready:
+            cur.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS {staging} ({columns}) ON COMMIT DELETE ROWS"
+            )
+            sess.staging_ready.add(table)
+        cur.copy_expert(f"COPY {staging} FROM STDIN", copy_text(rows))
+        cur.execute(merge_sql)
+        inserted = max(cur.rowcount, 0)
+        return inserted, len(rows) - inserted
+
+    def _write_rows(self, table: str, rows: list) -> None:
+        """Writes rows to a single table, logging rather than raising on failure."""
+        if not rows:
+            return
         try:
-            with self.conn.cursor() as cur:
-                if not mp.hop_start:
-                    mp.hop_start = 3
-                if not mp.hop_limit:
-                    mp.hop_limit = 0
-                if not mp.rx_time:
-                    mp.rx_time = int(time.time())
-                if not gw:
-                    gw = "!FFFF"
-                # execute the INSERT statement
-                cur.execute(
-                    sql,
-                    (
-                        getattr(mp, "from"),
-                        mp.to,
-                        mp.id,
-                        0,
-                        mp.rx_snr,
-                        mp.rx_rssi,
-                        mp.hop_limit,
-                        mp.hop_start,
-                        portnum,
-                        mp.rx_time,
-                        service_envelope.channel_id,
-                        hex_to_id(gw),
-                    ),
-                )
-                # commit the changes to the database
-                self.conn.commit()
-        except errors.UniqueViolation as u:
-            self.conn.rollback()
-            err = f"{type(u).__module__.removesuffix('.errors')}:{type(u).__name__}: \
-                {str(u).rstrip()}"
-            # self.logger.exception(err)
+            self.write_batches({table: rows})
+            self.logger.debug("Wrote %d row(s) to %s", len(rows), table)
         except psycopg2.Error as e:
-            self.conn.rollback()
-            err = f"{type(e).__module__.removesuffix('.errors')}:{type(e).__name__}: \
-                {str(e).rstrip()}"
-            self.logger.exception(err)
+            self.logger.error(format_db_error(e))  # noqa: TRY400
 
-    def insert_nodeinfo(self, from_node: str, nodeinfo: mesh_pb2.User, toi: int) -> None:
+    def insert_mesh_packet(self, service_envelope: mqtt_pb2.ServiceEnvelope) -> None:
+        """Called for every received packet:  insert the base packet infomation."""
+        self._write_rows("mesh_packets", [mesh_packet_row(service_envelope)])
+
+    def insert_nodeinfo(self, from_node: int, nodeinfo: mesh_pb2.User, toi: int) -> None:
         """Called for NodeInfo packets, to insert/update existing node info."""
-        upsert_sql = """INSERT INTO node_infos (node_id, long_name, short_name,
-                        mac_addr, hw_model, role, public_key, created_at, updated_at)
-                        VALUES(%s, %s, %s, %s, %s, %s, %s, to_timestamp(%s), to_timestamp(%s))
-                        ON CONFLICT (node_id, long_name, short_name)
-                        DO UPDATE
-                        SET updated_at=to_timestamp(%s), public_key=%s
-                        WHERE node_infos.long_name = %s
-                        AND node_infos.short_name = %s
-                        AND node_infos.role = %s
-                        AND node_infos.node_id = %s"""
-        try:
-            with self.conn.cursor() as cur:
-                role = "UNKNONW"
-                try:
-                    role = config_pb2.Config.DeviceConfig.Role.Name(nodeinfo.role)
-                except ValueError:
-                    role = "UNKNOWN"
-                hw = "UNKNONW"
-                try:
-                    hw = mesh_pb2.HardwareModel.Name(nodeinfo.hw_model)
-                except ValueError:
-                    hw = "UNKNONW"
-                cur.execute(
-                    upsert_sql,
-                    (
-                        from_node,
-                        nodeinfo.long_name,
-                        nodeinfo.short_name,
-                        nodeinfo.macaddr,
-                        hw,
-                        role,
-                        nodeinfo.public_key,
-                        toi,
-                        toi,
-                        toi,
-                        nodeinfo.public_key,
-                        nodeinfo.long_name,
-                        nodeinfo.short_name,
-                        role,
-                        from_node,
-                    ),
-                )
-                self.logger.debug("Upserted nodeinfo")
-                self.conn.commit()
-        except psycopg2.Error as e:
-            err = f"{type(e).__module__.removesuffix('.errors')}:{type(e).__name__}: \
-                {str(e).rstrip()}"
-            self.logger.exception(err)
+        self._write_rows("node_infos", [nodeinfo_row(from_node, nodeinfo, toi)])
 
     def insert_position(self, from_node, pos, toi) -> None:
         """Inserts Meshtastic node position data into db."""
-        upsert_sql = """INSERT INTO node_positions
-                        (node_id, created_at, updated_at, latitude, longitude, altitude)
-                        VALUES(%s, to_timestamp(%s), to_timestamp(%s), %s, %s, %s)
-                        ON CONFLICT (node_id, latitude, longitude)
-                        DO
-                        UPDATE SET updated_at = to_timestamp(%s)
-                        WHERE node_positions.node_id=%s
-                        and node_positions.latitude=%s
-                        and node_positions.longitude=%s"""
-        if pos.latitude_i == 0 and pos.longitude_i == 0:
-            return
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute(
-                    upsert_sql,
-                    (
-                        from_node,
-                        toi,
-                        toi,
-                        pos.latitude_i,
-                        pos.longitude_i,
-                        pos.altitude,
-                        toi,
-                        from_node,
-                        pos.latitude_i,
-                        pos.longitude_i,
-                    ),
-                )
-                # commit the changes to the database
-                self.conn.commit()
-                self.logger.debug("Upserted position")
-        except psycopg2.Error as e:
-            err = f"{type(e).__module__.removesuffix('.errors')}:{type(e).__name__}: \
-                {str(e).rstrip()}"
-            self.logger.exception(err)
+        row = position_row(from_node, pos, toi)
+        if row is not None:
+            self._write_rows("node_positions", [row])
 
     def insert_neighbor_info(
         self, from_node: int, neighbor_info: mesh_pb2.NeighborInfo, rx_time: int
     ) -> None:
-        """Inserts Meshtastic NeighborInfo packet data into DB."""
-        upsert_sql = """INSERT INTO neighbor_info
-                        (id, neighbor_id, snr, update_time)
-                        VALUES (%s, %s, %s, to_timestamp(%s))
-                        ON CONFLICT (id, neighbor_id)
-                        DO
-                        UPDATE SET snr=%s, update_time=to_timestamp(%s)
-                        WHERE neighbor_info.id=%s AND neighbor_info.neighbor_id=%s"""
-        try:
-            with self.conn.cursor() as cur:
-                for neighbor in neighbor_info.neighbors:
-                    cur.execute(
-                        upsert_sql,
-                        (
-                            from_node,
-                            neighbor.node_id,
-                            neighbor.snr,
-                            rx_time,
-                            neighbor.snr,
-                            rx_time,
-                            from_node,
-                            neighbor.node_id,
-                        ),
-                    )
-                # commit the changes to the database
-                self.conn.commit()
-                self.logger.debug("Upserted Neighbor Info")
-        except psycopg2.Error as e:
-            err = f"{type(e).__module__.removesuffix('.errors')}:{type(e).__name__}: \
-                {str(e).rstrip()}"
-            self.logger.exception(err)
+        """Inserts Meshtastic NeighborInfo packet data into DB.
+
+        All of the packet's neighbors go in one multi-row INSERT.
+        """
+        self._write_rows("neighbor_info", neighbor_info_rows(from_node, neighbor_info, rx_time))
 
     def insert_text_message(
         self, from_node: int, to_node: int, packet_id: int, rx_time: int, body: str
     ) -> None:
         """Inserts meshtastic text messages into db."""
-        insert_sql = """INSERT INTO text_messages (source_id, destination_id, packet_id, toi, body )
-                        VALUES ( %s, %s, %s, to_timestamp(%s), %s);"""
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute(insert_sql, (from_node, to_node, packet_id, rx_time, body))
-                self.conn.commit()
-                self.logger.debug("Inserted text message")
-        except psycopg2.Error as e:
-            err = f"{type(e).__module__.removesuffix('.errors')}:{type(e).__name__}: \
-                {str(e).rstrip()}"
-            self.logger.exception(err)
+        self._write_rows(
+            "text_messages", [text_message_row(from_node, to_node, packet_id, rx_time, body)]
+        )
 
     def insert_telemetry(self, from_node, packet_id, rx_time, telem) -> None:
-        """Inserts various telemetry data sent via Meshtastic packets.
-
-        XXX TODO - add additional telemetry types
-        """
-        if telem.WhichOneof("variant") == "device_metrics":
-            sql = """INSERT INTO device_metrics ( node_id, packet_id, toi, battery_level, voltage,
-                    channel_util, air_util_tx, uptime_seconds )
-                    VALUES ( %s, %s, to_timestamp(%s), %s, %s, %s, %s, %s)"""
-            dm = telem.device_metrics
-            if not dm.battery_level:
-                dm.battery_level = 0
-            if not dm.voltage:
-                dm.voltage = 0
-            if not dm.channel_utilization:
-                dm.channel_utilization = 0.0
-            if not dm.air_util_tx:
-                dm.air_util_tx = 0.0
-            if not dm.uptime_seconds:
-                dm.uptime_seconds = 0
-            try:
-                with self.conn.cursor() as cur:
-                    cur.execute(
-                        sql,
-                        (
-                            from_node,
-                            packet_id,
-                            rx_time,
-                            dm.battery_level,
-                            dm.voltage,
-                            dm.channel_utilization,
-                            dm.air_util_tx,
-                            dm.uptime_seconds,
-                        ),
-                    )
-                    self.conn.commit()
-                    self.logger.debug("Inserted telemetry")
-            except psycopg2.Error as e:
-                err = f"{type(e).__module__.removesuffix('.errors')}:{type(e).__name__}: \
-                    {str(e).rstrip()}"
-                self.logger.exception(err)
+        """Inserts telemetry data sent via Meshtastic packets, into its variant's table."""
+        table_row = telemetry_row(from_node, packet_id, rx_time, telem)
+        if table_row is not None:
+            self._write_rows(table_row[0], [table_row[1]])
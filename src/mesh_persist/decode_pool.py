@@ -0,0 +1,403 @@
+"""Multi-process decode workers.
+
+Envelope parsing, AES decryption and payload parsing are CPU bound and run
+under the GIL.  This module fans raw MQTT (topic, payload) pairs out to a pool
+of worker processes, each running its own PacketDecoder, and collects the
+resulting rows back in the parent for the batch writer.
+
+Messages are sharded by source node id, so every packet from a given node is
+decoded by the same worker, in arrival order, and that worker's dedup cache
+sees all of that node's receptions.
+
+Each worker decodes with its own dedup cache and, when metrics are enabled,
+its own PipelineMetrics; every REPORT_INTERVAL seconds it sends a
+WorkerReport with what its decoder counted, which the parent folds into the
+metrics it serves.  The pool's own live worker count, dropped messages and
+restarts are exported alongside.
+
+Messages replayed from the spool or a capture are marked as such, and their
+rows handed back marked too, so they are never shed or dropped.  barrier()
+waits until every message submitted so far has been decoded and its rows
+handed on, which is what the spool replayer needs before committing.
+
+A message that fails to decode is logged and skipped by its worker.  Workers
+ignore SIGINT, so Ctrl-C stops the parent, which then drains them.  A worker
+that dies anyway is restarted, so its shard keeps being decoded.
+"""
+
+# pylint: disable=R0902
+# pylint: disable=R0913
+
+import logging
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import time
+from collections.abc import Callable
+from multiprocessing.context import SpawnProcess
+from typing import NamedTuple
+
+from . import channels, decoder, dedup, metrics
+from .config_load import TRUTHY
+
+# Sentinel telling a worker (or the collector) to exit.
+_STOP = None
+
+# Rows from up to this many messages are sent back to the parent in one put().
+_RESULT_BATCH = 64
+
+# Seconds between checks that every worker process is still running.
+_CHECK_INTERVAL = 1.0
+
+# Seconds between a worker's reports of its decoder's counters.
+REPORT_INTERVAL = 1.0
+
+
+class Replayed(NamedTuple):
+    """Rows decoded from replayed messages, sent apart from the live rows."""
+
+    rows: decoder.Rows
+
+
+class Barrier(NamedTuple):
+    """Passed through every worker in turn; echoed once all before it is decoded."""
+
+    barrier_id: int
+
+
+class WorkerReport(NamedTuple):
+    """A decode worker's counters, sent to the parent alongside its rows."""
+
+    worker_id: int
+    dedup_hits: int  # totals since the worker started
+    dedup_misses: int
+    metrics: dict | None  # PipelineMetrics.take_decode(), since the last report
+
+
+def _report(worker_id: int, packet_decoder: decoder.PacketDecoder) -> WorkerReport:
+    s = packet_decoder.dedup.stats
+    m = packet_decoder.metrics
+    return WorkerReport(worker_id, s.hits, s.misses, m.take_decode() if m is not None else None)
+
+
+# Wire tags: ServiceEnvelope.packet (field 1, length delimited) and
+# MeshPacket.from (field 1, fixed32).
+_ENVELOPE_PACKET_TAG = 0x0A
+_PACKET_FROM_TAG = 0x0D
+
+_JSON_FROM = b'"from":'
+
+
+def peek_source(payload: bytes) -> int:
+    """Reads MeshPacket.from out of a serialized ServiceEnvelope without parsing it.
+
+    The envelope starts with field 1 (packet, length delimited) and the packet
+    starts with field 1 (from, fixed32), so the source id is at a fixed offset
+    after the length varint.  For JSON feed packets the number after "from": is
+    used.  Returns 0 if the payload doesn't have either shape.
+    """
+    if payload[:1] == b"{":
+        i = payload.find(_JSON_FROM)
+        if i < 0:
+            return 0
+        digits = payload[i + len(_JSON_FROM) : i + len(_JSON_FROM) + 11].strip()
+        end = 0
+        while end < len(digits) and digits[end : end + 1].isdigit():
+            end += 1
+        return int(digits[:end]) if end else 0
+    if len(payload) < 2 or payload[0] != _ENVELOPE_PACKET_TAG:  # noqa: PLR2004
+        return 0
+    i = 1
+    while i < len(payload) and payload[i] & 0x80:
+        i += 1
+    i += 1
+    if i + 5 <= len(payload) and payload[i] == _PACKET_FROM_TAG:
+        return int.from_bytes(payload[i + 1 : i + 5], "little")
+    return 0
+
+
+def _send_rows(outbox: multiprocessing.Queue, live: decoder.Rows, replayed: decoder.Rows) -> None:
+    if live:
+        outbox.put(live)
+    if replayed:
+        outbox.put(Replayed(replayed))
+
+
+def _worker_main(  # noqa: PLR0913, PLR0917
+    worker_id: int,
+    inbox: multiprocessing.Queue,
+    outbox: multiprocessing.Queue,
+    channel_config: dict,
+    dedup_config: dict,
+    profiling_config: dict,
+    log_level: int,
+    collect_metrics: bool,  # noqa: FBT001  passed positionally by Process
+) -> None:
+    """Decode worker process: decode messages from inbox, send rows and reports to outbox."""
+    # Ctrl-C goes to the whole process group; the parent stops the workers with _STOP
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger = logging.getLogger(f"{__name__}.worker{worker_id}")
+    logger.setLevel(log_level)
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(log_level)
+    ch.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(ch)
+    packet_decoder = decoder.PacketDecoder(
+        channels.ChannelKeys.from_config(channel_config, logger),
+        dedup.DedupCache.from_config(dedup_config),
+        logger,
+        pipeline_metrics=metrics.PipelineMetrics() if collect_metrics else None,
+    )
+    if profiling_config.get("enabled", "false").lower() in TRUTHY:
+        from . import profiling  # noqa: PLC0415  optional subsystem
+
+        profiling.Profiler.from_config(logger, profiling_config, packet_decoder).install()
+
+    pending: decoder.Rows = []
+    replayed: decoder.Rows = []
+    handled = 0
+    next_report = time.monotonic() + REPORT_INTERVAL
+    while True:
+        if time.monotonic() >= next_report:
+            outbox.put(_report(worker_id, packet_decoder))
+            next_report = time.monotonic() + REPORT_INTERVAL
+        try:
+            item = inbox.get(timeout=REPORT_INTERVAL)
+        except queue.Empty:
+            continue
+        if item is _STOP:
+            break
+        if isinstance(item, Barrier):
+            handled = _RESULT_BATCH
+        else:
+            topic, payload, is_replay = item
+            try:
+                (replayed if is_replay else pending).extend(packet_decoder.decode(topic, payload))
+            except Exception:
+                logger.exception("Skipping message on %s that failed to decode", topic)
+            handled += 1
+        if handled >= _RESULT_BATCH or inbox.empty():
+            _send_rows(outbox, pending, replayed)
+            pending = []
+            replayed = []
+            handled = 0
+        if isinstance(item, Barrier):
+            outbox.put(item)
+    _send_rows(outbox, pending, replayed)
+    outbox.put(_report(worker_id, packet_decoder))
+    packet_decoder.log_stats()
+    outbox.put(_STOP)
+
+
+class DecodePool:
+    """Pool of decode worker processes sharded by source node id."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        workers: int,
+        channel_config: dict,
+        dedup_config: dict,
+        on_rows: Callable[..., None],
+        logger: logging.Logger,
+        *,
+        queue_size: int = 10000,
+        log_level: int = logging.INFO,
+        profiling_config: dict | None = None,
+        pipeline_metrics: metrics.PipelineMetrics | None = None,
+    ) -> None:
+        """Initialization function for DecodePool.
+
+        Args:
+            workers: number of worker processes.
+            channel_config: [channels] settings for each worker's channel keys.
+            dedup_config: [dedup] settings for each worker's dedup cache.
+            on_rows: called in the parent (from a collector thread) with decoded
+                rows, and replayed=True for the rows of replayed messages.
+            logger: logger for pool status messages.
+            queue_size: bound on messages waiting for each worker.
+            log_level: logging level inside the worker processes.
+            profiling_config: [profiling] settings; if enabled, each worker opens
+                its own profiling window on the profiling signal.
+            pipeline_metrics: if given, the workers' decode counters and stage
+                timings are added here.
+        """
+        self.workers = workers
+        self.logger = logger
+        self.on_rows = on_rows
+        self.submitted = 0
+        self.dropped = 0
+        self.restarts = 0
+        self.metrics = pipeline_metrics
+        self._dedup: dict[int, tuple[int, int]] = {}
+        self._barriers = 0
+        self._echoes: dict[int, int] = {}
+        self._echoed = threading.Condition()
+        self._check_lock = threading.Lock()
+        self._ctx = multiprocessing.get_context("spawn")
+        self._outbox: multiprocessing.Queue = self._ctx.Queue()
+        self._queue_size = queue_size
+        self._inboxes: list[multiprocessing.Queue] = [
+            self._ctx.Queue(maxsize=queue_size) for _ in range(workers)
+        ]
+        self._worker_config = (
+            channel_config,
+            dedup_config,
+            profiling_config or {},
+            log_level,
+            pipeline_metrics is not None,
+        )
+        self._procs = [self._new_worker(i) for i in range(workers)]
+        self._next_check = 0.0
+        self._collector = threading.Thread(
+            target=self._collect, name="mesh-persist-collector", daemon=True
+        )
+        if pipeline_metrics is not None:
+            pipeline_metrics.add_gauge(
+                "mesh_persist_decode_workers_alive",
+                "Decode worker processes running.",
+                lambda: len(self.pids()),
+            )
+            pipeline_metrics.add_total(
+                "mesh_persist_decode_dropped_total",
+                "Messages dropped before decoding: decode queue full, or queued for a dead worker.",
+                lambda: self.dropped,
+            )
+            pipeline_metrics.add_total(
+                "mesh_persist_decode_worker_restarts_total",
+                "Decode worker processes restarted after dying.",
+                lambda: self.restarts,
+            )
+
+    def _new_worker(self, i: int) -> SpawnProcess:
+        return self._ctx.Process(
+            target=_worker_main,
+            args=(i, self._inboxes[i], self._outbox, *self._worker_config),
+            name=f"mesh-persist-decode-{i}",
+            daemon=True,
+        )
+
+    def start(self) -> None:
+        """Starts the worker processes and the result collector."""
+        for proc in self._procs:
+            proc.start()
+        self._collector.start()
+        self._next_check = time.monotonic() + _CHECK_INTERVAL
+        self.logger.info("Started %d decode workers", self.workers)
+
+    def check_workers(self) -> int:
+        """Restarts any worker process that has died; returns how many were restarted.
+
+        The new worker gets a new inbox: a worker killed while waiting for a
+        message dies holding the old inbox's read lock.  Messages still queued
+        for the dead worker, and the rows of the batch it was building, are lost.
+        Safe to call from more than one thread.
+        """
+        restarted = 0
+        with self._check_lock:
+            for i, proc in enumerate(self._procs):
+                if proc.is_alive():
+                    continue
+                old = self._inboxes[i]
+                lost = old.qsize()
+                old.cancel_join_thread()
+                self._inboxes[i] = self._ctx.Queue(maxsize=self._queue_size)
+                self.dropped += lost
+                self.logger.error(
+                    "Decode worker %d exited with code %s; restarting it (%d queued messages lost)",
+                    i,
+                    proc.exitcode,
+                    lost,
+                )
+                self._procs[i] = self._new_worker(i)
+                self._procs[i].start()
+                restarted += 1
+            self.restarts += restarted
+        return restarted
+
+    def pids(self) -> list[int]:
+        """Process ids of the running workers."""
+        return [proc.pid for proc in self._procs if proc.pid is not None and proc.is_alive()]
+
+    def submit(self, topic: str, payload: bytes, *, replayed: bool = False) -> bool:
+        """Hands a raw message to the worker that owns its source node.
+
+        A replayed message (from the spool or a capture) waits for room however
+        long it takes instead of being dropped after a second.
+        """
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + _CHECK_INTERVAL
+            self.check_workers()
+        inbox = self._inboxes[peek_source(payload) % self.workers]
+        try:
+            inbox.put((topic, bytes(payload), replayed), timeout=None if replayed else 1.0)
+        except queue.Full:
+            self.dropped += 1
+            self.logger.warning("Decode queue full, dropping message from %s", topic)
+            return False
+        self.submitted += 1
+        return True
+
+    def barrier(self) -> int:
+        """Queues a barrier behind every message submitted so far; see wait_barrier."""
+        self._barriers += 1
+        barrier = Barrier(self._barriers)
+        for inbox in self._inboxes:
+            inbox.put(barrier)
+        return barrier.barrier_id
+
+    def wait_barrier(self, barrier_id: int, timeout: float | None = None) -> bool:
+        """Waits until every worker has passed the barrier.
+
+        By then all messages submitted before it are decoded and their rows
+        handed to on_rows.  A worker that dies first loses the barrier along
+        with its queued messages, so this then times out.
+        """
+        with self._echoed:
+            done = self._echoed.wait_for(
+                lambda: self._echoes.get(barrier_id, 0) >= self.workers, timeout
+            )
+            if done:
+                del self._echoes[barrier_id]
+            return done
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Drains the workers, waits for their last results and shuts them down."""
+        # a dead worker would never read its _STOP, nor send one to the collector
+        self.check_workers()
+        for inbox in self._inboxes:
+            inbox.put(_STOP)
+        for proc in self._procs:
+            proc.join(timeout)
+        self._collector.join(timeout)
+
+    @property
+    def dedup_hit_rate(self) -> float:
+        """Share of the workers' dedup lookups that were repeat receptions."""
+        hits = sum(h for h, _ in self._dedup.values())
+        lookups = hits + sum(m for _, m in self._dedup.values())
+        return hits / lookups if lookups else 0.0
+
+    def _collect(self) -> None:
+        stopped = 0
+        while stopped < self.workers:
+            rows = self._outbox.get()
+            if rows is _STOP:
+                stopped += 1
+                continue
+            if isinstance(rows, WorkerReport):
+                self._dedup[rows.worker_id] = (rows.dedup_hits, rows.dedup_misses)
+                if self.metrics is not None and rows.metrics is not None:
+                    self.metrics.merge_decode(rows.metrics)
+                continue
+            if isinstance(rows, Barrier):
+                with self._echoed:
+                    self._echoes[rows.barrier_id] = self._echoes.get(rows.barrier_id, 0) + 1
+                    self._echoed.notify_all()
+                continue
+            if isinstance(rows, Replayed):
+                self.on_rows(rows.rows, replayed=True)
+                continue
+            self.on_rows(rows)
@@ -0,0 +1,366 @@
+"""Packet decoding.
+
+This module turns a raw MQTT (topic, payload) into the database rows it
+should produce: ServiceEnvelope parse, de-duplication, AES-CTR decryption,
+Data parse and the per-portnum payload parse.  Packets from the JSON feed
+are parsed once and mapped onto the same messages (see json_packets).  It holds no database or MQTT
+state, so it can run on the MQTT thread or inside a decode worker process.
+"""
+
+# pylint: disable=E0401
+# pylint: disable=R0911
+# pylint: disable=R0912
+# pylint: disable=W0718
+
+import json
+import logging
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Any
+
+from google.protobuf.message import DecodeError, Message
+
+from . import channels, db_functions, dedup, json_packets, metrics, protos
+from .protos import mesh_pb2, mqtt_pb2, portnums_pb2
+
+if TYPE_CHECKING:
+    from .profiling import PacketTracer
+
+# A decoded packet yields a list of (table, row) pairs for the batch writer; each
+# row is one of the compact records in records.py, never a protobuf message, and
+# the table says which.
+Rows = list[tuple[str, Any]]
+
+PROTOBUF = "protobuf"
+JSON = "json"
+
+_JSON_START = ord("{")
+
+
+def classify(topic: str, payload: bytes) -> str:
+    """Tells protobuf from JSON payloads by topic and first byte, without parsing.
+
+    msh/.../e/... topics carry ServiceEnvelopes and msh/.../json/... topics
+    carry JSON; anything else (map reports, custom roots) is JSON only if it
+    starts with "{", which a serialized ServiceEnvelope never does.
+    """
+    if "/e/" in topic:
+        return PROTOBUF
+    if "/json/" in topic or (payload and payload[0] == _JSON_START):
+        return JSON
+    return PROTOBUF
+
+
+class PacketDecoder:
+    """Decodes MQTT ServiceEnvelope payloads into table rows."""
+
+    MIN_MSG_LEN = 10
+
+    def __init__(
+        self,
+        keys: channels.ChannelKeys,
+        dedup_cache: dedup.DedupCache,
+        logger: logging.Logger,
+        *,
+        pipeline_metrics: metrics.PipelineMetrics | None = None,
+        log_every: int = 0,
+    ) -> None:
+        """Initialization function for PacketDecoder.
+
+        Args:
+            keys: channel keys used to decrypt channel traffic.
+            dedup_cache: cache used to recognise repeat receptions.
+            logger: logger for per-packet and error messages.
+            pipeline_metrics: if given, stage timings and counters are recorded here.
+            log_every: log one in this many packets at info level (0: none; the
+                per-portnum totals are still logged by log_stats).
+        """
+        self.keys = keys
+        self.dedup = dedup_cache
+        self.logger = logger
+        self.metrics = pipeline_metrics
+        self.log_every = log_every
+        self.decoded = 0
+        self.port_counts: Counter[str] = Counter()
+        # set by profiling.Profiler for the length of a profiling window
+        self.tracer: PacketTracer | None = None
+        self._stages: dict[str, float] | None = None
+
+    def log_stats(self) -> None:
+        """Logs the dedup and channel counters and the packets seen per portnum since last time."""
+        if self.port_counts:
+            summary = " ".join(f"{name}={n}" for name, n in self.port_counts.most_common())
+            self.logger.info("packets: %s", summary)
+            self.port_counts.clear()
+        c = self.keys.stats
+        if c.unknown or c.suppressed or c.failures:
+            self.logger.info(
+                "channels: unknown=%d suppressed=%d undecryptable=%d",
+                c.unknown,
+                c.suppressed,
+                c.failures,
+            )
+        s = self.dedup.stats
+        self.logger.info(
+            "dedup: entries=%d hits=%d misses=%d hit_rate=%.2f expired=%d evicted=%d",
+            len(self.dedup),
+            s.hits,
+            s.misses,
+            s.hit_rate,
+            s.expired,
+            s.evicted,
+        )
+
+    def _stage(self, stage: str, seconds: float) -> None:
+        if self.metrics is not None:
+            self.metrics.stage_seconds.observe(seconds, stage)
+        if self._stages is not None:
+            self._stages[stage] = seconds
+
+    def decode(self, topic: str, payload: bytes) -> Rows:
+        """Decodes one MQTT message into the rows it should write."""
+        tracer = self.tracer
+        if tracer is None:
+            return self._decode(topic, payload)
+        stages: dict[str, float] = {}
+        self._stages = stages
+        start = time.perf_counter()
+        try:
+            rows = self._decode(topic, payload)
+        finally:
+            self._stages = None
+        tracer.record(time.perf_counter() - start, topic, rows, stages)
+        return rows
+
+    def _decode(self, topic: str, payload: bytes) -> Rows:  # noqa: C901, PLR0911, PLR0912, PLR0915
+        rows: Rows = []
+        if len(payload) < self.MIN_MSG_LEN:
+            return rows
+        if classify(topic, payload) == JSON:
+            return self.decode_json(topic, payload)
+        m = self.metrics
+        timed = m is not None or self._stages is not None
+        self.logger.debug("==================================================")
+        self.logger.debug("%r", payload)
+        if timed:
+            t0 = time.perf_counter()
+        service_envelope = mqtt_pb2.ServiceEnvelope()
+        try:
+            service_envelope.ParseFromString(payload)
+        except Exception as e:
+            if m is not None:
+                m.decode_failures.inc("envelope_parse")
+            estr = f"Exception in initial Service Envelope decode: {e}\n{payload!r}"
+            self.logger.exception(estr)
+            return rows
+        if timed:
+            self._stage("envelope_parse", time.perf_counter() - t0)
+        msg_pkt = service_envelope.packet
+        pkt_id = msg_pkt.id
+        source = getattr(msg_pkt, "from")
+        dest = msg_pkt.to
+        relay_node = msg_pkt.relay_node
+        seen_portnum = self.dedup.lookup(source, pkt_id)
+        if seen_portnum is not None:
+            if m is not None:
+                m.duplicates.inc()
+                m.packets.inc(
+                    portnums_pb2.PortNum.Name(seen_portnum),
+                    service_envelope.gateway_id or topic.rsplit("/", 1)[-1],
+                )
+            # repeat reception via another gateway: only the reception itself is new,
+            # so skip the decrypt and payload parse and record just the mesh_packets row
+            if seen_portnum != portnums_pb2.MAP_REPORT_APP:
+                row = db_functions.mesh_packet_row(
+                    service_envelope, seen_portnum, self._received(source, msg_pkt), repeat=True
+                )
+                rows.append(("mesh_packets", row))
+            return rows
+        if msg_pkt.encrypted is not None and len(msg_pkt.encrypted) >= self.MIN_MSG_LEN:
+            channel_id = service_envelope.channel_id
+            channel = self.keys.lookup(msg_pkt.channel, channel_id)
+            if channel is None:
+                if m is not None:
+                    m.decode_failures.inc("unknown_channel")
+                return rows
+            if timed:
+                t0 = time.perf_counter()
+            plain_text = channel.decrypt(pkt_id, source, msg_pkt.encrypted)
+            data = mesh_pb2.Data()
+            try:
+                data.ParseFromString(plain_text)
+            except DecodeError:
+                if m is not None:
+                    m.decode_failures.inc("decrypt")
+                self.keys.failed(msg_pkt.channel, channel_id)
+                self.logger.debug("Undecryptable packet on %s: %r", channel_id, plain_text)
+                return rows
+            self.keys.decoded(msg_pkt.channel, channel_id)
+            if timed:
+                self._stage("decrypt", time.perf_counter() - t0)
+            msg_pkt.decoded.CopyFrom(data)
+        # we don't care to store map_report msgs, because they are locally generated and
+        # will violate the unique key of the mesh_packets table.  We'll deal with them
+        # separately
+        portnum = msg_pkt.decoded.portnum
+        portname = portnums_pb2.PortNum.Name(portnum)
+        # as for the JSON feed: the envelope's gateway, else the last topic level
+        gateway_id = service_envelope.gateway_id or topic.rsplit("/", 1)[-1]
+        self.port_counts[portname] += 1
+        if m is not None:
+            m.packets.inc(portname, gateway_id)
+        self.dedup.add(source, pkt_id, portnum)
+        if portname != "MAP_REPORT_APP":
+            row = db_functions.mesh_packet_row(
+                service_envelope, received=self._received(source, msg_pkt)
+            )
+            rows.append(("mesh_packets", row))
+            self.decoded += 1
+            if self.log_every and self.decoded % self.log_every == 0:
+                self.logger.info(
+                    "on %s: %s from GW %s source %s->%s", topic, portname, gateway_id, source, dest
+                )
+        if portnum not in protos.PAYLOAD_TYPES:
+            return rows
+        payload_type = protos.PAYLOAD_TYPES[portnum]
+        pb = None
+        if payload_type is not None:
+            if timed:
+                t0 = time.perf_counter()
+            pb = payload_type()
+            try:
+                pb.ParseFromString(msg_pkt.decoded.payload)
+            except Exception:
+                if m is not None:
+                    m.decode_failures.inc("payload_parse")
+                self.logger.exception("Unable to parse Service Envelope")
+                return rows
+            if timed:
+                self._stage("payload_parse", time.perf_counter() - t0)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "Received from: %s:  %s->%s:  %s relayed by %s",
+                gateway_id,
+                db_functions.id_to_hex(source),
+                db_functions.id_to_hex(dest),
+                portname,
+                hex(relay_node),
+            )
+
+        if timed:
+            t0 = time.perf_counter()
+        rows.extend(self.payload_rows(msg_pkt, pb))
+        if timed:
+            self._stage("rows", time.perf_counter() - t0)
+        return rows
+
+    def decode_json(self, topic: str, payload: bytes) -> Rows:  # noqa: C901
+        """Decodes one message from the JSON feed into the rows it should write."""
+        rows: Rows = []
+        m = self.metrics
+        timed = m is not None or self._stages is not None
+        if timed:
+            t0 = time.perf_counter()
+        try:
+            packet = json.loads(payload)
+        except ValueError:
+            if m is not None:
+                m.decode_failures.inc("json_parse")
+            self.logger.warning("Undecodable JSON on %s", topic)
+            return rows
+        try:
+            decoded = (
+                json_packets.envelope_from_json(packet, topic) if isinstance(packet, dict) else None
+            )
+        except (TypeError, ValueError, OverflowError) as e:
+            if m is not None:
+                m.decode_failures.inc("json_parse")
+            self.logger.warning("Malformed JSON packet on %s: %s", topic, e)
+            return rows
+        if timed:
+            self._stage("json_parse", time.perf_counter() - t0)
+        if decoded is None:
+            return rows
+        service_envelope, pb = decoded
+        msg_pkt = service_envelope.packet
+        source = getattr(msg_pkt, "from")
+        portnum = msg_pkt.decoded.portnum
+        seen_portnum = self.dedup.lookup(source, msg_pkt.id)
+        if seen_portnum is not None:
+            if m is not None:
+                m.duplicates.inc()
+                m.packets.inc(portnums_pb2.PortNum.Name(portnum), service_envelope.gateway_id)
+            row = db_functions.mesh_packet_row(
+                service_envelope, portnum, self._received(source, msg_pkt), repeat=True
+            )
+            rows.append(("mesh_packets", row))
+            return rows
+        portname = portnums_pb2.PortNum.Name(portnum)
+        self.port_counts[portname] += 1
+        if m is not None:
+            m.packets.inc(portname, service_envelope.gateway_id)
+        self.dedup.add(source, msg_pkt.id, portnum)
+        row = db_functions.mesh_packet_row(
+            service_envelope, received=self._received(source, msg_pkt)
+        )
+        rows.append(("mesh_packets", row))
+        if timed:
+            t0 = time.perf_counter()
+        rows.extend(self.payload_rows(msg_pkt, pb))
+        if timed:
+            self._stage("rows", time.perf_counter() - t0)
+        return rows
+
+    def _received(self, source: int, msg_pkt: mesh_pb2.MeshPacket) -> int | None:
+        """A stable toi for a reception without a usable rx_time: when the packet was first seen."""
+        return self.dedup.first_seen(source, msg_pkt.id)
+
+    def payload_rows(self, msg_pkt: mesh_pb2.MeshPacket, pb: Message | None) -> Rows:  # noqa: C901
+        """Builds the payload-table rows for a decoded, de-duplicated packet."""
+        rows: Rows = []
+        source = getattr(msg_pkt, "from")
+        toi = db_functions.packet_toi(msg_pkt.rx_time, self._received(source, msg_pkt))
+        pkt_id = msg_pkt.id
+        try:
+            if isinstance(pb, mesh_pb2.User):
+                rows.append(("node_infos", db_functions.nodeinfo_row(source, pb, toi)))
+
+            if isinstance(pb, mesh_pb2.Position):
+                row = db_functions.position_row(source, pb, toi)
+                if row is not None:
+                    rows.append(("node_positions", row))
+
+            if isinstance(pb, mesh_pb2.NeighborInfo):
+                rows.extend(
+                    ("neighbor_info", row)
+                    for row in db_functions.neighbor_info_rows(source, pb, toi)
+                )
+
+            if msg_pkt.decoded.portnum == portnums_pb2.TELEMETRY_APP:
+                table_row = db_functions.telemetry_row(source, pkt_id, toi, pb)
+                if table_row is not None:
+                    rows.append(table_row)
+
+            if msg_pkt.decoded.portnum == portnums_pb2.ROUTING_APP:
+                route = mesh_pb2.Routing()
+                route.ParseFromString(msg_pkt.decoded.payload)
+                self.logger.debug(route)
+
+            if msg_pkt.decoded.portnum == portnums_pb2.TEXT_MESSAGE_APP:
+                text_message = msg_pkt.decoded.payload.decode("utf-8")
+                rows.append(
+                    (
+                        "text_messages",
+                        db_functions.text_message_row(
+                            source, msg_pkt.to, pkt_id, toi, text_message
+                        ),
+                    )
+                )
+
+            if msg_pkt.decoded.portnum == portnums_pb2.MAP_REPORT_APP:
+                map_report = mqtt_pb2.MapReport()
+                map_report.ParseFromString(msg_pkt.decoded.payload)
+
+        except DecodeError:
+            self.logger.exception("Failed to decode an on air message.  Punting on it.")
+        return rows
@@ -0,0 +1,113 @@
+"""Packet de-duplication.
+
+Every gateway that hears a packet republishes it to MQTT, so the same
+(source, packet_id) arrives many times.  This module keeps a bounded,
+time-limited record of recently seen packets so that repeat receptions can be
+recognised straight after the envelope parse, before any decryption or
+payload parsing is done.
+"""
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+
+@dataclass
+class DedupStats:
+    """Counters kept by the dedup cache."""
+
+    hits: int = 0
+    misses: int = 0
+    expired: int = 0
+    evicted: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups that found a recently seen packet."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class DedupCache:
+    """LRU/TTL cache of recently seen (source, packet_id) pairs.
+
+    Entries are kept in insertion order, which is also expiry order, so both
+    TTL expiry and the size cap only ever trim from the front.  Keys are packed
+    into a single int (source << 32 | packet_id) to keep per-entry overhead down
+    on meshes with very large node counts.
+    """
+
+    def __init__(self, max_entries: int = 100000, ttl: float = 600.0) -> None:
+        """Initialization function for DedupCache.
+
+        Args:
+            max_entries: hard cap on remembered packets; the oldest are evicted first.
+            ttl: seconds after first reception for which repeats are treated as duplicates.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = DedupStats()
+        self._entries: OrderedDict[int, tuple[float, int]] = OrderedDict()
+        # fixed once, so that first_seen gives the same answer for as long as an entry lives
+        self._wall_offset = time.time() - time.monotonic()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "DedupCache":
+        """Builds a DedupCache from the [dedup] section of mesh_persist.ini."""
+        return cls(
+            max_entries=int(config.get("max_entries", 100000)),
+            ttl=float(config.get("ttl", 600.0)),
+        )
+
+    def __len__(self) -> int:
+        """Number of packets currently remembered."""
+        return len(self._entries)
+
+    @staticmethod
+    def _key(source: int, packet_id: int) -> int:
+        return (source << 32) | packet_id
+
+    def lookup(self, source: int, packet_id: int) -> int | None:
+        """Checks for a repeat reception.
+
+        Returns:
+            The portnum recorded when the packet was first decoded, or None if the
+            packet has not been seen within the TTL.
+        """
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._entries.get(self._key(source, packet_id))
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return entry[1]
+
+    def first_seen(self, source: int, packet_id: int) -> int | None:
+        """Wall-clock time, in whole seconds, at which a remembered packet was first decoded.
+
+        Returns:
+            None if the packet is not remembered.
+        """
+        entry = self._entries.get(self._key(source, packet_id))
+        if entry is None:
+            return None
+        return int(entry[0] - self.ttl + self._wall_offset)
+
+    def add(self, source: int, packet_id: int, portnum: int) -> None:
+        """Records a newly decoded packet and its portnum."""
+        key = self._key(source, packet_id)
+        self._entries[key] = (time.monotonic() + self.ttl, portnum)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evicted += 1
+
+    def _expire(self, now: float) -> None:
+        entries = self._entries
+        while entries:
+            key, (expires, _) = next(iter(entries.items()))
+            if expires > now:
+                break
+            del entries[key]
+            self.stats.expired += 1
@@ -0,0 +1,147 @@
+"""Meshtastic JSON MQTT packets.
+
+Gateways with JSON output enabled publish already-decoded packets on
+msh/<region>/2/json/<channel>/<gateway>.  This module maps those objects
+back onto the protobuf messages the protobuf path produces (a ServiceEnvelope
+with a decoded MeshPacket, plus the parsed payload message), so both feeds
+share the dedup cache, the row builders and the batched write path.
+
+The feed is untrusted: a value of the wrong type or out of range for its
+protobuf field makes envelope_from_json raise, and the decoder counts and
+skips the message.
+"""
+
+# pylint: disable=E0401
+
+from google.protobuf.message import Message
+
+from .db_functions import hex_to_id
+from .protos import mesh_pb2, mqtt_pb2, portnums_pb2, telemetry_pb2
+
+# JSON "type" -> portnum
+JSON_TYPES = {
+    "text": portnums_pb2.TEXT_MESSAGE_APP,
+    "nodeinfo": portnums_pb2.NODEINFO_APP,
+    "position": portnums_pb2.POSITION_APP,
+    "telemetry": portnums_pb2.TELEMETRY_APP,
+    "neighborinfo": portnums_pb2.NEIGHBORINFO_APP,
+    "traceroute": portnums_pb2.TRACEROUTE_APP,
+    "waypoint": portnums_pb2.WAYPOINT_APP,
+    "detection": portnums_pb2.DETECTION_SENSOR_APP,
+    "remotehardware": portnums_pb2.REMOTE_HARDWARE_APP,
+}
+
+# JSON nodeinfo keys that don't match the User field names
+_USER_KEYS = {"longname": "long_name", "shortname": "short_name", "hardware": "hw_model"}
+
+# A telemetry payload carries one variant; it is recognised by a key unique to it.
+_TELEMETRY_VARIANTS = (
+    ("device_metrics", telemetry_pb2.DeviceMetrics, ("battery_level", "uptime_seconds")),
+    (
+        "environment_metrics",
+        telemetry_pb2.EnvironmentMetrics,
+        ("temperature", "relative_humidity", "barometric_pressure"),
+    ),
+    ("power_metrics", telemetry_pb2.PowerMetrics, ("ch1_voltage", "ch1_current")),
+    ("air_quality_metrics", telemetry_pb2.AirQualityMetrics, ("pm10_standard", "pm25_standard")),
+)
+
+
+def fill(message, values: dict, renames: dict[str, str] | None = None) -> Message:
+    """Copies the scalar keys of values that name a field of message; ignores the rest."""
+    fields = message.DESCRIPTOR.fields_by_name
+    for key, value in values.items():
+        name = renames.get(key, key) if renames else key
+        field = fields.get(name)
+        if field is None or field.message_type is not None or isinstance(value, (list, dict)):
+            continue
+        try:
+            setattr(message, name, value)
+        except (TypeError, ValueError):
+            continue
+    return message
+
+
+def payload_message(portnum: int, payload: dict) -> Message | None:
+    """Builds the protobuf payload message for a JSON payload object, if it has one."""
+    if portnum == portnums_pb2.NODEINFO_APP:
+        return fill(mesh_pb2.User(), payload, _USER_KEYS)
+    if portnum == portnums_pb2.POSITION_APP:
+        return fill(mesh_pb2.Position(), payload)
+    if portnum == portnums_pb2.NEIGHBORINFO_APP:
+        info = mesh_pb2.NeighborInfo()
+        fill(info, payload)
+        neighbors = payload.get("neighbors")
+        for neighbor in neighbors if isinstance(neighbors, list) else ():
+            if isinstance(neighbor, dict):
+                fill(info.neighbors.add(), neighbor)
+        return info
+    if portnum == portnums_pb2.TELEMETRY_APP:
+        telem = telemetry_pb2.Telemetry(time=int(payload.get("time", 0)))
+        for variant, cls, markers in _TELEMETRY_VARIANTS:
+            if any(k in payload for k in markers):
+                getattr(telem, variant).CopyFrom(fill(cls(), payload))
+                break
+        return telem
+    return None
+
+
+def gateway_id(sender: object, topic_gateway: str) -> str:
+    """The reporting gateway: the packet's sender, else the last topic level.
+
+    Raises:
+        ValueError: neither is a node id ("!" and hex digits).
+    """
+    for candidate in (sender, topic_gateway):
+        if not isinstance(candidate, str) or not candidate:
+            continue
+        try:
+            hex_to_id(candidate)
+        except ValueError:
+            continue
+        return candidate
+    msg = f"no gateway node id in sender {sender!r} or topic level {topic_gateway!r}"
+    raise ValueError(msg)
+
+
+def envelope_from_json(
+    packet: dict, topic: str
+) -> tuple[mqtt_pb2.ServiceEnvelope, Message | None] | None:
+    """Maps a JSON packet onto a ServiceEnvelope and its parsed payload message.
+
+    Returns None for packet types that aren't stored (or aren't packets at all,
+    like the "sendtext" downlink requests).
+
+    Raises:
+        TypeError: a field has a value of the wrong type (null, a list...).
+        ValueError: a value is out of range for its field, or there is no gateway id.
+        OverflowError: a number is too large for a float.
+    """
+    portnum = JSON_TYPES.get(packet.get("type", ""))
+    if portnum is None or "from" not in packet or "id" not in packet:
+        return None
+    payload = packet.get("payload")
+    mp = mesh_pb2.MeshPacket(
+        to=int(packet.get("to", 0xFFFFFFFF)),
+        id=int(packet["id"]),
+        rx_time=int(packet.get("timestamp", 0)),
+        rx_snr=float(packet.get("snr", 0.0)),
+        rx_rssi=int(packet.get("rssi", 0)),
+        hop_start=int(packet.get("hop_start", 0)),
+    )
+    setattr(mp, "from", int(packet["from"]))
+    if mp.hop_start and "hops_away" in packet:
+        mp.hop_limit = max(mp.hop_start - int(packet["hops_away"]), 0)
+    mp.decoded.portnum = portnum
+    pb = None
+    if isinstance(payload, dict):
+        if portnum == portnums_pb2.TEXT_MESSAGE_APP:
+            mp.decoded.payload = str(payload.get("text", "")).encode("utf-8")
+        else:
+            pb = payload_message(portnum, payload)
+    # msh/<region>/2/json/<channel>/<gateway>
+    parts = topic.split("/")
+    channel = parts[-2] if len(parts) >= 2 else ""  # noqa: PLR2004
+    gateway = gateway_id(packet.get("sender"), parts[-1])
+    envelope = mqtt_pb2.ServiceEnvelope(packet=mp, channel_id=channel, gateway_id=gateway)
+    return envelope, pb
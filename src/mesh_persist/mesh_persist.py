@@ -14,51 +14,43 @@ persists specific types of messages to the database.
 # pylint: disable=W0613
 # pylint: disable=W0718
 
-import json
+import argparse
 import logging
+import os
 import sys
-from typing import Any, ClassVar
-
-import paho
-import paho.mqtt.client as mqtt
-from Crypto.Cipher import AES
-from google.protobuf.message import DecodeError
-from meshtastic import mesh_pb2, mqtt_pb2, portnums_pb2, protocols
+import threading
+import time
+from typing import TYPE_CHECKING, Any
+
+import paho.mqtt.client
+import psycopg2
+
+from . import batch_writer, channels, db_functions, decoder, dedup, metrics, mqtt_session
+from .config_load import instance_id, read_config
+
+if TYPE_CHECKING:
+    # optional subsystems, imported when their section enables them
+    from . import (
+        backpressure,
+        capture,
+        decode_pool,
+        node_status,
+        partitions,
+        profiling,
+        rollups,
+        spool,
+    )
 
-from . import db_functions
-from .config_load import load_config
+ENGINES = ("threaded", "async")
 
 
 class MeshPersist:
     """Main class for the meshtastic MQTT->DB gateway."""
 
-    key = bytearray(
-        [
-            0xD4,
-            0xF1,
-            0xBB,
-            0x3A,
-            0x20,
-            0x29,
-            0x07,
-            0x59,
-            0xF0,
-            0xBC,
-            0xFF,
-            0xAB,
-            0xCF,
-            0x4E,
-            0x69,
-            0x01,
-        ]
-    )
-    MIN_MSG_LEN = 10
-    msg_queue: ClassVar[list[Any]] = []
     debug = False
 
     def __init__(self) -> None:
         """Initialization function for MeshPersist."""
-        self.last_msg: dict[int, int] = {}
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
         ch = logging.StreamHandler(sys.stdout)
@@ -66,18 +58,46 @@ class MeshPersist:
         formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
         ch.setFormatter(formatter)
         self.logger.addHandler(ch)
-        self.db = db_functions.DbFunctions(self.logger)
-
-    def is_json(self, teststr) -> bool:
-        """Tests to see if teststr is a json object."""
-        try:
-            j = json.loads(teststr)
-            self.logger.debug(json.dumps(j, indent=4))
-        except ValueError:
-            return False
-        return True
+        self.db: db_functions.DbFunctions | None = None
+        self.writer: batch_writer.BatchWriter | None = None
+        self.pool: decode_pool.DecodePool | None = None
+        self.spool: spool.Spool | None = None
+        self.replayer: spool.SpoolReplayer | None = None
+        self.spool_watermark = 0.9
+        self._replay_barrier: int | None = None
+        self._replay_restarts = 0
+        self.capture: capture.CaptureWriter | None = None
+        self.maintainer: partitions.PartitionMaintainer | None = None
+        self.node_status: node_status.NodeStatusTracker | None = None
+        self.rollups: rollups.GatewayRollups | None = None
+        self.shedder: backpressure.LoadShedder | None = None
+        self.profiler: profiling.Profiler | None = None
+        self.config = read_config()
+        self.instance_id = instance_id(self.config.section("persist"))
+        self._decode_lock = threading.Lock()
+        self.dedup_config = self.config.section("dedup")
+        metrics_config = self.config.section("metrics")
+        self.metrics = metrics.from_config(metrics_config, self.logger)
+        self.channel_config = self.config.section("channels")
+        self.decoder = decoder.PacketDecoder(
+            channels.ChannelKeys.from_config(self.channel_config, self.logger),
+            dedup.DedupCache.from_config(self.dedup_config),
+            self.logger,
+            pipeline_metrics=self.metrics,
+            log_every=self.config.get_int("metrics", "log_every", 0),
+        )
+        if self.metrics is not None:
+            dedup_stats = self.decoder.dedup.stats
+            # with decode workers, dedup happens in them
+            self.metrics.add_gauge(
+                "mesh_persist_dedup_hit_ratio",
+                "Share of dedup lookups that were repeat receptions.",
+                lambda: dedup_stats.hit_rate if self.pool is None else self.pool.dedup_hit_rate,
+            )
+        self.stats_interval = 60.0
+        self._next_stats = time.monotonic() + self.stats_interval
 
-    def on_message(  # noqa: C901  PLR0911 PLR0912 PLR0915
+    def on_message(
         self,
         client: paho.mqtt.client.Client,
         userdata: dict[Any, Any],
@@ -85,137 +105,93 @@ class MeshPersist:
         properties=None,
     ) -> None:
         """Callback function when message received from MQTT server."""
-        if len(message.payload) < self.MIN_MSG_LEN:
+        if self.capture is not None:
+            self.capture.write(message.topic, message.payload)
+        self.ingest(message.topic, message.payload)
+
+    def ingest(self, topic: str, payload: bytes) -> None:
+        """Routes one raw message to the spool, the decode workers or the inline decoder."""
+        if self.spool is not None and self._should_spool():
+            self.spool.append(topic, payload)
             return
-        if self.is_json(message.payload):
-            self.logger.debug("Got a JSON payload")
+        if self.pool is not None:
+            self.pool.submit(topic, payload)
             return
-        self.logger.debug("==================================================")
-        self.logger.debug(str(message.payload))
-        service_envelope = mqtt_pb2.ServiceEnvelope()
-        if service_envelope is not None:
-            try:
-                service_envelope.ParseFromString(message.payload)
-            except Exception as e:
-                estr = f"Exception in initial Service Envelope decode: {e}\n{message.payload!r}"
-                self.logger.exception(estr)
-                return
-        else:
-            return
-        msg_pkt = service_envelope.packet
-        toi = msg_pkt.rx_time
-        pkt_id = msg_pkt.id
-        source = getattr(msg_pkt, "from")
-        dest = msg_pkt.to
-        relay_node = msg_pkt.relay_node
-        if msg_pkt.encrypted is not None and len(msg_pkt.encrypted) >= self.MIN_MSG_LEN:
-            nonce = pkt_id.to_bytes(8, "little") + source.to_bytes(7, "little")
-            decrypt_cipher = AES.new(self.key, AES.MODE_CTR, nonce=bytearray(nonce))
-            plain_text = decrypt_cipher.decrypt(bytearray(msg_pkt.encrypted))
-            data = mesh_pb2.Data()
-            try:
-                data.ParseFromString(plain_text)
-            except Exception as e:
-                estr = f"Error parsing plain text: {e}\n{plain_text!r}"
-                self.logger.exception(estr)
-                return
-            msg_pkt.decoded.CopyFrom(data)
-        # we don't care to store map_report msgs, because they are locally generated and
-        # will violate the unique key of the mesh_packets table.  We'll deal with them
-        # separately
-        portnum = msg_pkt.decoded.portnum
-        portname = portnums_pb2.PortNum.Name(portnum)
-        gw_from_topic = message.topic.split("/")
-        gateway_id = gw_from_topic[-1]
-        if portnums_pb2.PortNum.Name(portnum) != "MAP_REPORT_APP" and not self.debug:
-            self.db.insert_mesh_packet(service_envelope=service_envelope)
-            logline = (
-                "on "
-                + message.topic
-                + ": "
-                + str(portname)
-                + " from GW "
-                + str(gateway_id)
-                + " source "
-                + str(source)
-                + "->"
-                + str(dest)
-            )
-            self.logger.info(logline)
-        if source in self.last_msg and self.last_msg[source] == pkt_id:
+        if time.monotonic() >= self._next_stats:
+            self.decoder.log_stats()
+            self._next_stats = time.monotonic() + self.stats_interval
+        self.decode_and_submit(topic, payload)
+
+    def decode_and_submit(self, topic: str, payload: bytes) -> None:
+        """Decodes a message on the calling thread and queues its rows."""
+        with self._decode_lock:
+            rows = self.decoder.decode(topic, payload)
+        self.submit_rows(rows)
+
+    def replay_message(self, topic: str, payload: bytes) -> None:
+        """Decodes a spooled or captured message and queues its rows, never dropping them."""
+        if self.pool is not None:
+            self.pool.submit(topic, payload, replayed=True)
             return
-        self.last_msg[source] = pkt_id
-        handler = protocols.get(msg_pkt.decoded.portnum)
-        if isinstance(handler, (str, type(None))) or handler is None:
-            return
-        if handler.protobufFactory is not None:
-            pb = handler.protobufFactory()
-            try:
-                pb.ParseFromString(msg_pkt.decoded.payload)
-            except Exception:
-                self.logger.exception("Unable to parse Service Envelope")
-                return
-        dbg = (
-            "Received from: "
-            + gateway_id
-            + ":  "
-            + db_functions.id_to_hex(source)
-            + "->"
-            + db_functions.id_to_hex(dest)
-            + ":  "
-            + portnums_pb2.PortNum.Name(portnum)
-            + " relayed by "
-            + str(hex(relay_node))
-        )
-        self.logger.debug(dbg)
+        with self._decode_lock:
+            rows = self.decoder.decode(topic, payload)
+        self.submit_rows(rows, replayed=True)
 
-        self.msg_queue.append(msg_pkt)
+    def _should_spool(self) -> bool:
+        """Spool while the DB is down, the writer is backed up, or a backlog remains.
 
-        if not self.db.test_connection() or self.debug:
-            return
-
-        while len(self.msg_queue) > 0:
-            msg_pkt = self.msg_queue.pop(0)
+        Once anything is spooled, new messages keep going to the spool until the
+        replayer has caught up, so packets are persisted in arrival order.
+        """
+        if self.spool is None or self.writer is None:
+            return False
+        return (
+            self.spool.has_backlog()
+            or not self.writer.healthy
+            or not self.writer.has_room(self.spool_watermark)
+        )
 
-            try:
-                if not msg_pkt.decoded:
-                    self.logger.warning("Encrypted packets not yet handled.")
-                    return
-                if msg_pkt.decoded.portnum == portnums_pb2.NODEINFO_APP:
-                    self.db.insert_nodeinfo(from_node=source, nodeinfo=pb, toi=toi)
-
-                if msg_pkt.decoded.portnum == portnums_pb2.POSITION_APP:
-                    self.db.insert_position(from_node=source, pos=pb, toi=toi)
-
-                if msg_pkt.decoded.portnum == portnums_pb2.NEIGHBORINFO_APP:
-                    self.db.insert_neighbor_info(from_node=source, neighbor_info=pb, rx_time=toi)
-
-                if msg_pkt.decoded.portnum == portnums_pb2.TELEMETRY_APP:
-                    self.db.insert_telemetry(
-                        from_node=source, packet_id=pkt_id, rx_time=toi, telem=pb
-                    )
-
-                if msg_pkt.decoded.portnum == portnums_pb2.ROUTING_APP:
-                    route = mesh_pb2.Routing()
-                    route.ParseFromString(msg_pkt.decoded.payload)
-                    self.logger.debug(route)
-
-                if msg_pkt.decoded.portnum == portnums_pb2.TEXT_MESSAGE_APP:
-                    text_message = msg_pkt.decoded.payload.decode("utf-8")
-                    self.db.insert_text_message(
-                        from_node=source,
-                        to_node=dest,
-                        packet_id=pkt_id,
-                        rx_time=toi,
-                        body=text_message,
-                    )
-
-                if msg_pkt.decoded.portnum == portnums_pb2.MAP_REPORT_APP:
-                    map_report = mqtt_pb2.MapReport()
-                    map_report.ParseFromString(msg_pkt.decoded.payload)
-
-            except DecodeError:
-                self.logger.exception("Failed to decode an on air message.  Punting on it.")
+    def _replay_ready(self) -> bool:
+        return self.writer is not None and self.writer.healthy and self.writer.has_room(0.5)
+
+    def _wait_replay_flushed(self, timeout: float) -> bool:
+        if self.writer is None:
+            return True
+        pool = self.pool
+        if pool is not None:
+            # nothing else notices a dead worker while live traffic goes to the spool
+            pool.check_workers()
+            if pool.restarts != self._replay_restarts:
+                from . import spool  # noqa: PLC0415  optional subsystem
+
+                self._replay_restarts = pool.restarts
+                self._replay_barrier = None
+                msg = "a decode worker died, possibly holding replayed messages"
+                raise spool.ReplayAbortedError(msg)
+            # the replayed messages have to be decoded before their rows can be waited on
+            if self._replay_barrier is None:
+                self._replay_barrier = pool.barrier()
+            if not pool.wait_barrier(self._replay_barrier, timeout):
+                return False
+            self._replay_barrier = None
+        return self.writer.wait_flushed(self.writer.stats.rows_submitted, timeout)
+
+    def submit_rows(self, rows: decoder.Rows, *, replayed: bool = False) -> None:
+        """Hands decoded rows to the write-behind queue (unless running in debug mode).
+
+        Rows replayed from the spool are neither shed nor dropped when the queue
+        is full: the spool offset is only committed once they are flushed.
+        """
+        if self.debug or self.writer is None:
+            return
+        if self.node_status is not None:
+            self.node_status.observe(rows)
+        if self.rollups is not None:
+            self.rollups.observe(rows)
+        if self.shedder is not None and not replayed:
+            rows = self.shedder.admit(rows)
+        for table, row in rows:
+            self.writer.submit(table, row, block=replayed)
 
     def on_connect(
         self,
@@ -226,15 +202,16 @@ class MeshPersist:
         properties=None,
     ) -> None:
         """Callback function on connection to MQTT server."""
-        config = client.user_data_get()
-        topic = config.get("topics")
-        log_msg = f"Connected, subscribing to {topic}..."
-        self.logger.info(log_msg)
-        topics = config.get("topics").split(",")
-        for topic in topics:
-            msg = f"Subscribing to {topic}"
-            self.logger.debug(msg)
-            client.subscribe(topic)
+        if reason_code.is_failure:
+            self.logger.error("MQTT connection refused: %s", reason_code)
+            return
+        settings: mqtt_session.MqttSettings = client.user_data_get()
+        if flags.session_present:
+            self.logger.info("Connected, resuming the broker's stored session")
+        subscriptions = settings.subscriptions
+        self.logger.info("Connected, subscribing to %s", ", ".join(t for t, _ in subscriptions))
+        # subscribing again is harmless when the broker kept the session
+        client.subscribe(subscriptions)
 
     def on_subscribe(
         self,
@@ -253,38 +230,338 @@ class MeshPersist:
         This is the primary entry point, and sets up an infinite loop waiting
         for messages from the MQTT broker
         """
-        self.logger.info("Starting mesh-persist.")
+        self.logger.info("Starting mesh-persist (instance %s).", self.instance_id)
         self.logger.debug("Loading MQTT config")
-        mqtt_config = load_config(filename="mesh_persist.ini", section="mqtt")
-        broker = str(mqtt_config.get("broker"))
-        broker_port = int(str(mqtt_config.get("port")))
-        broker_user = mqtt_config.get("user")
-        broker_pass = mqtt_config.get("pass")
+        settings = mqtt_session.MqttSettings.from_config(
+            self.config.section("mqtt", required=True), self.instance_id
+        )
 
-        self.db = db_functions.DbFunctions(self.logger)
+        self.start_pipeline()
+        self.start_spool()
 
         self.logger.debug("Initializing MQTT connection")
-        client = mqtt.Client(
-            mqtt.CallbackAPIVersion.VERSION2,
-            transport="tcp",
-            protocol=mqtt.MQTTv311,
-            clean_session=True,
-        )
-        client.username_pw_set(broker_user, broker_pass)
-        client.user_data_set(mqtt_config)
+        client = mqtt_session.paho_client(settings)
+        client.user_data_set(settings)
         client.on_message = self.on_message
         client.on_connect = self.on_connect
         client.on_subscribe = self.on_subscribe
 
-        client.connect(broker, port=broker_port, keepalive=60)
+        mqtt_session.connect_paho(client, settings)
 
         client.loop_forever()
 
+    def start_pipeline(self) -> None:
+        """Starts the DB writer and, if [decode] asks for them, the decode workers."""
+        if not self.debug:
+            self.db = db_functions.DbFunctions(self.logger, self.config)
+            writer_config = self.config.section("writer")
+            try:
+                self.db.warm_node_cache()
+            except psycopg2.Error as e:
+                self.logger.warning(
+                    "Could not warm the node cache: %s", db_functions.format_db_error(e)
+                )
+            self.writer = batch_writer.BatchWriter.from_config(self.db, self.logger, writer_config)
+            self.writer.start()
+            if self.config.enabled("backpressure"):
+                from . import backpressure  # noqa: PLC0415  optional subsystem
+
+                writer = self.writer
+                self.shedder = backpressure.LoadShedder.from_config(
+                    lambda: writer.fill,
+                    self.logger,
+                    self.config.section("backpressure"),
+                    self.metrics,
+                )
+            if self.metrics is not None:
+                self.db.metrics = self.metrics
+                self.add_writer_gauges(self.metrics, self.writer)
+            self.start_partition_maintenance(self.db)
+            if self.config.enabled("node_status"):
+                from . import node_status  # noqa: PLC0415  optional subsystem
+
+                self.node_status = node_status.NodeStatusTracker.from_config(
+                    self.db, self.logger, self.config.section("node_status")
+                )
+                self.node_status.start()
+            if self.config.enabled("rollups"):
+                from . import rollups  # noqa: PLC0415  optional subsystem
+
+                self.rollups = rollups.GatewayRollups.from_config(
+                    self.db, self.logger, self.config.section("rollups")
+                )
+                self.rollups.start()
+        workers = self.config.get_int("decode", "workers", 0)
+        if workers > 0:
+            from . import decode_pool  # noqa: PLC0415  optional subsystem
+
+            self.pool = decode_pool.DecodePool(
+                workers,
+                self.channel_config,
+                self.dedup_config,
+                self.submit_rows,
+                self.logger,
+                queue_size=self.config.get_int("decode", "queue_size", 10000),
+                profiling_config=self.config.section("profiling"),
+                pipeline_metrics=self.metrics,
+            )
+            self.pool.start()
+        self.start_profiler()
+
+    def start_profiler(self) -> None:
+        """Installs the profiling signal handler, if [profiling] enables it."""
+        if not self.config.enabled("profiling"):
+            return
+        from . import profiling  # noqa: PLC0415  optional subsystem
+
+        self.profiler = profiling.Profiler.from_config(
+            self.logger, self.config.section("profiling"), self.decoder
+        )
+        if self.pool is not None:
+            self.profiler.children = self.pool.pids
+        if self.profiler.install():
+            self.logger.info(
+                "Profiling: kill -%s %d", self.profiler.signal_name.removeprefix("SIG"), os.getpid()
+            )
+
+    def start_partition_maintenance(self, db: db_functions.DbFunctions) -> None:
+        """Starts the partition maintenance thread, if [partitions] enables it."""
+        if not self.config.enabled("partitions"):
+            return
+        from . import partitions  # noqa: PLC0415  optional subsystem
+
+        config = self.config.section("partitions")
+        manager = partitions.PartitionManager.from_config(db, self.logger, config)
+        self.maintainer = partitions.PartitionMaintainer(
+            manager,
+            self.logger,
+            check_interval=float(config.get("check_hours", 6)) * 3600,
+        )
+        self.maintainer.start()
+
+    def maintain_partitions(self) -> None:
+        """Runs partition creation and retention once (--maintain-partitions)."""
+        from . import partitions  # noqa: PLC0415  optional subsystem
+
+        self.db = db_functions.DbFunctions(self.logger, self.config)
+        partitions.PartitionManager.from_config(
+            self.db, self.logger, self.config.section("partitions")
+        ).run_once()
+        self.db.pool.closeall()
+
+    def archive(self) -> None:
+        """Archives cold rows to Parquet once (--archive)."""
+        from . import archive  # noqa: PLC0415  optional dependencies
+
+        self.db = db_functions.DbFunctions(self.logger, self.config)
+        try:
+            archive.Archiver.from_config(self.db, self.logger, self.config.section("archive")).run()
+        finally:
+            self.db.pool.closeall()
+
+    def add_writer_gauges(
+        self, pipeline_metrics: metrics.PipelineMetrics, writer: batch_writer.BatchWriter
+    ) -> None:
+        """Exposes the writer's queue depth and row counters as metrics."""
+        stats = writer.stats
+        pipeline_metrics.add_gauge(
+            "mesh_persist_writer_queue_depth",
+            "Rows waiting to be flushed.",
+            lambda: writer.queue_depth,
+        )
+        for name, doc, func in (
+            (
+                "mesh_persist_rows_written_total",
+                "Rows written by the writer.",
+                lambda: stats.rows_written,
+            ),
+            (
+                "mesh_persist_rows_dropped_total",
+                "Rows dropped by the writer.",
+                lambda: stats.rows_dropped,
+            ),
+            (
+                "mesh_persist_flush_errors_total",
+                "Failed batch flushes.",
+                lambda: stats.flush_errors,
+            ),
+        ):
+            pipeline_metrics.add_total(name, doc, func)
+        cache = writer.db.node_cache
+        if cache is not None:
+            pipeline_metrics.add_total(
+                "mesh_persist_node_cache_suppressed_total",
+                "Unchanged nodeinfo/position rows not written.",
+                lambda: cache.stats.suppressed,
+            )
+
+    def replay(self, path: str, rate: float = 0.0) -> None:
+        """Feeds a capture file through the decode and persist path, without a broker.
+
+        Like spool replay, nothing is shed or dropped: a full queue slows the
+        replay down instead, so every captured message is persisted.
+
+        Args:
+            path: capture file written with --capture.
+            rate: 0 for as fast as possible, otherwise a multiple of real time.
+        """
+        from . import capture  # noqa: PLC0415  optional subsystem
+
+        self.logger.info("Replaying %s (rate %s)", path, rate or "unpaced")
+        self.start_pipeline()
+        count = 0
+        start = time.perf_counter()
+        for _, topic, payload in capture.paced(capture.read_capture(path), rate):
+            self.replay_message(topic, payload)
+            count += 1
+        self.shutdown()
+        elapsed = time.perf_counter() - start
+        self.logger.info(
+            "Replayed %d messages in %.1fs (%.0f msgs/s)",
+            count,
+            elapsed,
+            count / elapsed if elapsed else 0.0,
+        )
+
+    def start_spool(self) -> None:
+        """Opens the on-disk spool and starts its replayer, if [spool] enables it."""
+        if not self.config.enabled("spool"):
+            return
+        from . import spool  # noqa: PLC0415  optional subsystem
+
+        spool_config = self.config.section("spool")
+        self.spool = spool.Spool.from_config(self.logger, spool_config)
+        self.spool_watermark = float(spool_config.get("watermark", 0.9))
+        self.replayer = spool.SpoolReplayer(
+            self.spool,
+            self.replay_message,
+            self._replay_ready,
+            self._wait_replay_flushed,
+            self.logger,
+            batch_records=int(spool_config.get("replay_batch", 5000)),
+            chunk_records=int(spool_config.get("replay_chunk", 500)),
+            min_speedup=float(spool_config.get("replay_min_speedup", 10.0)),
+        )
+        self.replayer.start()
+        if self.spool.has_backlog():
+            self.logger.info("Spool has a backlog from a previous run; replaying")
+
+    def main_async(self) -> None:
+        """Entry point for the asyncio engine (see async_engine)."""
+        from . import async_engine  # noqa: PLC0415  optional dependencies
+
+        self.logger.info("Starting mesh-persist (async engine, instance %s).", self.instance_id)
+        ignored = [
+            f"[{section}] {key}"
+            for section, key, default in async_engine.UNSUPPORTED
+            # the node cache is on by default, so only warn about what was configured
+            if self.config.section(section) and self.config.get_bool(section, key, default=default)
+        ]
+        if ignored:
+            self.logger.warning(
+                "The async engine ignores %s; use the threaded engine for them",
+                ", ".join(ignored),
+            )
+        self.start_profiler()
+        async_engine.run(
+            mqtt_session.MqttSettings.from_config(
+                self.config.section("mqtt", required=True), self.instance_id
+            ),
+            db_functions.tag_connection(
+                self.config.section("postgresql", required=True), self.instance_id
+            ),
+            self.config.section("writer"),
+            self.decoder,
+            self.logger,
+            debug=self.debug,
+            capture_writer=self.capture,
+            backpressure_config=self.config.section("backpressure"),
+        )
+
+    def shutdown(self) -> None:  # noqa: C901
+        """Stops replay, drains the decode workers and flushes any queued rows."""
+        if self.maintainer is not None:
+            self.maintainer.stop()
+        if self.replayer is not None:
+            # a replay batch left unflushed is not committed, so it's safe to give up on it
+            self.replayer.stop(timeout=10.0)
+        if self.pool is not None:
+            self.pool.stop()
+        if self.writer is not None:
+            self.writer.stop()
+        if self.shedder is not None:
+            self.shedder.log_stats()
+        if self.node_status is not None:
+            self.node_status.stop()
+        if self.rollups is not None:
+            self.rollups.stop()
+        if self.spool is not None:
+            self.spool.close()
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.capture is not None:
+            self.capture.close()
+            self.logger.info("Captured %d messages to %s", self.capture.count, self.capture.path)
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parses the mesh-persist command line."""
+    parser = argparse.ArgumentParser(prog="mesh-persist", description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        help="ingest runtime (default: [persist] engine in mesh_persist.ini, else threaded)",
+    )
+    parser.add_argument("--capture", metavar="FILE", help="also record received MQTT traffic")
+    parser.add_argument(
+        "--replay", metavar="FILE", help="ingest a capture file instead of connecting to MQTT"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="replay speed as a multiple of real time (default 0: as fast as possible)",
+    )
+    parser.add_argument("--no-db", action="store_true", help="decode only; write nothing")
+    parser.add_argument(
+        "--maintain-partitions",
+        action="store_true",
+        help="create future partitions, apply retention and exit",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="export rows older than [archive] older_than_days to Parquet and exit",
+    )
+    return parser.parse_args(argv)
+
 
 def main() -> None:
     """Main entry point."""
+    args = parse_args()
+    engine = args.engine or read_config().get_str("persist", "engine", "threaded")
+    if engine not in ENGINES:
+        sys.exit(f"Unknown engine {engine!r}, expected one of {', '.join(ENGINES)}")
     try:
         mp = MeshPersist()
-        mp.main()
+        mp.debug = args.no_db
+        if args.maintain_partitions:
+            mp.maintain_partitions()
+            return
+        if args.archive:
+            mp.archive()
+            return
+        if args.replay:
+            mp.replay(args.replay, args.rate)
+            return
+        if args.capture:
+            from . import capture  # noqa: PLC0415  optional subsystem
+
+            mp.capture = capture.CaptureWriter(args.capture)
+        if engine == "async":
+            mp.main_async()
+        else:
+            mp.main()
     except KeyboardInterrupt:
         mp.logger.info("Exiting on user request")
+        mp.shutdown()
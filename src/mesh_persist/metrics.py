@@ -0,0 +1,302 @@
+"""Pipeline metrics in Prometheus text format.
+
+A deliberately small, dependency-free metrics registry plus a local HTTP
+endpoint serving it.  Nothing here is touched by the hot path unless metrics
+are enabled: the decoder and writer hold a PipelineMetrics reference that is
+None when [metrics] is disabled, and skip all timing when it is.
+
+Decode workers record into a PipelineMetrics of their own and send what
+they counted since the last report to the parent (take_decode/merge_decode),
+which serves the totals.
+"""
+
+# pylint: disable=R0902
+
+import bisect
+import logging
+import threading
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
+from .config_load import TRUTHY
+
+if TYPE_CHECKING:
+    import http.server
+
+# Latency buckets (seconds) shared by every histogram: 10us .. 10s.
+DEFAULT_BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values, strict=True)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    def __init__(self, name: str, doc: str, labelnames: tuple[str, ...] = ()) -> None:
+        """Initialization function for Counter."""
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: object, amount: float = 1.0) -> None:
+        """Adds amount to the series identified by labels."""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def take(self) -> dict[tuple, float]:
+        """The counts since the last take, resetting them."""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: dict[tuple, float]) -> None:
+        """Adds counts taken from another process's counter."""
+        with self._lock:
+            for labels, amount in values.items():
+                self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list[str]:
+        """Prometheus exposition lines for this counter."""
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        lines.extend(f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items)
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Initialization function for Histogram."""
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label set: [bucket counts..., +Inf count], sum
+        self._series: dict[tuple, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: object) -> None:
+        """Records one observation in the series identified by labels."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = ([0] * (len(self.buckets) + 1), [0.0])
+                self._series[labels] = series
+            series[0][i] += 1
+            series[1][0] += value
+
+    def take(self) -> dict[tuple, tuple[list[int], list[float]]]:
+        """The observations since the last take, resetting them."""
+        with self._lock:
+            series, self._series = self._series, {}
+        return series
+
+    def merge(self, series: dict[tuple, tuple[list[int], list[float]]]) -> None:
+        """Adds observations taken from another process's histogram."""
+        with self._lock:
+            for labels, (counts, total) in series.items():
+                mine = self._series.get(labels)
+                if mine is None:
+                    self._series[labels] = (list(counts), list(total))
+                    continue
+                for i, count in enumerate(counts):
+                    mine[0][i] += count
+                mine[1][0] += total[0]
+
+    def render(self) -> list[str]:
+        """Prometheus exposition lines for this histogram."""
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(c), s[0]) for k, (c, s) in self._series.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                cumulative += count
+                le = _labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time."""
+
+    def __init__(self, name: str, doc: str, func: Callable[[], float]) -> None:
+        """Initialization function for Gauge."""
+        self.name = name
+        self.doc = doc
+        self.func = func
+
+    def render(self) -> list[str]:
+        """Prometheus exposition lines for this gauge."""
+        return [
+            f"# HELP {self.name} {self.doc}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.func()}",
+        ]
+
+
+class Total(Gauge):
+    """Monotonic count kept elsewhere, read from a callback at scrape time."""
+
+    def render(self) -> list[str]:
+        """Prometheus exposition lines for this counter."""
+        return [
+            f"# HELP {self.name} {self.doc}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.func()}",
+        ]
+
+
+class PipelineMetrics:
+    """The ingest pipeline's metrics and the HTTP endpoint that serves them."""
+
+    def __init__(self) -> None:
+        """Initialization function for PipelineMetrics."""
+        self.packets = Counter(
+            "mesh_persist_packets_total",
+            "Receptions, by portnum and gateway (repeat receptions included).",
+            ("portnum", "gateway"),
+        )
+        self.duplicates = Counter(
+            "mesh_persist_duplicate_packets_total", "Repeat receptions skipped by the dedup cache."
+        )
+        self.decode_failures = Counter(
+            "mesh_persist_decode_failures_total", "Messages that failed to decode.", ("stage",)
+        )
+        self.stage_seconds = Histogram(
+            "mesh_persist_stage_seconds",
+            "Time spent in each decode stage (envelope_parse, decrypt, payload_parse, rows).",
+            ("stage",),
+        )
+        self.insert_seconds = Histogram(
+            "mesh_persist_db_insert_seconds", "Time to insert one batch, by table.", ("table",)
+        )
+        self.commit_seconds = Histogram(
+            "mesh_persist_db_commit_seconds", "Time to commit one write transaction."
+        )
+        self.shed = Counter(
+            "mesh_persist_shed_rows_total",
+            "Rows dropped by load shedding, by traffic class.",
+            ("traffic",),
+        )
+        self._metrics: list[Counter | Histogram | Gauge] = [
+            self.packets,
+            self.duplicates,
+            self.decode_failures,
+            self.stage_seconds,
+            self.insert_seconds,
+            self.commit_seconds,
+            self.shed,
+        ]
+        self._server: http.server.ThreadingHTTPServer | None = None
+
+    def _decode_metrics(self) -> dict[str, Counter | Histogram]:
+        return {
+            "packets": self.packets,
+            "duplicates": self.duplicates,
+            "decode_failures": self.decode_failures,
+            "stage_seconds": self.stage_seconds,
+        }
+
+    def take_decode(self) -> dict[str, dict]:
+        """What the decoder recorded since the last take (in a decode worker)."""
+        return {name: metric.take() for name, metric in self._decode_metrics().items()}
+
+    def merge_decode(self, taken: dict[str, dict]) -> None:
+        """Adds what a decode worker's decoder recorded (see take_decode)."""
+        metrics = self._decode_metrics()
+        for name, values in taken.items():
+            metrics[name].merge(values)
+
+    def add_gauge(self, name: str, doc: str, func: Callable[[], float]) -> None:
+        """Registers a value to be read at scrape time (queue depth, hit rate...)."""
+        self._metrics.append(Gauge(name, doc, func))
+
+    def add_total(self, name: str, doc: str, func: Callable[[], float]) -> None:
+        """Registers a count kept elsewhere (rows written...), exposed as a counter."""
+        self._metrics.append(Total(name, doc, func))
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format."""
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host: str, port: int, logger: logging.Logger) -> None:
+        """Starts the /metrics HTTP endpoint on a daemon thread."""
+        import http.server  # noqa: PLC0415  only loaded when metrics are served
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+                return
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name="mesh-persist-metrics", daemon=True
+        ).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+
+    def close(self) -> None:
+        """Stops the HTTP endpoint."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def from_config(config: dict, logger: logging.Logger) -> PipelineMetrics | None:
+    """Builds and serves metrics from the [metrics] section, or None if disabled."""
+    if config.get("enabled", "false").lower() not in TRUTHY:
+        return None
+    metrics = PipelineMetrics()
+    metrics.serve(config.get("host", "127.0.0.1"), int(config.get("port", 9464)), logger)
+    return metrics
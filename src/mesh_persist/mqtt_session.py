@@ -0,0 +1,113 @@
+"""MQTT session settings shared by the threaded and async engines.
+
+Besides the broker and topics, [mqtt] controls how several instances share
+one stream: with share_group set, every topic is subscribed as the MQTT v5
+shared subscription $share/<group>/<topic>, so the broker hands each message
+to just one instance of the group.  With persistent_session the broker keeps
+the subscription, and queues QoS 1 messages, while an instance is briefly
+disconnected.  Either setting is only worth having at QoS 1, so that is the
+default qos when one is set.
+"""
+
+from dataclasses import dataclass
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from .config_load import TRUTHY
+
+
+@dataclass(frozen=True)
+class MqttSettings:
+    """The [mqtt] section, parsed."""
+
+    broker: str
+    port: int
+    user: str | None
+    password: str | None
+    topics: tuple[str, ...]
+    client_id: str = ""
+    qos: int = 0
+    share_group: str = ""
+    v5: bool = False
+    persistent: bool = False
+    session_expiry: int = 3600
+
+    @classmethod
+    def from_config(cls, config: dict, instance: str) -> "MqttSettings":
+        """Builds MqttSettings from the [mqtt] section for the given instance id.
+
+        A persistent session needs a stable client id; unless client_id is set
+        it is derived from the instance id, so each instance must have its own.
+        """
+        persistent = config.get("persistent_session", "false").lower() in TRUTHY
+        client_id = config.get("client_id", "")
+        if persistent and not client_id:
+            client_id = f"mesh-persist-{instance}"
+        share_group = config.get("share_group", "")
+        # QoS 0 messages are neither queued for a persistent session nor redelivered
+        # to another member of a share group
+        qos = int(config.get("qos", 1 if persistent or share_group else 0))
+        return cls(
+            broker=str(config.get("broker")),
+            port=int(str(config.get("port", 1883))),
+            user=config.get("user"),
+            password=config.get("pass"),
+            topics=tuple(t.strip() for t in config.get("topic", "msh/#").split(",") if t.strip()),
+            client_id=client_id,
+            qos=qos,
+            share_group=share_group,
+            v5=config.get("protocol", "3.1.1") in ("5", "5.0") or bool(share_group),
+            persistent=persistent,
+            session_expiry=int(config.get("session_expiry", 3600)),
+        )
+
+    @property
+    def subscriptions(self) -> list[tuple[str, int]]:
+        """(topic filter, qos) pairs to subscribe to, shared if share_group is set."""
+        prefix = f"$share/{self.share_group}/" if self.share_group else ""
+        return [(prefix + topic, self.qos) for topic in self.topics]
+
+    def connect_properties(self) -> Properties | None:
+        """MQTT v5 CONNECT properties: the session expiry for a persistent session."""
+        if not (self.v5 and self.persistent):
+            return None
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.session_expiry
+        return properties
+
+
+def paho_client(settings: MqttSettings) -> mqtt.Client:
+    """Creates, but doesn't connect, a paho client for settings."""
+    if settings.v5:
+        client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=settings.client_id,
+            transport="tcp",
+            protocol=mqtt.MQTTv5,
+        )
+    else:
+        client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=settings.client_id,
+            transport="tcp",
+            protocol=mqtt.MQTTv311,
+            clean_session=not settings.persistent,
+        )
+    client.username_pw_set(settings.user, settings.password)
+    return client
+
+
+def connect_paho(client: mqtt.Client, settings: MqttSettings) -> None:
+    """Connects a paho_client() client, resuming the stored session if persistent."""
+    if settings.v5:
+        client.connect(
+            settings.broker,
+            port=settings.port,
+            keepalive=60,
+            clean_start=not settings.persistent,
+            properties=settings.connect_properties(),
+        )
+    else:
+        client.connect(settings.broker, port=settings.port, keepalive=60)
@@ -0,0 +1,215 @@
+"""Last-known node state, to skip no-op nodeinfo and position upserts.
+
+Nodes rebroadcast NODEINFO and POSITION constantly, nearly always unchanged,
+and each of those upserts only bumps updated_at.  NodeStateCache remembers
+what was last written for each node; DbFunctions.write_batches drops rows
+that match it and instead records the new last-seen time in memory.  The
+collected timestamps are written back in one bulk UPDATE per table every
+touch_interval seconds.
+
+Cached content is kept in the form the database returns it, so that rows read
+back when warming the cache compare equal to incoming rows with the same
+content: mac_addr and public_key arrive as bytes but are stored in varchar
+columns, as the hex text PostgreSQL renders a bytea as.
+"""
+
+# pylint: disable=R0902
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from .config_load import TRUTHY
+
+# Per table: the row positions of the node id, of the stored content compared
+# against the cache, of the touch key (the table's unique key) and of the
+# updated_at timestamp.
+CACHED_TABLES: dict[str, dict[str, Any]] = {
+    "node_infos": {"node": 0, "content": slice(1, 7), "key": (0, 1, 2), "seen": 8},
+    "node_positions": {"node": 0, "content": slice(3, 6), "key": (0, 3, 4), "seen": 2},
+}
+
+# Bulk last-seen updates, in the (sql, row template) form of BATCH_SQL.
+TOUCH_SQL = {
+    "node_infos": (
+        """UPDATE node_infos
+                SET updated_at = GREATEST(node_infos.updated_at, to_timestamp(v.ts))
+                FROM (VALUES %s) AS v (node_id, long_name, short_name, ts)
+                WHERE node_infos.node_id = v.node_id
+                AND node_infos.long_name = v.long_name
+                AND node_infos.short_name = v.short_name""",
+        "(%s::bigint, %s::varchar, %s::varchar, %s::double precision)",
+    ),
+    "node_positions": (
+        """UPDATE node_positions
+                SET updated_at = GREATEST(node_positions.updated_at, to_timestamp(v.ts))
+                FROM (VALUES %s) AS v (node_id, latitude, longitude, ts)
+                WHERE node_positions.node_id = v.node_id
+                AND node_positions.latitude = v.latitude
+                AND node_positions.longitude = v.longitude""",
+        "(%s::bigint, %s::double precision, %s::double precision, %s::double precision)",
+    ),
+}
+
+# Most recent row per node, in CACHED_TABLES row layout, for warming the cache.
+WARM_SQL = {
+    "node_infos": """SELECT * FROM (
+                SELECT DISTINCT ON (node_id) node_id, long_name, short_name, mac_addr,
+                hw_model, role, public_key, updated_at
+                FROM node_infos ORDER BY node_id, updated_at DESC) latest
+                ORDER BY updated_at DESC LIMIT %s""",
+    "node_positions": """SELECT * FROM (
+                SELECT DISTINCT ON (node_id) node_id, latitude, longitude, altitude, updated_at
+                FROM node_positions ORDER BY node_id, updated_at DESC) latest
+                ORDER BY updated_at DESC LIMIT %s""",
+}
+
+
+def stored(content: tuple) -> tuple:
+    """Row content as the database returns it: bytes become their varchar (hex bytea) text."""
+    return tuple("\\x" + v.hex() if isinstance(v, bytes) else v for v in content)
+
+
+@dataclass
+class NodeCacheStats:
+    """Counters kept by the node state cache."""
+
+    suppressed: int = 0
+    passed: int = 0
+    touches_written: int = 0
+    warmed: int = 0
+
+
+class NodeStateCache:
+    """Bounded LRU of each node's last written nodeinfo and position."""
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        *,
+        max_entries: int = 50000,
+        touch_interval: float = 60.0,
+    ) -> None:
+        """Initialization function for NodeStateCache.
+
+        Args:
+            logger: logger for the periodic cache summary.
+            max_entries: nodes remembered per table; least recently seen go first.
+            touch_interval: seconds between bulk last-seen updates.
+        """
+        self.logger = logger
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.stats = NodeCacheStats()
+        self._state: dict[str, OrderedDict[int, tuple]] = {t: OrderedDict() for t in CACHED_TABLES}
+        self._touches: dict[str, dict[tuple, float]] = {t: {} for t in CACHED_TABLES}
+        self._next_touch = time.monotonic() + touch_interval
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, logger: logging.Logger, config: dict) -> "NodeStateCache | None":
+        """Builds a NodeStateCache from the [node_cache] section, or None if disabled."""
+        if config.get("enabled", "true").lower() not in TRUTHY:
+            return None
+        return cls(
+            logger,
+            max_entries=int(config.get("max_entries", 50000)),
+            touch_interval=float(config.get("touch_interval", 60.0)),
+        )
+
+    def __len__(self) -> int:
+        """Number of cached node states, over both tables."""
+        return sum(len(state) for state in self._state.values())
+
+    def filter(self, table: str, rows: list[tuple], pending: dict[str, dict[int, tuple]]) -> list:
+        """Drops rows that would not change what is stored for their node.
+
+        A dropped row's timestamp is kept for the next bulk touch.  The content
+        of rows that are kept is staged in pending, and only enters the cache
+        through commit(), once the transaction writing it has committed.
+        """
+        layout = CACHED_TABLES.get(table)
+        if layout is None:
+            return rows
+        kept = []
+        staged = pending.setdefault(table, {})
+        with self._lock:
+            state = self._state[table]
+            touches = self._touches[table]
+            for row in rows:
+                node = row[layout["node"]]
+                content = stored(row[layout["content"]])
+                known = staged.get(node, state.get(node))
+                if known == content:
+                    key = tuple(row[i] for i in layout["key"])
+                    touches[key] = max(touches.get(key, 0.0), row[layout["seen"]])
+                    if node in state:
+                        state.move_to_end(node)
+                    self.stats.suppressed += 1
+                    continue
+                staged[node] = content
+                kept.append(row)
+                self.stats.passed += 1
+        return kept
+
+    def commit(self, pending: dict[str, dict[int, tuple]]) -> None:
+        """Records the content of rows that have now been written."""
+        with self._lock:
+            for table, staged in pending.items():
+                state = self._state[table]
+                for node, content in staged.items():
+                    state[node] = content
+                    state.move_to_end(node)
+                while len(state) > self.max_entries:
+                    state.popitem(last=False)
+
+    def take_touches(self) -> dict[str, list[tuple]]:
+        """Hands over the collected last-seen times, if the touch interval has passed."""
+        if time.monotonic() < self._next_touch:
+            return {}
+        self._next_touch = time.monotonic() + self.touch_interval
+        with self._lock:
+            taken = {
+                t: [(*k, ts) for k, ts in touches.items()] for t, touches in self._touches.items()
+            }
+            self._touches = {t: {} for t in CACHED_TABLES}
+        self.log_stats()
+        return {t: rows for t, rows in taken.items() if rows}
+
+    def touched(self, taken: dict[str, list[tuple]]) -> None:
+        """Counts last-seen times that have been written."""
+        self.stats.touches_written += sum(len(rows) for rows in taken.values())
+
+    def restore_touches(self, taken: dict[str, list[tuple]]) -> None:
+        """Puts back last-seen times whose bulk update was rolled back."""
+        with self._lock:
+            for table, rows in taken.items():
+                touches = self._touches[table]
+                for *key, ts in rows:
+                    touches[tuple(key)] = max(touches.get(tuple(key), 0.0), ts)
+        self._next_touch = time.monotonic()
+
+    def warm(self, table: str, rows: list[tuple]) -> None:
+        """Loads (node_id, *content) rows read from the database, most recent first."""
+        with self._lock:
+            state = self._state[table]
+            for node, *content in reversed(rows):
+                state[node] = tuple(content)
+            while len(state) > self.max_entries:
+                state.popitem(last=False)
+        self.stats.warmed += len(rows)
+
+    def log_stats(self) -> None:
+        """Logs how many writes the cache has avoided."""
+        s = self.stats
+        self.logger.info(
+            "node cache: entries=%d suppressed=%d passed=%d touches_written=%d warmed=%d",
+            len(self),
+            s.suppressed,
+            s.passed,
+            s.touches_written,
+            s.warmed,
+        )
@@ -0,0 +1,198 @@
+"""Incrementally maintained per-node status.
+
+Dashboards want one row per node: when it was last heard, where it is, its
+names and latest device metrics.  Working that out from mesh_packets at query
+time (the old current_nodes view) gets slower as the tables grow, so instead
+the persister folds every decoded row into an in-memory summary per node and
+upserts the changed nodes into node_status every few seconds, in one batch.
+"""
+
+# pylint: disable=R0902
+
+import logging
+import threading
+from dataclasses import astuple, dataclass
+
+import psycopg2
+
+from . import db_functions, decoder
+
+
+@dataclass
+class NodeDelta:
+    """What has been learned about one node since the last flush.
+
+    Field order matches the db_functions.BATCH_SQL["node_status"] row template.
+    None means "not heard since the last flush", which the upsert leaves unchanged.
+    """
+
+    node_id: int
+    last_seen: float | None = None
+    last_gateway: int | None = None
+    packet_count: int = 0
+    long_name: str | None = None
+    short_name: str | None = None
+    hw_model: str | None = None
+    role: str | None = None
+    info_updated_at: float | None = None
+    latitude: float | None = None
+    longitude: float | None = None
+    altitude: float | None = None
+    position_updated_at: float | None = None
+    battery_level: int | None = None
+    voltage: float | None = None
+    channel_util: float | None = None
+    air_util_tx: float | None = None
+    uptime_seconds: int | None = None
+    metrics_updated_at: float | None = None
+
+    def merge(self, newer: "NodeDelta") -> None:
+        """Folds a later delta for the same node into this one (after a failed flush)."""
+        self.packet_count += newer.packet_count
+        for name, value in vars(newer).items():
+            if name not in ("node_id", "packet_count") and value is not None:
+                setattr(self, name, value)
+
+
+class NodeStatusTracker(threading.Thread):
+    """Coalesces decoded rows into per-node deltas and upserts them periodically."""
+
+    def __init__(
+        self,
+        db: db_functions.DbFunctions,
+        logger: logging.Logger,
+        *,
+        flush_interval: float = 5.0,
+    ) -> None:
+        """Initialization function for NodeStatusTracker.
+
+        Args:
+            db: database functions used to write node_status.
+            logger: logger for flush errors.
+            flush_interval: seconds between upserts.
+        """
+        super().__init__(name="mesh-persist-node-status", daemon=True)
+        self.db = db
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self.nodes_written = 0
+        self._pending: dict[int, NodeDelta] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def from_config(
+        cls, db: db_functions.DbFunctions, logger: logging.Logger, config: dict
+    ) -> "NodeStatusTracker":
+        """Builds a NodeStatusTracker from the [node_status] section of mesh_persist.ini."""
+        return cls(db, logger, flush_interval=float(config.get("flush_interval", 5.0)))
+
+    def _delta(self, node_id: int) -> NodeDelta:
+        delta = self._pending.get(node_id)
+        if delta is None:
+            delta = self._pending[node_id] = NodeDelta(node_id)
+        return delta
+
+    def observe(self, rows: decoder.Rows) -> None:
+        """Folds a decoded packet's rows into the pending per-node deltas."""
+        with self._lock:
+            for table, row in rows:
+                if table == "mesh_packets":
+                    d = self._delta(row.source)
+                    d.packet_count += 1
+                    if d.last_seen is None or row.toi >= d.last_seen:
+                        d.last_seen = row.toi
+                        d.last_gateway = row.gateway_id
+                elif table == "node_infos":
+                    d = self._delta(row.node_id)
+                    d.long_name, d.short_name = row.long_name, row.short_name
+                    d.hw_model, d.role = row.hw_model, row.role
+                    d.info_updated_at = row.updated_at
+                elif table == "node_positions":
+                    d = self._delta(row.node_id)
+                    d.latitude = row.latitude
+                    d.longitude = row.longitude
+                    d.altitude = row.altitude
+                    d.position_updated_at = row.updated_at
+                elif table == "device_metrics":
+                    d = self._delta(row.node_id)
+                    d.battery_level = row.battery_level
+                    d.voltage = row.voltage
+                    d.channel_util = row.channel_util
+                    d.air_util_tx = row.air_util_tx
+                    d.uptime_seconds = row.uptime_seconds
+                    d.metrics_updated_at = row.toi
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Flushes what is pending and stops."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self) -> None:
+        """Flush loop."""
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        """Upserts every node changed since the last flush, in one statement.
+
+        If the database rejects the statement, the nodes are written one at a
+        time, so a bad value only costs the update of the node that carried it.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        rows = [astuple(delta) for delta in pending.values()]
+        try:
+            self.db.write_batches({"node_status": rows})
+        except psycopg2.OperationalError as e:
+            self.logger.warning(
+                "node_status flush of %d nodes failed, will retry: %s",
+                len(rows),
+                db_functions.format_db_error(e),
+            )
+            self._requeue(pending)
+            return
+        except Exception as e:  # noqa: BLE001  includes values psycopg2 can't adapt
+            self.logger.warning(
+                "node_status flush of %d nodes failed, writing them one by one: %s",
+                len(rows),
+                db_functions.format_db_error(e),
+            )
+            self._flush_each(pending)
+            return
+        self.flushes += 1
+        self.nodes_written += len(rows)
+
+    def _flush_each(self, pending: dict[int, NodeDelta]) -> None:
+        """Writes the nodes one at a time, dropping only those the database rejects."""
+        unwritten = dict(pending)
+        for node_id, delta in pending.items():
+            try:
+                self.db.write_batches({"node_status": [astuple(delta)]})
+            except psycopg2.OperationalError:
+                self._requeue(unwritten)
+                return
+            except Exception as e:  # noqa: BLE001
+                self.logger.error(  # noqa: TRY400
+                    "Dropping node_status update of node %s: %s",
+                    db_functions.id_to_hex(node_id),
+                    db_functions.format_db_error(e),
+                )
+            else:
+                self.nodes_written += 1
+            del unwritten[node_id]
+        self.flushes += 1
+
+    def _requeue(self, pending: dict[int, NodeDelta]) -> None:
+        """Puts unwritten deltas back, merged with anything observed since."""
+        with self._lock:
+            for node_id, delta in pending.items():
+                newer = self._pending.get(node_id)
+                if newer is not None:
+                    delta.merge(newer)
+                self._pending[node_id] = delta
@@ -0,0 +1,261 @@
+"""Partition maintenance for the toi-partitioned tables.
+
+After db/migrations/0001_partition_by_toi.sql, mesh_packets and the metric
+tables are range partitioned by toi.  This module keeps partitions created
+ahead of the data, so inserts never fall into the default partition, and
+applies retention by detaching (and optionally dropping) partitions that lie
+entirely before the retention cutoff, which is instant compared to a DELETE.
+
+Rows can still end up in the default partition (the writer replaces rx_times
+from unset or skewed gateway clocks, see db_functions.packet_toi, but not rows
+written before that).  Retention never touches them, and they block creating
+a partition for their period, so every run warns while it holds any.
+"""
+
+# pylint: disable=R0902
+# pylint: disable=R0913
+
+import datetime as dt
+import logging
+import re
+import threading
+
+import psycopg2
+
+from . import db_functions
+
+PARTITIONED_TABLES = (
+    "mesh_packets",
+    "device_metrics",
+    "text_messages",
+    "environment_metrics",
+    "power_metrics",
+    "air_quality_metrics",
+    "local_stats",
+)
+
+INTERVALS = ("day", "week", "month")
+RETENTION_ACTIONS = ("detach", "drop")
+
+_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+_LIST_PARTITIONS = """SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = %s::regclass"""
+
+
+def period_start(moment: dt.datetime, interval: str) -> dt.datetime:
+    """Start (UTC midnight) of the partition period containing moment."""
+    day = moment.astimezone(dt.UTC).date()
+    if interval == "month":
+        day = day.replace(day=1)
+    elif interval == "week":
+        day -= dt.timedelta(days=day.weekday())
+    return dt.datetime(day.year, day.month, day.day, tzinfo=dt.UTC)
+
+
+def next_period(start: dt.datetime, interval: str) -> dt.datetime:
+    """Start of the period following the one beginning at start."""
+    if interval == "month":
+        if start.month == 12:  # noqa: PLR2004
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    return start + dt.timedelta(days=7 if interval == "week" else 1)
+
+
+def partition_name(table: str, start: dt.datetime) -> str:
+    """Name of the partition of table starting at start, e.g. mesh_packets_p20250101."""
+    return f"{table}_p{start:%Y%m%d}"
+
+
+class PartitionManager:
+    """Creates future partitions and applies retention to the partitioned tables."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        db: db_functions.DbFunctions,
+        logger: logging.Logger,
+        *,
+        interval: str = "month",
+        premake: int = 3,
+        retention_days: int = 0,
+        retention_action: str = "detach",
+        tables: tuple[str, ...] = PARTITIONED_TABLES,
+    ) -> None:
+        """Initialization function for PartitionManager.
+
+        Args:
+            db: database functions whose connection pool is used for the DDL.
+            logger: logger for maintenance messages.
+            interval: partition width: day, week or month (match the migration).
+            premake: number of periods to create ahead of the current one.
+            retention_days: remove partitions entirely older than this (0 keeps all).
+            retention_action: detach leaves old partitions as standalone tables,
+                drop deletes them.
+            tables: the partitioned tables to maintain.
+        """
+        if interval not in INTERVALS:
+            msg = f"Unknown partition interval {interval!r}"
+            raise ValueError(msg)
+        if retention_action not in RETENTION_ACTIONS:
+            msg = f"Unknown retention action {retention_action!r}"
+            raise ValueError(msg)
+        self.db = db
+        self.logger = logger
+        self.interval = interval
+        self.premake = premake
+        self.retention_days = retention_days
+        self.retention_action = retention_action
+        self.tables = tables
+        self._default_counts: dict[str, int] = {}
+
+    @classmethod
+    def from_config(
+        cls, db: db_functions.DbFunctions, logger: logging.Logger, config: dict
+    ) -> "PartitionManager":
+        """Builds a PartitionManager from the [partitions] section of mesh_persist.ini."""
+        return cls(
+            db,
+            logger,
+            interval=config.get("interval", "month"),
+            premake=int(config.get("premake", 3)),
+            retention_days=int(config.get("retention_days", 0)),
+            retention_action=config.get("retention_action", "detach"),
+        )
+
+    def partitions(self, cur, table: str) -> dict[str, tuple[dt.datetime, dt.datetime]]:
+        """Maps each range partition of table to its (from, to) bounds."""
+        cur.execute(_LIST_PARTITIONS, (table,))
+        bounds = {}
+        for name, expr in cur.fetchall():
+            match = _BOUND_RE.search(expr or "")
+            if match is None:  # the DEFAULT partition
+                continue
+            bounds[name] = (
+                dt.datetime.fromisoformat(match.group(1)),
+                dt.datetime.fromisoformat(match.group(2)),
+            )
+        return bounds
+
+    def default_rows(self, cur, table: str) -> tuple[str, int, dt.datetime, dt.datetime] | None:
+        """The default partition of table, its row count and toi range, if it holds any rows."""
+        cur.execute(_LIST_PARTITIONS, (table,))
+        for name, expr in cur.fetchall():
+            if expr != "DEFAULT":
+                continue
+            cur.execute(f"SELECT count(*), min(toi), max(toi) FROM {name}")  # noqa: S608
+            count, oldest, newest = cur.fetchone()
+            return (name, count, oldest, newest) if count else None
+        return None
+
+    def run_once(self, now: dt.datetime | None = None) -> None:
+        """Creates missing future partitions and applies retention, table by table.
+
+        Each table is handled in its own transaction, so one failure (say, rows
+        for a future period already sitting in the default partition) doesn't
+        hold up the others.
+        """
+        now = now or dt.datetime.now(dt.UTC)
+        sess = self.db.pool.session()
+        for table in self.tables:
+            try:
+                with sess.conn.cursor() as cur:
+                    cur.execute("SET LOCAL timezone = 'UTC'")
+                    existing = self.partitions(cur, table)
+                    self._create_future(cur, table, existing, now)
+                    if self.retention_days > 0:
+                        self._apply_retention(cur, table, existing, now)
+                    self._check_default(cur, table)
+                sess.conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.db.pool.discard()
+                raise
+            except psycopg2.Error as e:
+                sess.conn.rollback()
+                err = f"Partition maintenance of {table} failed: {db_functions.format_db_error(e)}"
+                self.logger.error(err)  # noqa: TRY400
+
+    def _create_future(
+        self,
+        cur,
+        table: str,
+        existing: dict[str, tuple[dt.datetime, dt.datetime]],
+        now: dt.datetime,
+    ) -> None:
+        start = period_start(now, self.interval)
+        for _ in range(self.premake + 1):
+            end = next_period(start, self.interval)
+            if not any(lo <= start < hi for lo, hi in existing.values()):
+                name = partition_name(table, start)
+                cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                    "FOR VALUES FROM (%s) TO (%s)",
+                    (start, end),
+                )
+                self.logger.info("Created partition %s", name)
+            start = end
+
+    def _check_default(self, cur, table: str) -> None:
+        found = self.default_rows(cur, table)
+        count = found[1] if found is not None else 0
+        grown = count - self._default_counts.get(table, 0)
+        self._default_counts[table] = count
+        if found is None:
+            return
+        name, _, oldest, newest = found
+        self.logger.warning(
+            "Default partition %s holds %d rows (%+d since the last run) with toi from %s to %s; "
+            "retention won't remove them, and they block creating partitions for those periods",
+            name,
+            count,
+            grown,
+            oldest,
+            newest,
+        )
+
+    def _apply_retention(
+        self,
+        cur,
+        table: str,
+        existing: dict[str, tuple[dt.datetime, dt.datetime]],
+        now: dt.datetime,
+    ) -> None:
+        cutoff = now - dt.timedelta(days=self.retention_days)
+        for name, (_, end) in sorted(existing.items()):
+            if end > cutoff:
+                continue
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+            if self.retention_action == "drop":
+                cur.execute(f"DROP TABLE {name}")
+            self.logger.info(
+                "Retention: %s partition %s (ended %s)", self.retention_action, name, end
+            )
+
+
+class PartitionMaintainer(threading.Thread):
+    """Background thread running PartitionManager.run_once periodically."""
+
+    def __init__(
+        self, manager: PartitionManager, logger: logging.Logger, *, check_interval: float = 3600.0
+    ) -> None:
+        """Initialization function for PartitionMaintainer."""
+        super().__init__(name="mesh-persist-partitions", daemon=True)
+        self.manager = manager
+        self.logger = logger
+        self.check_interval = check_interval
+        self._stop_event = threading.Event()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Stops the maintenance loop."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self) -> None:
+        """Maintenance loop; a failed run is retried at the next check."""
+        while not self._stop_event.is_set():
+            try:
+                self.manager.run_once()
+            except psycopg2.Error as e:
+                self.logger.warning("Partition maintenance failed: %s", e)
+            self._stop_event.wait(self.check_interval)
@@ -0,0 +1,273 @@
+"""On-demand profiling of a running persister.
+
+With [profiling] enabled, sending the process SIGUSR2 (`kill -USR2 <pid>`)
+opens a profiling window of `seconds` seconds, without a restart:
+
+* every thread's stack is sampled every interval_ms, and the samples are
+  written to <directory>/mesh-persist-<pid>-<time>.folded in collapsed-stack
+  format, one "thread;outer;...;inner count" line per distinct stack, which
+  flamegraph.pl, speedscope and inferno read as they are;
+* the decoder times every packet it decodes, and the slowest_packets slowest
+  are logged at the end of the window with the time spent in each decode
+  stage (envelope_parse, decrypt, payload_parse, rows; "other" is dedup,
+  logging and the rest).
+
+Decode workers install the same handler and are sent the signal by the
+parent, so each writes its own profile and logs its own slowest packets.
+Outside a window nothing is sampled and the decoder checks a single
+attribute per packet.
+
+slow_query_ms is applied by DbFunctions whenever the section is enabled:
+each table's insert, and the commit, is logged when it takes longer.
+"""
+
+# pylint: disable=R0902
+# pylint: disable=R0913
+
+import datetime as dt
+import heapq
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+
+    from . import decoder
+
+
+@dataclass(order=True)
+class PacketTrace:
+    """One traced packet: its total decode time and the time in each stage."""
+
+    seconds: float
+    topic: str = field(compare=False)
+    packet: str = field(compare=False)
+    stages: dict[str, float] = field(compare=False)
+
+
+def describe(rows: "decoder.Rows") -> str:
+    """Source, packet id, portnum and row count of a decoded packet, for the trace log."""
+    for table, row in rows:
+        if table == "mesh_packets":
+            return f"!{row.source:08x} #{row.packet_id} {row.portnum} rows={len(rows)}"
+    return f"rows={len(rows)}"
+
+
+class PacketTracer:
+    """Keeps the slowest packets seen, with their per-stage decode times."""
+
+    def __init__(self, slowest: int = 20) -> None:
+        """Initialization function for PacketTracer.
+
+        Args:
+            slowest: how many packets to keep.
+        """
+        self.slowest = slowest
+        self.traced = 0
+        self._heap: list[tuple[float, int, PacketTrace]] = []
+
+    def record(
+        self, seconds: float, topic: str, rows: "decoder.Rows", stages: dict[str, float]
+    ) -> None:
+        """Counts one decoded packet, keeping it if it is among the slowest so far."""
+        self.traced += 1
+        heap = self._heap
+        full = len(heap) >= self.slowest
+        if full and seconds <= heap[0][0]:
+            return
+        item = (seconds, self.traced, PacketTrace(seconds, topic, describe(rows), stages))
+        if full:
+            heapq.heapreplace(heap, item)
+        else:
+            heapq.heappush(heap, item)
+
+    def take(self) -> list[PacketTrace]:
+        """The slowest packets, slowest first, clearing the tracer."""
+        traces = [trace for _, _, trace in sorted(self._heap, reverse=True)]
+        self._heap = []
+        return traces
+
+    def log(self, logger: logging.Logger) -> None:
+        """Logs the slowest packets with their stage breakdown, in milliseconds."""
+        traced = self.traced
+        traces = self.take()
+        logger.info("Slowest %d of %d packets decoded:", len(traces), traced)
+        for trace in traces:
+            stages = dict(trace.stages)
+            stages["other"] = max(trace.seconds - sum(stages.values()), 0.0)
+            breakdown = " ".join(f"{stage}={s * 1000:.3f}" for stage, s in stages.items())
+            logger.info(
+                "  %.3f ms %s %s: %s", trace.seconds * 1000, trace.topic, trace.packet, breakdown
+            )
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads and writes them in collapsed-stack format."""
+
+    def __init__(self, directory: str = "profiles", interval: float = 0.005) -> None:
+        """Initialization function for SamplingProfiler.
+
+        Args:
+            directory: where profiles are written.
+            interval: seconds between samples.
+        """
+        self.directory = Path(directory)
+        self.interval = interval
+        self._labels: dict[CodeType, str] = {}
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            filename = Path(code.co_filename).name
+            label = self._labels[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+        return label
+
+    def sample(self, seconds: float) -> tuple[Counter[str], int]:
+        """Samples every thread but the calling one for `seconds`.
+
+        Returns:
+            the number of samples of each folded stack, and the number of sampling rounds.
+        """
+        counts: Counter[str] = Counter()
+        me = threading.get_ident()
+        rounds = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # noqa: SLF001
+                if ident == me:
+                    continue
+                stack = []
+                f: FrameType | None = frame
+                while f is not None:
+                    stack.append(self._label(f.f_code))
+                    f = f.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[";".join(reversed(stack))] += 1
+            rounds += 1
+            time.sleep(self.interval)
+        return counts, rounds
+
+    def write(self, counts: Counter[str]) -> Path:
+        """Writes folded stacks to a new file in the profile directory."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        now = dt.datetime.now(dt.UTC)
+        path = self.directory / f"mesh-persist-{os.getpid()}-{now:%Y%m%dT%H%M%S}.folded"
+        with path.open("w", encoding="utf-8") as f:
+            for stack, count in counts.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+class Profiler:
+    """Opens a profiling window when the process receives the profiling signal."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        logger: logging.Logger,
+        *,
+        packet_decoder: "decoder.PacketDecoder | None" = None,
+        signal_name: str = "SIGUSR2",
+        seconds: float = 30.0,
+        interval: float = 0.005,
+        directory: str = "profiles",
+        slowest: int = 20,
+    ) -> None:
+        """Initialization function for Profiler.
+
+        Args:
+            logger: logger for the window's results.
+            packet_decoder: decoder whose packets are traced during a window (None: none).
+            signal_name: the signal that opens a window.
+            seconds: length of a window.
+            interval: seconds between stack samples.
+            directory: where profiles are written.
+            slowest: packets logged at the end of a window (0: no packet tracing).
+        """
+        self.logger = logger
+        self.packet_decoder = packet_decoder
+        self.signal_name = signal_name
+        self.seconds = seconds
+        self.slowest = slowest
+        self.sampler = SamplingProfiler(directory, interval)
+        # returns the pids of processes (decode workers) the signal is passed on to
+        self.children: Callable[[], Iterable[int]] | None = None
+        self._thread: threading.Thread | None = None
+
+    @classmethod
+    def from_config(
+        cls,
+        logger: logging.Logger,
+        config: dict,
+        packet_decoder: "decoder.PacketDecoder | None" = None,
+    ) -> "Profiler":
+        """Builds a Profiler from the [profiling] section of mesh_persist.ini."""
+        return cls(
+            logger,
+            packet_decoder=packet_decoder,
+            signal_name=config.get("signal", "SIGUSR2"),
+            seconds=float(config.get("seconds", 30.0)),
+            interval=float(config.get("interval_ms", 5.0)) / 1000,
+            directory=config.get("directory", "profiles"),
+            slowest=int(config.get("slowest_packets", 20)),
+        )
+
+    def install(self) -> bool:
+        """Installs the signal handler; must be called from the main thread.
+
+        Returns:
+            False if this platform has no such signal.
+        """
+        signum = getattr(signal, self.signal_name, None)
+        if signum is None:
+            self.logger.warning("No %s on this platform; profiling is off", self.signal_name)
+            return False
+        signal.signal(signum, self._on_signal)
+        return True
+
+    def _on_signal(self, signum: int, frame) -> None:
+        for pid in self.children() if self.children is not None else ():
+            os.kill(pid, signum)
+        self.start()
+
+    def start(self) -> bool:
+        """Opens a profiling window in a background thread, unless one is open."""
+        if self._thread is not None and self._thread.is_alive():
+            self.logger.info("Profiling window already open")
+            return False
+        self._thread = threading.Thread(target=self.run, name="mesh-persist-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def run(self) -> None:
+        """One profiling window: samples stacks and traces packets for `seconds`."""
+        tracer = None
+        packet_decoder = self.packet_decoder if self.slowest > 0 else None
+        if packet_decoder is not None:
+            tracer = PacketTracer(self.slowest)
+            packet_decoder.tracer = tracer
+        self.logger.info("Profiling for %.0fs", self.seconds)
+        try:
+            counts, rounds = self.sampler.sample(self.seconds)
+        finally:
+            if packet_decoder is not None:
+                packet_decoder.tracer = None
+        try:
+            path = self.sampler.write(counts)
+        except OSError as e:
+            self.logger.error("Could not write profile: %s", e)  # noqa: TRY400
+        else:
+            self.logger.info(
+                "Wrote %d stack samples (%d rounds) to %s", counts.total(), rounds, path
+            )
+        if tracer is not None and tracer.traced:
+            tracer.log(self.logger)
@@ -0,0 +1,101 @@
+"""The Meshtastic protobuf modules, without the rest of the meshtastic package.
+
+`import meshtastic` runs the package's __init__, which loads the serial, BLE
+and TCP client code and their dependencies, when all the persister needs is a
+few generated *_pb2 modules.  Those live in meshtastic.protobuf, whose own
+__init__ is empty, so that subpackage and the *_pb2 modules are loaded here
+from their files and registered under their real names.  The generated modules
+import each other with `from meshtastic.protobuf import x_pb2`, which imports
+the meshtastic package whenever x_pb2 is not yet loaded, so each module's
+imports are loaded before the module itself.  A later `import meshtastic`
+still runs the real package, which then reuses the protobuf modules already
+loaded (reach them with `from meshtastic.protobuf import ...`: the import
+system does not set the package's protobuf attribute for a subpackage that
+was already loaded).
+
+PAYLOAD_TYPES takes the place of meshtastic.protocols for the portnums the
+decoder handles.
+"""
+
+import importlib.util
+import re
+import sys
+import types
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from google.protobuf.message import Message
+
+_PROTOBUF_MODULES = ("config_pb2", "mesh_pb2", "mqtt_pb2", "portnums_pb2", "telemetry_pb2")
+
+_PACKAGE = "meshtastic.protobuf"
+
+# How the generated modules import their dependencies.
+_DEPENDENCY_RE = re.compile(r"^from meshtastic\.protobuf import (\w+)", re.MULTILINE)
+
+
+def _load(name: str, path: Path, search_locations: list[str] | None = None) -> types.ModuleType:
+    spec = importlib.util.spec_from_file_location(
+        name, path, submodule_search_locations=search_locations
+    )
+    if spec is None or spec.loader is None:
+        msg = f"No module named {name!r}"
+        raise ModuleNotFoundError(msg, name=name)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+
+def _protobuf_package() -> types.ModuleType:
+    package = sys.modules.get(_PACKAGE)
+    if package is not None:
+        return package
+    spec = importlib.util.find_spec("meshtastic")
+    if spec is None or not spec.submodule_search_locations:
+        msg = "No module named 'meshtastic'"
+        raise ModuleNotFoundError(msg, name="meshtastic")
+    directory = Path(spec.submodule_search_locations[0]) / "protobuf"
+    return _load(_PACKAGE, directory / "__init__.py", [str(directory)])
+
+
+def _import_protobuf(package: types.ModuleType, name: str) -> types.ModuleType:
+    module = sys.modules.get(f"{_PACKAGE}.{name}")
+    if module is not None:
+        return module
+    path = Path(package.__path__[0]) / f"{name}.py"
+    for dependency in _DEPENDENCY_RE.findall(path.read_text(encoding="utf-8")):
+        _import_protobuf(package, dependency)
+    module = _load(f"{_PACKAGE}.{name}", path)
+    setattr(package, name, module)
+    return module
+
+
+def _import_protobufs(names: tuple[str, ...]) -> list[types.ModuleType]:
+    package = _protobuf_package()
+    return [_import_protobuf(package, name) for name in names]
+
+
+if TYPE_CHECKING:
+    # the same modules, as the type checker sees them
+    from meshtastic.protobuf import config_pb2, mesh_pb2, mqtt_pb2, portnums_pb2, telemetry_pb2
+else:
+    config_pb2, mesh_pb2, mqtt_pb2, portnums_pb2, telemetry_pb2 = _import_protobufs(
+        _PROTOBUF_MODULES
+    )
+
+# Portnums whose payload the decoder looks at, and the message type it is parsed
+# into (None: the payload is not a protobuf).
+PAYLOAD_TYPES: dict[int, type[Message] | None] = {
+    portnums_pb2.TEXT_MESSAGE_APP: None,
+    portnums_pb2.NODEINFO_APP: mesh_pb2.User,
+    portnums_pb2.POSITION_APP: mesh_pb2.Position,
+    portnums_pb2.NEIGHBORINFO_APP: mesh_pb2.NeighborInfo,
+    portnums_pb2.TELEMETRY_APP: telemetry_pb2.Telemetry,
+    portnums_pb2.ROUTING_APP: mesh_pb2.Routing,
+    portnums_pb2.MAP_REPORT_APP: mqtt_pb2.MapReport,
+}
@@ -0,0 +1,169 @@
+"""Row records passed from the decoder to the writer.
+
+Each packet is reduced, at decode time, to one immutable record per table row
+holding only the columns that table needs, in its BATCH_SQL row-template order.
+The records are named tuples, so they cost no more memory than plain tuples,
+go to execute_values, COPY and pickling unchanged, and don't keep the
+protobuf messages (and their encrypted and decoded payload copies) alive
+while they wait on the write queue.
+"""
+
+from typing import NamedTuple
+
+
+class MeshPacketRow(NamedTuple):
+    """A mesh_packets row: one per reception, duplicates included."""
+
+    source: int
+    dest: int
+    packet_id: int
+    channel: int
+    rx_snr: float
+    rx_rssi: int
+    hop_limit: int
+    hop_start: int
+    portnum: str
+    toi: float
+    channel_id: str
+    gateway_id: int
+
+
+class RepeatReception(MeshPacketRow):
+    """A mesh_packets row for a packet already decoded from an earlier reception.
+
+    It is written exactly like a MeshPacketRow; the type only marks the row as a
+    repeat, for load shedding and the gateway rollups.
+    """
+
+    __slots__ = ()
+
+
+class NodeInfoRow(NamedTuple):
+    """A node_infos row, from a NODEINFO packet."""
+
+    node_id: int
+    long_name: str
+    short_name: str
+    mac_addr: bytes
+    hw_model: str
+    role: str
+    public_key: bytes
+    created_at: float
+    updated_at: float
+
+
+class PositionRow(NamedTuple):
+    """A node_positions row, from a POSITION packet (degrees)."""
+
+    node_id: int
+    created_at: float
+    updated_at: float
+    latitude: float
+    longitude: float
+    altitude: float
+
+
+class NeighborRow(NamedTuple):
+    """A neighbor_info row: one per neighbor listed in a NEIGHBORINFO packet."""
+
+    node_id: int
+    neighbor_id: int
+    snr: float
+    update_time: float
+
+
+class TextMessageRow(NamedTuple):
+    """A text_messages row."""
+
+    source_id: int
+    destination_id: int
+    packet_id: int
+    toi: float
+    body: str
+
+
+class DeviceMetricsRow(NamedTuple):
+    """A device_metrics row, from device_metrics telemetry."""
+
+    node_id: int
+    packet_id: int
+    toi: float
+    battery_level: int | None
+    voltage: float | None
+    channel_util: float | None
+    air_util_tx: float | None
+    uptime_seconds: int | None
+
+
+class EnvironmentMetricsRow(NamedTuple):
+    """An environment_metrics row, from environment_metrics telemetry."""
+
+    node_id: int
+    packet_id: int
+    toi: float
+    temperature: float | None
+    relative_humidity: float | None
+    barometric_pressure: float | None
+    gas_resistance: float | None
+    voltage: float | None
+    current: float | None
+    iaq: int | None
+    distance: float | None
+    lux: float | None
+    white_lux: float | None
+    ir_lux: float | None
+    uv_lux: float | None
+    wind_direction: int | None
+    wind_speed: float | None
+    weight: float | None
+    wind_gus: float | None
+    wind_lull: float | None
+
+
+class PowerMetricsRow(NamedTuple):
+    """A power_metrics row, from power_metrics telemetry."""
+
+    node_id: int
+    packet_id: int
+    toi: float
+    ch1_voltage: float | None
+    ch1_current: float | None
+    ch2_voltage: float | None
+    ch2_current: float | None
+    ch3_voltage: float | None
+    ch3_current: float | None
+
+
+class AirQualityMetricsRow(NamedTuple):
+    """An air_quality_metrics row, from air_quality_metrics telemetry."""
+
+    node_id: int
+    packet_id: int
+    toi: float
+    pm10_std: int | None
+    pm25_std: int | None
+    pm100_std: int | None
+    pm10_env: int | None
+    pm25_env: int | None
+    pm100_env: int | None
+    particles_03um: int | None
+    particles_05um: int | None
+    particles_10um: int | None
+    particles_25um: int | None
+    particles_50um: int | None
+    particles_100um: int | None
+
+
+class LocalStatsRow(NamedTuple):
+    """A local_stats row, from local_stats telemetry (the table has no packet_id)."""
+
+    node_id: int
+    toi: float
+    uptime_seconds: int | None
+    channel_utilization: float | None
+    air_util_tx: float | None
+    num_packets_tx: int | None
+    num_packets_rx: int | None
+    num_packets_rx_bad: int | None
+    num_online_nodes: int | None
+    num_total_nodes: int | None
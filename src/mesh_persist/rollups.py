@@ -0,0 +1,181 @@
+"""Per-minute traffic rollups per gateway and channel.
+
+How busy each gateway and channel is, and what signal it hears, used to be a
+GROUP BY over mesh_packets.  Instead, every reception's mesh_packets row is
+folded into an in-memory aggregate for its (minute, gateway, channel):
+receptions, repeat receptions of an already seen packet (the rows the decoder
+marks as records.RepeatReception, so a repeat is whatever [dedup] treats as
+one), SNR and RSSI min/sum/max, and hops taken.  The aggregates are added into gateway_rollups
+every flush_interval seconds, in one statement, so a minute that spans
+flushes (or instances) adds up.
+"""
+
+# pylint: disable=R0902
+
+import logging
+import threading
+from collections.abc import Callable
+from dataclasses import astuple, dataclass
+from typing import TypeVar
+
+import psycopg2
+
+from . import db_functions, decoder, records
+
+BUCKET_SECONDS = 60
+
+T = TypeVar("T", int, float)
+
+
+def _extreme(pick: Callable[[T, T], T], current: T | None, newer: T | None) -> T | None:  # noqa: UP047
+    """The min or max (pick) of two optional values; None means no reception yet."""
+    if current is None:
+        return newer
+    if newer is None:
+        return current
+    return pick(current, newer)
+
+
+@dataclass
+class GatewayRollup:
+    """One gateway's traffic on one channel in one minute, since the last flush.
+
+    Field order matches the db_functions.BATCH_SQL["gateway_rollups"] row template.
+    """
+
+    bucket: int
+    gateway_id: int
+    channel_id: str
+    packets: int = 0
+    duplicates: int = 0
+    snr_min: float | None = None
+    snr_max: float | None = None
+    snr_sum: float = 0.0
+    rssi_min: int | None = None
+    rssi_max: int | None = None
+    rssi_sum: int = 0
+    hops_sum: int = 0
+    hops_count: int = 0
+
+    def add(self, row, *, duplicate: bool) -> None:
+        """Counts one mesh_packets row."""
+        self.packets += 1
+        self.duplicates += duplicate
+        self.snr_sum += row.rx_snr
+        self.rssi_sum += row.rx_rssi
+        if self.snr_min is None:
+            self.snr_min = self.snr_max = row.rx_snr
+            self.rssi_min = self.rssi_max = row.rx_rssi
+        else:
+            self.snr_min = min(self.snr_min, row.rx_snr)
+            self.snr_max = max(self.snr_max, row.rx_snr)
+            self.rssi_min = min(self.rssi_min, row.rx_rssi)
+            self.rssi_max = max(self.rssi_max, row.rx_rssi)
+        if row.hop_start >= row.hop_limit:
+            self.hops_sum += row.hop_start - row.hop_limit
+            self.hops_count += 1
+
+    def merge(self, newer: "GatewayRollup") -> None:
+        """Folds a later rollup of the same minute into this one (after a failed flush)."""
+        self.snr_min = _extreme(min, self.snr_min, newer.snr_min)
+        self.snr_max = _extreme(max, self.snr_max, newer.snr_max)
+        self.rssi_min = _extreme(min, self.rssi_min, newer.rssi_min)
+        self.rssi_max = _extreme(max, self.rssi_max, newer.rssi_max)
+        for name in ("packets", "duplicates", "snr_sum", "rssi_sum", "hops_sum", "hops_count"):
+            setattr(self, name, getattr(self, name) + getattr(newer, name))
+
+
+class GatewayRollups(threading.Thread):
+    """Aggregates receptions per minute, gateway and channel, and writes them periodically."""
+
+    def __init__(
+        self,
+        db: db_functions.DbFunctions,
+        logger: logging.Logger,
+        *,
+        flush_interval: float = 60.0,
+    ) -> None:
+        """Initialization function for GatewayRollups.
+
+        Args:
+            db: database functions used to write gateway_rollups.
+            logger: logger for flush errors.
+            flush_interval: seconds between writes.
+        """
+        super().__init__(name="mesh-persist-rollups", daemon=True)
+        self.db = db
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self.rows_written = 0
+        self._pending: dict[tuple[int, int, str], GatewayRollup] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def from_config(
+        cls, db: db_functions.DbFunctions, logger: logging.Logger, config: dict
+    ) -> "GatewayRollups":
+        """Builds GatewayRollups from the [rollups] section of mesh_persist.ini."""
+        return cls(
+            db,
+            logger,
+            flush_interval=float(config.get("flush_interval", 60.0)),
+        )
+
+    def observe(self, rows: decoder.Rows) -> None:
+        """Folds a decoded packet's mesh_packets rows into the pending rollups."""
+        with self._lock:
+            for table, row in rows:
+                if table != "mesh_packets":
+                    continue
+                bucket = int(row.toi) // BUCKET_SECONDS * BUCKET_SECONDS
+                key = (bucket, row.gateway_id, row.channel_id)
+                rollup = self._pending.get(key)
+                if rollup is None:
+                    rollup = self._pending[key] = GatewayRollup(*key)
+                rollup.add(row, duplicate=isinstance(row, records.RepeatReception))
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Flushes what is pending and stops."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self) -> None:
+        """Flush loop."""
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        """Adds every rollup gathered since the last flush into gateway_rollups."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        rows = [astuple(rollup) for rollup in pending.values()]
+        try:
+            self.db.write_batches({"gateway_rollups": rows})
+        except psycopg2.OperationalError as e:
+            self.logger.warning(
+                "gateway_rollups flush of %d rows failed, will retry: %s",
+                len(rows),
+                db_functions.format_db_error(e),
+            )
+            with self._lock:
+                for key, rollup in pending.items():
+                    newer = self._pending.get(key)
+                    if newer is not None:
+                        rollup.merge(newer)
+                    self._pending[key] = rollup
+            return
+        except psycopg2.Error as e:
+            self.logger.error(  # noqa: TRY400
+                "Dropping %d gateway_rollups rows: %s",
+                len(rows),
+                db_functions.format_db_error(e),
+            )
+            return
+        self.flushes += 1
+        self.rows_written += len(rows)
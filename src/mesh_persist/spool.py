@@ -0,0 +1,395 @@
+"""Durable on-disk spool.
+
+When the database is unreachable, or the writer can't keep up, raw MQTT
+messages are appended to a spool on disk instead of piling up in memory.  A
+replay thread feeds them back through the normal decode path once the
+database is healthy again.
+
+The spool is a directory of append-only segment files, spool-<n>.log, each a
+sequence of length-prefixed records (see encode_record).  The replay position
+(segment, byte offset) is kept in a small offset file that is replaced
+atomically, and only advanced once the replayed rows have been flushed, so a
+crash replays at most a little already-written data (which the ON CONFLICT
+inserts absorb; text_messages needs db/migrations/0007_text_messages_uk.sql for
+that) and never skips any.  A batch whose rows could not be flushed
+is read again from the committed position.
+
+Each append is flushed to the operating system at once, so a crash of the
+process loses nothing.  The active segment is fsync'd every fsync_interval
+seconds and on rotation, so a power loss or OS crash can lose up to that much
+of the newest records.
+"""
+
+# pylint: disable=R0902
+# pylint: disable=R0913
+
+import logging
+import os
+import struct
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO
+
+# timestamp (float seconds), topic length, payload length
+RECORD_HEADER = struct.Struct("<dHI")
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_new")
+
+
+def encode_record(timestamp: float, topic: str, payload: bytes) -> bytes:
+    """Frames one (timestamp, topic, payload) record."""
+    topic_bytes = topic.encode("utf-8")
+    return RECORD_HEADER.pack(timestamp, len(topic_bytes), len(payload)) + topic_bytes + payload
+
+
+def iter_records(f: BinaryIO, end: int | None = None) -> Iterator[tuple[float, str, bytes, int]]:
+    """Yields (timestamp, topic, payload, offset-after-record) from a framed stream.
+
+    Stops at `end` (if given) or at the first incomplete record, which is what a
+    crash in the middle of an append leaves behind.
+    """
+    offset = f.tell()
+    while end is None or offset + RECORD_HEADER.size <= end:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        timestamp, topic_len, payload_len = RECORD_HEADER.unpack(header)
+        body = f.read(topic_len + payload_len)
+        if len(body) < topic_len + payload_len:
+            return
+        offset += RECORD_HEADER.size + topic_len + payload_len
+        yield timestamp, body[:topic_len].decode("utf-8"), body[topic_len:], offset
+
+
+class ReplayAbortedError(Exception):
+    """Replayed messages were lost before reaching the writer; replay them again."""
+
+
+@dataclass
+class SpoolStats:
+    """Counters kept by the spool."""
+
+    appended: int = 0
+    replayed: int = 0
+    dropped: int = 0
+    segments_dropped: int = 0
+
+
+class Spool:
+    """Segment-rotated, append-only log of raw MQTT messages."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        directory: str,
+        logger: logging.Logger,
+        *,
+        segment_bytes: int = 64 * 1024 * 1024,
+        max_bytes: int = 1024 * 1024 * 1024,
+        overflow: str = "drop_oldest",
+        fsync_interval: float = 1.0,
+    ) -> None:
+        """Initialization function for Spool.
+
+        Args:
+            directory: where the segment and offset files live (created if missing).
+            logger: logger for spool status messages.
+            segment_bytes: rotate to a new segment file after this many bytes.
+            max_bytes: upper bound on the total size of all segments.
+            overflow: what to do at max_bytes: drop_oldest deletes the oldest
+                segment, drop_new refuses new records.
+            fsync_interval: fsync the active segment at most this often (seconds);
+                0 fsyncs every append.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            msg = f"Unknown spool overflow policy {overflow!r}"
+            raise ValueError(msg)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.logger = logger
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.fsync_interval = fsync_interval
+        self.stats = SpoolStats()
+        self._lock = threading.Lock()
+        self._segments = sorted(
+            int(p.stem.removeprefix("spool-")) for p in self.directory.glob("spool-*.log")
+        )
+        self._sizes = {seg: self._path(seg).stat().st_size for seg in self._segments}
+        if not self._segments:
+            self._segments = [0]
+            self._sizes = {0: 0}
+        self._read_pos = self._load_offset()
+        self._committed = self._read_pos
+        self._next_fsync = time.monotonic() + fsync_interval
+        self._write_seg = self._segments[-1]
+        self._recover_tail()
+        self._writer = self._path(self._write_seg).open("ab")
+
+    @classmethod
+    def from_config(cls, logger: logging.Logger, config: dict) -> "Spool":
+        """Builds a Spool from the [spool] section of mesh_persist.ini."""
+        return cls(
+            config.get("directory", "spool"),
+            logger,
+            segment_bytes=int(config.get("segment_mb", 64)) * 1024 * 1024,
+            max_bytes=int(config.get("max_mb", 1024)) * 1024 * 1024,
+            overflow=config.get("overflow", "drop_oldest"),
+            fsync_interval=float(config.get("fsync_interval", 1.0)),
+        )
+
+    def _path(self, segment: int) -> Path:
+        return self.directory / f"spool-{segment:010d}.log"
+
+    def _recover_tail(self) -> None:
+        """Truncates a record left half-written by a crash off the last segment."""
+        path = self._path(self._write_seg)
+        if not path.exists():
+            return
+        good = 0
+        with path.open("rb") as f:
+            for *_, next_off in iter_records(f):
+                good = next_off
+        if good < self._sizes[self._write_seg]:
+            self.logger.warning("Spool segment %d has a torn record; truncating", self._write_seg)
+            os.truncate(path, good)
+            self._sizes[self._write_seg] = good
+
+    def _load_offset(self) -> tuple[int, int]:
+        try:
+            seg, off = (int(v) for v in (self.directory / "offset").read_text().split())
+        except (OSError, ValueError):
+            return self._segments[0], 0
+        if seg < self._segments[0]:
+            return self._segments[0], 0
+        return seg, off
+
+    def _save_offset(self, pos: tuple[int, int]) -> None:
+        tmp = self.directory / "offset.tmp"
+        with tmp.open("w") as f:
+            f.write(f"{pos[0]} {pos[1]}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self.directory / "offset")
+
+    @property
+    def size(self) -> int:
+        """Total bytes held in segment files."""
+        return sum(self._sizes.values())
+
+    def has_backlog(self) -> bool:
+        """True if there are spooled records that have not been replayed."""
+        with self._lock:
+            return self._read_pos < (self._write_seg, self._sizes[self._write_seg])
+
+    def append(self, topic: str, payload: bytes, timestamp: float | None = None) -> bool:
+        """Appends a message.  Returns False if the overflow policy dropped it."""
+        record = encode_record(time.time() if timestamp is None else timestamp, topic, payload)
+        with self._lock:
+            if self.size + len(record) > self.max_bytes and not self._make_room(len(record)):
+                self.stats.dropped += 1
+                return False
+            if self._sizes[self._write_seg] + len(record) > self.segment_bytes:
+                self._rotate()
+            self._writer.write(record)
+            self._writer.flush()
+            now = time.monotonic()
+            if now >= self._next_fsync:
+                os.fsync(self._writer.fileno())
+                self._next_fsync = now + self.fsync_interval
+            self._sizes[self._write_seg] += len(record)
+            self.stats.appended += 1
+        return True
+
+    def _rotate(self) -> None:
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        self._writer.close()
+        self._write_seg += 1
+        self._segments.append(self._write_seg)
+        self._sizes[self._write_seg] = 0
+        self._writer = self._path(self._write_seg).open("ab")
+
+    def _make_room(self, needed: int) -> bool:
+        if self.overflow == "drop_new":
+            return False
+        while self.size + needed > self.max_bytes and len(self._segments) > 1:
+            oldest = self._segments.pop(0)
+            self.logger.warning("Spool full, discarding segment %d", oldest)
+            self._path(oldest).unlink(missing_ok=True)
+            del self._sizes[oldest]
+            self.stats.segments_dropped += 1
+            if self._read_pos[0] <= oldest:
+                self._read_pos = (self._segments[0], 0)
+            if self._committed[0] <= oldest:
+                self._committed = (self._segments[0], 0)
+                self._save_offset(self._committed)
+        return self.size + needed <= self.max_bytes
+
+    def read_batch(self, max_records: int) -> tuple[list[tuple[str, bytes]], tuple[int, int]]:
+        """Reads up to max_records unreplayed messages.
+
+        Returns:
+            The (topic, payload) messages and the position just past them, to be
+            handed to commit() once they are safely in the database.
+        """
+        with self._lock:
+            seg, off = self._read_pos
+            if seg not in self._sizes:
+                seg, off = self._segments[0], 0
+            end = self._sizes[seg]
+            if off >= end and seg != self._write_seg:
+                seg, off = self._segments[self._segments.index(seg) + 1], 0
+                end = self._sizes[seg]
+            if seg == self._write_seg:
+                self._writer.flush()
+        messages: list[tuple[str, bytes]] = []
+        pos = (seg, off)
+        with self._path(seg).open("rb") as f:
+            f.seek(off)
+            for _, topic, payload, next_off in iter_records(f, end):
+                messages.append((topic, payload))
+                pos = (seg, next_off)
+                if len(messages) >= max_records:
+                    break
+        with self._lock:
+            self._read_pos = pos
+        return messages, pos
+
+    def commit(self, pos: tuple[int, int], count: int) -> None:
+        """Records that everything before pos has been replayed into the database."""
+        self._save_offset(pos)
+        with self._lock:
+            self._committed = pos
+            self.stats.replayed += count
+            while self._segments[0] < pos[0]:
+                done = self._segments.pop(0)
+                del self._sizes[done]
+                self._path(done).unlink(missing_ok=True)
+
+    def rewind(self) -> None:
+        """Moves the read position back to the last commit, to replay what follows again."""
+        with self._lock:
+            self._read_pos = self._committed
+
+    def close(self) -> None:
+        """Flushes and closes the active segment."""
+        with self._lock:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._writer.close()
+
+
+class SpoolReplayer(threading.Thread):
+    """Background thread that replays the spool once the writer is healthy again."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        spool: Spool,
+        ingest: Callable[[str, bytes], None],
+        is_ready: Callable[[], bool],
+        wait_flushed: Callable[[float], bool],
+        logger: logging.Logger,
+        *,
+        batch_records: int = 5000,
+        chunk_records: int = 500,
+        min_speedup: float = 10.0,
+    ) -> None:
+        """Initialization function for SpoolReplayer.
+
+        Args:
+            spool: the spool to drain.
+            ingest: feeds one raw message through the decode/submit path, waiting
+                for room in the write queue rather than dropping rows.
+            is_ready: True when the database is healthy and the writer has room.
+            wait_flushed: waits up to the given seconds for everything ingested so
+                far to be flushed; returns False if it wasn't, and raises
+                ReplayAbortedError if some of it never will be.
+            logger: logger for replay progress.
+            batch_records: records ingested, at most, per offset commit.
+            chunk_records: records ingested between checks of is_ready; a batch
+                ends early once the writer is no longer ready.
+            min_speedup: warn when replay runs at less than this multiple of the
+                rate live messages are being spooled at meanwhile.
+        """
+        super().__init__(name="mesh-persist-replay", daemon=True)
+        self.spool = spool
+        self.ingest = ingest
+        self.is_ready = is_ready
+        self.wait_flushed = wait_flushed
+        self.logger = logger
+        self.batch_records = batch_records
+        self.chunk_records = max(1, min(chunk_records, batch_records))
+        self.min_speedup = min_speedup
+        self._stop_event = threading.Event()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Stops replaying after the current chunk.
+
+        A batch whose rows aren't flushed by then is not committed, and is
+        replayed again on the next start.
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self) -> None:
+        """Replay loop."""
+        while not self._stop_event.is_set():
+            if not (self.spool.has_backlog() and self.is_ready()):
+                self._stop_event.wait(1.0)
+                continue
+            start = time.perf_counter()
+            appended = self.spool.stats.appended
+            count = 0
+            pos = None
+            while count < self.batch_records and not self._stop_event.is_set():
+                messages, pos = self.spool.read_batch(
+                    min(self.chunk_records, self.batch_records - count)
+                )
+                for topic, payload in messages:
+                    self.ingest(topic, payload)
+                count += len(messages)
+                if not messages or not (self.spool.has_backlog() and self.is_ready()):
+                    break
+            if pos is None:
+                continue
+            if not self._flushed(count):
+                self.spool.rewind()
+                continue
+            self.spool.commit(pos, count)
+            self._log_rate(count, self.spool.stats.appended - appended, time.perf_counter() - start)
+
+    def _flushed(self, count: int) -> bool:
+        """Waits for the batch's rows to be flushed; False if it has to be replayed again."""
+        try:
+            while not self.wait_flushed(1.0):
+                if self._stop_event.is_set():
+                    self.logger.warning(
+                        "Stopped before the replayed messages were flushed; they will be replayed"
+                    )
+                    return False
+        except ReplayAbortedError as e:
+            self.logger.warning("Replaying the last %d spooled messages again: %s", count, e)
+            return False
+        return True
+
+    def _log_rate(self, count: int, appended: int, elapsed: float) -> None:
+        """Logs the replay rate, warning if it is not far enough ahead of live traffic."""
+        rate = count / elapsed if elapsed else 0.0
+        live = appended / elapsed if elapsed else 0.0
+        if live and rate < live * self.min_speedup:
+            self.logger.warning(
+                "Replayed %d spooled messages at %.0f msgs/s, only %.1fx the %.0f msgs/s "
+                "being spooled meanwhile (target %gx)",
+                count,
+                rate,
+                rate / live,
+                live,
+                self.min_speedup,
+            )
+            return
+        self.logger.info("Replayed %d spooled messages (%.0f msgs/s)", count, rate)
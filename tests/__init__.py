@@ -0,0 +1 @@
+"""mesh_persist tests."""
@@ -0,0 +1,23 @@
+"""Shared fixtures: a decoder wired up as MeshPersist does it, without a broker or database."""
+
+import logging
+
+import pytest
+
+from mesh_persist import channels, decoder, dedup, metrics
+
+
+@pytest.fixture
+def pipeline_metrics() -> metrics.PipelineMetrics:
+    return metrics.PipelineMetrics()
+
+
+@pytest.fixture
+def packet_decoder(pipeline_metrics: metrics.PipelineMetrics) -> decoder.PacketDecoder:
+    logger = logging.getLogger("test")
+    return decoder.PacketDecoder(
+        channels.ChannelKeys.from_config({}, logger),
+        dedup.DedupCache(),
+        logger,
+        pipeline_metrics=pipeline_metrics,
+    )
@@ -0,0 +1,90 @@
+"""The batch writer's handling of batches the database rejects."""
+
+import logging
+
+import psycopg2
+
+from mesh_persist import batch_writer
+
+BAD = "bad\x00body"
+TEXTS = [(n, f"text {n}") for n in range(10)]
+PACKETS = [(n,) for n in range(5)]
+
+
+class FakeDb:
+    """Stands in for DbFunctions, rejecting any batch that holds a NUL text body."""
+
+    def __init__(self, *, disconnects: int = 0) -> None:
+        """Fails every write after the first with a lost connection, `disconnects` times."""
+        self.written: dict[str, list[tuple]] = {}
+        self.calls = 0
+        self.disconnects = disconnects
+
+    def write_batches(
+        self, batches: dict[str, list[tuple]], *, bulk_copy: bool = False
+    ) -> dict[str, tuple[int, int]]:
+        """Records the rows written, like a committed transaction."""
+        del bulk_copy
+        self.calls += 1
+        if self.disconnects and self.calls > 1:
+            self.disconnects -= 1
+            msg = "server closed the connection unexpectedly"
+            raise psycopg2.OperationalError(msg)
+        if any(BAD in row for rows in batches.values() for row in rows):
+            # what psycopg2 raises when adapting such a string
+            msg = "A string literal cannot contain NUL (0x00) characters."
+            raise ValueError(msg)
+        for table, rows in batches.items():
+            self.written.setdefault(table, []).extend(rows)
+        return {}
+
+
+def writer(db: FakeDb) -> batch_writer.BatchWriter:
+    return batch_writer.BatchWriter(db, logging.getLogger("test"), flush_interval=0.01)  # type: ignore[arg-type]
+
+
+def batch() -> dict[str, list[tuple]]:
+    return {
+        "text_messages": [*TEXTS, (10, BAD)],
+        "mesh_packets": list(PACKETS),
+    }
+
+
+def test_bad_row_drops_only_itself() -> None:
+    db = FakeDb()
+    w = writer(db)
+    assert w._flush(batch())
+    assert sorted(db.written["text_messages"]) == TEXTS
+    assert db.written["mesh_packets"] == PACKETS
+    assert w.stats.rows_dropped == 1
+    assert w.stats.rows_written == len(TEXTS) + len(PACKETS)
+    assert w.stats.flush_errors == 1
+    assert w.healthy
+
+
+def test_lost_connection_keeps_unwritten_rows() -> None:
+    db = FakeDb(disconnects=1)
+    w = writer(db)
+    pending = batch()
+    assert not w._flush(pending)
+    assert not w.healthy
+    assert w._flush(pending)
+    assert not pending
+    # nothing written twice, only the bad row missing
+    assert sorted(db.written["text_messages"]) == TEXTS
+    assert db.written["mesh_packets"] == PACKETS
+    assert w.stats.rows_dropped == 1
+
+
+def test_writer_thread_survives_bad_rows() -> None:
+    db = FakeDb()
+    w = writer(db)
+    w.start()
+    w.submit("text_messages", (1, BAD))
+    w.submit("text_messages", (2, "fine"))
+    assert w.wait_flushed(w.stats.rows_submitted, timeout=5)
+    assert w.is_alive()
+    w.submit("text_messages", (3, "later"))
+    assert w.wait_flushed(w.stats.rows_submitted, timeout=5)
+    w.stop(timeout=5)
+    assert db.written["text_messages"] == [(2, "fine"), (3, "later")]
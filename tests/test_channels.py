@@ -0,0 +1,99 @@
+"""Channel keys: decryption and the negative cache."""
+
+import logging
+
+import pytest
+from Crypto.Cipher import AES
+
+from mesh_persist import channels
+
+PACKET_ID = 0x1234ABCD
+SOURCE = 0xA1B2C3D4
+CHANNEL = "LongFast"
+THRESHOLD = 3
+TTL = 300.0
+
+
+class Clock:
+    """A time.monotonic stand-in that only moves when told to."""
+
+    def __init__(self) -> None:
+        """Starts the clock at an arbitrary time."""
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        """The current time."""
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(channels.time, "monotonic", clock)
+    return clock
+
+
+def reference_decrypt(key: bytes, packet_id: int, source: int, encrypted: bytes) -> bytes:
+    nonce = packet_id.to_bytes(8, "little") + source.to_bytes(4, "little")
+    return AES.new(key, AES.MODE_CTR, nonce=nonce, initial_value=0).decrypt(encrypted)
+
+
+@pytest.mark.parametrize("key", [channels.DEFAULT_KEY, bytes(range(32))])
+@pytest.mark.parametrize("size", [0, 1, 15, 16, 17, 100, 237])
+def test_decrypt_matches_aes_ctr(key: bytes, size: int) -> None:
+    encrypted = bytes((n * 7 + 3) & 0xFF for n in range(size))
+    channel = channels.ChannelKey(CHANNEL, key)
+    decrypted = channel.decrypt(PACKET_ID, SOURCE, encrypted)
+    assert decrypted == reference_decrypt(key, PACKET_ID, SOURCE, encrypted)
+    # CTR is its own inverse
+    assert channel.decrypt(PACKET_ID, SOURCE, decrypted) == encrypted
+
+
+def test_expand_psk() -> None:
+    assert channels.expand_psk(b"") is None
+    assert channels.expand_psk(b"\x00") is None
+    assert channels.expand_psk(b"\x01") == channels.DEFAULT_KEY
+    assert channels.expand_psk(b"\x02") == channels.DEFAULT_KEY[:-1] + b"\x02"
+    assert channels.expand_psk(bytes(16)) == bytes(16)
+    with pytest.raises(ValueError, match="PSK must be"):
+        channels.expand_psk(bytes(8))
+
+
+def test_lookup_by_hash() -> None:
+    keys = channels.ChannelKeys.default()
+    chash = channels.channel_hash(CHANNEL, channels.DEFAULT_KEY)
+    channel = keys.lookup(chash, CHANNEL)
+    assert channel is not None
+    assert channel.key == channels.DEFAULT_KEY
+
+
+def test_unknown_channel_is_skipped_until_ttl(clock: Clock) -> None:
+    keys = channels.ChannelKeys([], logging.getLogger("test"), negative_ttl=TTL)
+    assert keys.lookup(1, "secret") is None
+    assert keys.lookup(1, "secret") is None
+    assert keys.stats.unknown == 1
+    assert keys.stats.suppressed == 1
+    clock.now += TTL
+    assert keys.lookup(1, "secret") is None
+    assert keys.stats.unknown == 1 + 1
+
+
+def test_failing_channel_is_skipped_after_threshold(clock: Clock) -> None:
+    keys = channels.ChannelKeys(
+        [channels.ChannelKey(CHANNEL, channels.DEFAULT_KEY)],
+        logging.getLogger("test"),
+        negative_ttl=TTL,
+        failure_threshold=THRESHOLD,
+    )
+    chash = channels.channel_hash(CHANNEL, channels.DEFAULT_KEY)
+    for _ in range(THRESHOLD - 1):
+        keys.failed(chash, CHANNEL)
+    # a success in between starts the count again
+    keys.decoded(chash, CHANNEL)
+    for _ in range(THRESHOLD - 1):
+        keys.failed(chash, CHANNEL)
+    assert keys.lookup(chash, CHANNEL) is not None
+    keys.failed(chash, CHANNEL)
+    assert keys.lookup(chash, CHANNEL) is None
+    clock.now += TTL
+    assert keys.lookup(chash, CHANNEL) is not None
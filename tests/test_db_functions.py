@@ -0,0 +1,89 @@
+"""Row building helpers."""
+
+import logging
+import time
+from typing import Self
+
+import psycopg2
+import pytest
+
+from mesh_persist import db_functions
+
+RECEIVED = 1_700_000_000
+
+
+@pytest.mark.parametrize(
+    ("rx_time", "expected"),
+    [
+        (RECEIVED - 60, RECEIVED - 60),
+        (0, RECEIVED),  # no rx_time
+        (12_345, RECEIVED),  # clock never set: seconds since boot
+        (int(time.time()) + 30 * 86400, RECEIVED),  # clock far ahead
+    ],
+)
+def test_packet_toi(rx_time: int, expected: int) -> None:
+    assert db_functions.packet_toi(rx_time, RECEIVED) == expected
+
+
+def test_packet_toi_without_first_seen_is_now() -> None:
+    before = int(time.time())
+    assert before <= db_functions.packet_toi(0) <= time.time()
+
+
+class FakeCursor:
+    """Answers every query with `row`."""
+
+    def __init__(self, row: tuple | None) -> None:
+        """Remembers the row to answer with."""
+        self.row = row
+        self.executed: list[str] = []
+
+    def __enter__(self) -> Self:
+        """Used as a context manager, like a psycopg2 cursor."""
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        """Nothing to close."""
+
+    def execute(self, sql: str) -> None:
+        """Records the statement."""
+        self.executed.append(sql)
+
+    def fetchone(self) -> tuple | None:
+        """The canned row."""
+        return self.row
+
+
+class FakeConnection:
+    """Hands out one FakeCursor."""
+
+    closed = False
+
+    def __init__(self, cur: FakeCursor) -> None:
+        """Wraps cur."""
+        self.cur = cur
+
+    def cursor(self) -> FakeCursor:
+        """The wrapped cursor."""
+        return self.cur
+
+    def commit(self) -> None:
+        """Nothing to commit."""
+
+    def close(self) -> None:
+        """Marks the connection closed."""
+        self.closed = True
+
+
+@pytest.mark.parametrize("migrated", [True, False])
+def test_pool_refuses_unmigrated_database(monkeypatch: pytest.MonkeyPatch, migrated: bool) -> None:  # noqa: FBT001
+    cur = FakeCursor(None if migrated else (1,))
+    monkeypatch.setattr(psycopg2, "connect", lambda **_: FakeConnection(cur))
+    pool = db_functions.ConnectionPool({}, logging.getLogger("test"))
+    if migrated:
+        assert pool.session().conn.cursor() is cur
+        assert any(sql.startswith("PREPARE") for sql in cur.executed)
+        return
+    with pytest.raises(psycopg2.OperationalError, match="0003_position_geom"):
+        pool.session()
+    assert not any(sql.startswith("PREPARE") for sql in cur.executed)
@@ -0,0 +1,77 @@
+"""The dedup cache's TTL expiry and size cap."""
+
+import pytest
+
+from mesh_persist import dedup
+
+TTL = 600.0
+PORTNUM = 1
+SOURCE = 0xA1B2C3D4
+
+
+class Clock:
+    """A time.monotonic stand-in that only moves when told to."""
+
+    def __init__(self) -> None:
+        """Starts the clock at an arbitrary time."""
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        """The current time."""
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(dedup.time, "monotonic", clock)
+    return clock
+
+
+def test_repeat_within_ttl_is_a_hit(clock: Clock) -> None:
+    cache = dedup.DedupCache(ttl=TTL)
+    assert cache.lookup(SOURCE, 1) is None
+    cache.add(SOURCE, 1, PORTNUM)
+    clock.now += TTL - 1
+    assert cache.lookup(SOURCE, 1) == PORTNUM
+    # the same packet id from another node is a different packet
+    assert cache.lookup(SOURCE + 1, 1) is None
+    assert cache.stats.hits == 1
+    assert cache.stats.misses == 1 + 1
+
+
+def test_entries_expire_after_ttl(clock: Clock) -> None:
+    cache = dedup.DedupCache(ttl=TTL)
+    cache.add(SOURCE, 1, PORTNUM)
+    clock.now += TTL / 2
+    cache.add(SOURCE, 2, PORTNUM)
+    clock.now += TTL / 2
+    assert cache.lookup(SOURCE, 1) is None
+    assert cache.lookup(SOURCE, 2) == PORTNUM
+    assert cache.stats.expired == 1
+    assert len(cache) == 1
+
+
+def test_oldest_evicted_past_max_entries(clock: Clock) -> None:
+    del clock
+    cache = dedup.DedupCache(max_entries=3, ttl=TTL)
+    for packet_id in range(5):
+        cache.add(SOURCE, packet_id, PORTNUM)
+    assert len(cache) == cache.max_entries
+    assert cache.stats.evicted == 1 + 1
+    assert cache.lookup(SOURCE, 1) is None
+    assert cache.lookup(SOURCE, 2) == PORTNUM
+    # adding a packet again renews it
+    cache.add(SOURCE, 2, PORTNUM)
+    cache.add(SOURCE, 5, PORTNUM)
+    assert cache.lookup(SOURCE, 3) is None
+    assert cache.lookup(SOURCE, 2) == PORTNUM
+
+
+def test_first_seen_is_stable(clock: Clock) -> None:
+    cache = dedup.DedupCache(ttl=TTL)
+    cache.add(SOURCE, 1, PORTNUM)
+    first = cache.first_seen(SOURCE, 1)
+    clock.now += TTL / 2
+    assert cache.first_seen(SOURCE, 1) == first
+    assert cache.first_seen(SOURCE, 2) is None
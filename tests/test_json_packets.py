@@ -0,0 +1,125 @@
+"""The JSON feed: mapping onto protobuf messages, and malformed input."""
+
+import json
+
+import pytest
+
+from mesh_persist import db_functions, decoder, json_packets, metrics, records
+from mesh_persist.protos import mesh_pb2, portnums_pb2
+
+TOPIC = "msh/EU_868/2/json/LongFast/!a1b2c3d4"
+SOURCE = 0x11223344
+GATEWAY = 0xA1B2C3D4
+TIMESTAMP = 1_700_000_000
+HOP_START = 3
+
+
+def text_packet(**overrides: object) -> dict:
+    packet = {
+        "type": "text",
+        "from": SOURCE,
+        "to": 0xFFFFFFFF,
+        "id": 1234,
+        "timestamp": TIMESTAMP,
+        "snr": 5.5,
+        "rssi": -90,
+        "hop_start": HOP_START,
+        "hops_away": 1,
+        "sender": "!a1b2c3d4",
+        "payload": {"text": "hello"},
+    }
+    packet.update(overrides)
+    return packet
+
+
+def decode(packet_decoder: decoder.PacketDecoder, packet: object, topic: str = TOPIC) -> list:
+    return packet_decoder.decode(topic, json.dumps(packet).encode())
+
+
+def json_failures(pipeline_metrics: metrics.PipelineMetrics) -> float:
+    return pipeline_metrics.decode_failures.take().get(("json_parse",), 0.0)
+
+
+def test_text_packet_rows(packet_decoder: decoder.PacketDecoder) -> None:
+    rows = decode(packet_decoder, text_packet())
+    tables = [table for table, _ in rows]
+    assert tables == ["mesh_packets", "text_messages"]
+    reception = rows[0][1]
+    assert reception.source == SOURCE
+    assert reception.gateway_id == GATEWAY
+    assert reception.channel_id == "LongFast"
+    assert reception.hop_limit == HOP_START - 1
+    assert reception.toi == TIMESTAMP
+
+
+def test_repeat_reception_is_marked(packet_decoder: decoder.PacketDecoder) -> None:
+    decode(packet_decoder, text_packet())
+    rows = decode(packet_decoder, text_packet(sender="!0000beef"))
+    assert len(rows) == 1
+    assert isinstance(rows[0][1], records.RepeatReception)
+    assert rows[0][1].gateway_id == db_functions.hex_to_id("!0000beef")
+
+
+def test_missing_sender_falls_back_to_topic(packet_decoder: decoder.PacketDecoder) -> None:
+    rows = decode(packet_decoder, text_packet(sender=None))
+    assert rows[0][1].gateway_id == GATEWAY
+
+
+def test_unstored_types_are_ignored(packet_decoder: decoder.PacketDecoder) -> None:
+    assert decode(packet_decoder, text_packet(type="sendtext")) == []
+    assert decode(packet_decoder, {"type": "text"}) == []
+    assert decode(packet_decoder, [1, 2, 3]) == []
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        pytest.param({"to": None}, id="null-to"),
+        pytest.param({"to": -1}, id="negative-to"),
+        pytest.param({"id": "abc"}, id="non-numeric-id"),
+        pytest.param({"from": 2**40}, id="from-out-of-range"),
+        pytest.param({"rssi": 1e400}, id="infinite-rssi"),
+        pytest.param({"snr": [1]}, id="list-snr"),
+        pytest.param({"type": ["text"]}, id="unhashable-type"),
+        pytest.param({"hops_away": "x"}, id="non-numeric-hops"),
+        pytest.param({"sender": 42}, id="non-string-sender-and-topic"),
+    ],
+)
+def test_malformed_packet_is_skipped(
+    packet_decoder: decoder.PacketDecoder,
+    pipeline_metrics: metrics.PipelineMetrics,
+    overrides: dict,
+) -> None:
+    topic = "msh/EU_868/2/json/LongFast/gateway"
+    assert decode(packet_decoder, text_packet(**overrides), topic) == []
+    assert json_failures(pipeline_metrics) == 1
+
+
+def test_non_hex_sender_and_topic_is_skipped(
+    packet_decoder: decoder.PacketDecoder, pipeline_metrics: metrics.PipelineMetrics
+) -> None:
+    packet = text_packet()
+    del packet["sender"]
+    assert decode(packet_decoder, packet, "msh/EU_868/2/json/LongFast/gateway") == []
+    assert json_failures(pipeline_metrics) == 1
+
+
+def test_undecodable_json_is_skipped(
+    packet_decoder: decoder.PacketDecoder, pipeline_metrics: metrics.PipelineMetrics
+) -> None:
+    assert packet_decoder.decode(TOPIC, b'{"type": "text", "from": ') == []
+    assert json_failures(pipeline_metrics) == 1
+
+
+def test_malformed_payload_fields_are_dropped() -> None:
+    info = json_packets.payload_message(
+        portnums_pb2.NEIGHBORINFO_APP, {"node_id": 1, "neighbors": "not a list"}
+    )
+    assert isinstance(info, mesh_pb2.NeighborInfo)
+    assert info.node_id == 1
+    assert len(info.neighbors) == 0
+    info = json_packets.payload_message(
+        portnums_pb2.NEIGHBORINFO_APP, {"neighbors": [{"node_id": 5, "snr": "bad"}, "junk"]}
+    )
+    assert isinstance(info, mesh_pb2.NeighborInfo)
+    assert [n.node_id for n in info.neighbors] == [5]
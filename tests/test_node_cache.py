@@ -0,0 +1,79 @@
+"""The node state cache: filtering unchanged rows and committing written ones."""
+
+import logging
+
+from mesh_persist import node_cache, records
+
+TABLE = "node_infos"
+NODE = 0xA1B2C3D4
+FIRST = 1_700_000_000.0
+LATER = FIRST + 60
+MAC = b"\x01\x02\x03\x04\x05\x06"
+
+
+def info(node: int = NODE, long_name: str = "Base", seen: float = FIRST) -> records.NodeInfoRow:
+    return records.NodeInfoRow(
+        node, long_name, "BS", MAC, "HELTEC_V3", "CLIENT", b"\xaa" * 32, seen, seen
+    )
+
+
+def cache(**kwargs: float) -> node_cache.NodeStateCache:
+    return node_cache.NodeStateCache(logging.getLogger("test"), **kwargs)  # type: ignore[arg-type]
+
+
+def write(c: node_cache.NodeStateCache, rows: list) -> list:
+    """Filters rows as DbFunctions.write_batches does, committing what is kept."""
+    pending: dict[str, dict[int, tuple]] = {}
+    kept = c.filter(TABLE, rows, pending)
+    c.commit(pending)
+    return kept
+
+
+def test_unchanged_row_is_suppressed_and_touched() -> None:
+    c = cache(touch_interval=0)
+    assert write(c, [info()]) == [info()]
+    assert write(c, [info(seen=LATER)]) == []
+    assert write(c, [info(long_name="Renamed", seen=LATER)]) == [
+        info(long_name="Renamed", seen=LATER)
+    ]
+    assert c.stats.suppressed == 1
+    assert c.stats.passed == 1 + 1
+    assert c.take_touches() == {TABLE: [(NODE, "Base", "BS", LATER)]}
+
+
+def test_repeats_within_one_batch_are_suppressed() -> None:
+    c = cache()
+    pending: dict[str, dict[int, tuple]] = {}
+    assert c.filter(TABLE, [info(), info(seen=LATER)], pending) == [info()]
+
+
+def test_uncommitted_rows_are_not_cached() -> None:
+    c = cache()
+    # a transaction that rolled back: nothing committed, so nothing remembered
+    c.filter(TABLE, [info()], {})
+    assert len(c) == 0
+    assert write(c, [info()]) == [info()]
+
+
+def test_warmed_rows_compare_as_stored() -> None:
+    c = cache()
+    # bytea columns read back as their hex text
+    c.warm(TABLE, [(NODE, *node_cache.stored(info()[1:7]))])
+    assert write(c, [info()]) == []
+
+
+def test_least_recently_seen_evicted() -> None:
+    c = cache(max_entries=2)
+    write(c, [info(node) for node in (1, 2)])
+    write(c, [info(1, seen=LATER)])  # suppressed, but still recently seen
+    write(c, [info(3)])
+    assert write(c, [info(1)]) == []
+    assert write(c, [info(2)]) == [info(2)]
+
+
+def test_restored_touches_are_written_again() -> None:
+    c = cache(touch_interval=0)
+    write(c, [info(), info(seen=LATER)])
+    taken = c.take_touches()
+    c.restore_touches(taken)
+    assert c.take_touches() == taken
@@ -0,0 +1,73 @@
+"""The node status tracker's flushes, including ones the database rejects."""
+
+import logging
+
+import psycopg2
+
+from mesh_persist import node_status, records
+
+BAD_NODE = 2
+NODES = (1, BAD_NODE, 3)
+GATEWAY = 0xA1B2C3D4
+FIRST = 1_700_000_000.0
+LATER = FIRST + 60
+
+
+def packet(source: int, toi: float = FIRST) -> tuple[str, records.MeshPacketRow]:
+    return (
+        "mesh_packets",
+        records.MeshPacketRow(
+            source, 0xFFFFFFFF, 1, 0, 5.0, -90, 3, 3, "TEXT_MESSAGE_APP", toi, "LongFast", GATEWAY
+        ),
+    )
+
+
+class FakeDb:
+    """Writes node_status rows, rejecting BAD_NODE's and failing to connect `disconnects` times."""
+
+    def __init__(self, disconnects: int = 0) -> None:
+        """Starts out with nothing written."""
+        self.written: dict[int, tuple] = {}
+        self.disconnects = disconnects
+
+    def write_batches(self, batches: dict[str, list[tuple]]) -> dict:
+        """Stores rows by node id, or raises like psycopg2 would."""
+        rows = batches["node_status"]
+        if self.disconnects:
+            self.disconnects -= 1
+            msg = "server closed the connection unexpectedly"
+            raise psycopg2.OperationalError(msg)
+        if any(row[0] == BAD_NODE for row in rows):
+            msg = "value out of range"
+            raise psycopg2.DataError(msg)
+        self.written.update((row[0], row) for row in rows)
+        return {}
+
+
+def tracker(db: FakeDb) -> node_status.NodeStatusTracker:
+    tracker = node_status.NodeStatusTracker(db, logging.getLogger("test"))  # type: ignore[arg-type]
+    tracker.observe([packet(node) for node in NODES])
+    return tracker
+
+
+def test_bad_node_drops_only_itself() -> None:
+    db = FakeDb()
+    t = tracker(db)
+    t.flush()
+    assert sorted(db.written) == [1, 3]
+    assert t.nodes_written == len(NODES) - 1
+    assert not t._pending
+
+
+def test_lost_connection_keeps_and_merges_updates() -> None:
+    db = FakeDb(disconnects=1)
+    t = tracker(db)
+    t.flush()
+    assert not db.written
+    # seen again before the retry: the counts add up, the latest time wins
+    t.observe([packet(1, LATER)])
+    t.flush()
+    assert sorted(db.written) == [1, 3]
+    delta = node_status.NodeDelta(*db.written[1])
+    assert delta.packet_count == len([FIRST, LATER])
+    assert delta.last_seen == LATER
@@ -0,0 +1,122 @@
+"""The on-disk spool: torn tails, offset commits and replay."""
+
+import logging
+import time
+from pathlib import Path
+
+import pytest
+
+from mesh_persist import spool
+
+TOPIC = "msh/EU_868/2/e/LongFast/!a1b2c3d4"
+MESSAGES = [(TOPIC, bytes([n]) * 20) for n in range(10)]
+TIMEOUT = 5.0
+
+
+def open_spool(directory: Path, **kwargs: object) -> spool.Spool:
+    return spool.Spool(str(directory), logging.getLogger("test"), **kwargs)  # type: ignore[arg-type]
+
+
+def filled_spool(directory: Path) -> spool.Spool:
+    s = open_spool(directory)
+    for topic, payload in MESSAGES:
+        s.append(topic, payload)
+    return s
+
+
+def test_torn_tail_is_truncated(tmp_path: Path) -> None:
+    filled_spool(tmp_path).close()
+    (segment,) = tmp_path.glob("spool-*.log")
+    whole = segment.stat().st_size
+    with segment.open("ab") as f:
+        # a crash part way through the next append
+        f.write(spool.encode_record(0.0, TOPIC, b"x" * 20)[:-5])
+    s = open_spool(tmp_path)
+    assert segment.stat().st_size == whole
+    messages, _ = s.read_batch(100)
+    assert messages == MESSAGES
+    # appends carry on after the last whole record
+    s.append(TOPIC, b"after")
+    messages, _ = s.read_batch(100)
+    assert messages == [(TOPIC, b"after")]
+
+
+def test_committed_offset_survives_restart(tmp_path: Path) -> None:
+    s = filled_spool(tmp_path)
+    messages, pos = s.read_batch(4)
+    assert messages == MESSAGES[:4]
+    s.commit(pos, len(messages))
+    s.read_batch(4)  # read, never committed
+    s.close()
+    s = open_spool(tmp_path)
+    messages, _ = s.read_batch(100)
+    assert messages == MESSAGES[4:]
+
+
+def test_rewind_rereads_uncommitted(tmp_path: Path) -> None:
+    s = filled_spool(tmp_path)
+    _, pos = s.read_batch(4)
+    s.commit(pos, 4)
+    s.read_batch(4)
+    s.rewind()
+    messages, _ = s.read_batch(100)
+    assert messages == MESSAGES[4:]
+
+
+def test_rotation_and_drop_oldest(tmp_path: Path) -> None:
+    record = len(spool.encode_record(0.0, *MESSAGES[0]))
+    s = open_spool(tmp_path, segment_bytes=record * 2, max_bytes=record * 4)
+    for topic, payload in MESSAGES:
+        assert s.append(topic, payload)
+    assert s.stats.segments_dropped == len(MESSAGES) // 2 - 2
+    messages: list = []
+    while s.has_backlog():
+        batch, pos = s.read_batch(100)
+        s.commit(pos, len(batch))
+        messages += batch
+    assert messages == MESSAGES[-4:]
+
+
+class ReplayTarget:
+    """Collects replayed messages; its first flush wait aborts the batch."""
+
+    def __init__(self) -> None:
+        """Starts out with nothing ingested."""
+        self.ingested: list[tuple[str, bytes]] = []
+        self.aborts = 1
+
+    def ingest(self, topic: str, payload: bytes) -> None:
+        """Records a replayed message."""
+        self.ingested.append((topic, payload))
+
+    def wait_flushed(self, timeout: float) -> bool:
+        """Reports everything flushed, after aborting once."""
+        del timeout
+        if self.aborts:
+            self.aborts -= 1
+            msg = "lost"
+            raise spool.ReplayAbortedError(msg)
+        return True
+
+
+@pytest.mark.parametrize("batch_records", [3, 100])
+def test_replayer_replays_aborted_batch_again(tmp_path: Path, batch_records: int) -> None:
+    s = filled_spool(tmp_path)
+    target = ReplayTarget()
+    replayer = spool.SpoolReplayer(
+        s,
+        target.ingest,
+        lambda: True,
+        target.wait_flushed,
+        logging.getLogger("test"),
+        batch_records=batch_records,
+    )
+    replayer.start()
+    deadline = time.monotonic() + TIMEOUT
+    while s.has_backlog() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    replayer.stop(TIMEOUT)
+    assert not s.has_backlog()
+    assert s.stats.replayed == len(MESSAGES)
+    # the aborted batch is replayed twice, everything else once
+    assert target.ingested == MESSAGES[: min(batch_records, len(MESSAGES))] + MESSAGES